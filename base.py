@@ -17,40 +17,50 @@ class BasePlayer:
         ``set_prefs`` method.
     matching : Optional[BasePlayer]
         The current match of the player. ``None`` if not currently matched.
-    _pref_names : Optional[List]
-        A list of the names in ``prefs``. Updates with ``prefs`` via
-        ``set_prefs`` method.
-    _original_prefs : Optional[List[BasePlayer]]
-        The original set of player preferences. Defaults to ``None`` and does
-        not update after the first ``set_prefs`` method call.
+    vector : PearlVector
+        The player's goals or characteristics.
+    _ranks : Dict[BasePlayer, int]
+        The rank of each player in ``prefs``, built by ``set_prefs``.
+
+    Players are slotted, so that a market of millions of them doesn't also carry millions of instance
+    dictionaries. Nothing that can be worked out from ``prefs`` is stored separately.
     """
 
+    __slots__ = ('name', 'prefs', 'matching', 'vector', '_ranks')
+
     def __init__(self, name, vector: PearlVector):
         self.name = name
+        self.vector = vector
         self.prefs = []
         self.matching = []
-        self.vector = vector
-        self.fits = {}
-
-        self._pref_names = []
-        self._original_prefs = None
+        self._ranks = {}
 
     def __repr__(self):
         return str(self.name)
 
+    @property
+    def _pref_names(self):
+        """The names of the players in ``prefs``."""
+        return [player.name for player in self.prefs]
+
+    @property
+    def _original_prefs(self):
+        """The player's preferences. ``prefs`` is only ever replaced, never edited, so these are the same."""
+        return self.prefs
+
     def _forget(self, other):
         """Forget another player by removing them from the player's preference
         list."""
 
-        self.prefs = [p for p in self.prefs if p != other]
+        self.set_prefs([p for p in self.prefs if p != other])
     
     def get_fitness(self, other):
-        if other.name in self.fits.keys():
-            return self.fits[other.name]
-        else:
-            fitness = self.vector @ other.vector
-            self.fits[other.name] = fitness
-            return fitness
+        return self.vector @ other.vector
+
+    @property
+    def fits(self):
+        """The player's fit to each player in ``prefs``, by name."""
+        return {player.name: self.get_fitness(player) for player in self.prefs}
 
     def unmatched_message(self):
         """Message to say the player is not matched."""
@@ -68,17 +78,23 @@ class BasePlayer:
     def set_prefs(self, players):
         """Set the player's preferences to be a list of players."""
         self.prefs = players
-        self._pref_names = [player.name for player in players]
+        # a player listed twice keeps their first rank, as ``prefs.index`` would find it
+        ranks = {}
+        for rank, player in enumerate(players):
+            ranks.setdefault(player, rank)
+        self._ranks = ranks
+
+    def get_rank(self, player):
+        """The position of a player in ``prefs``, or ``None`` if they are not listed."""
 
-        if self._original_prefs is None:
-            self._original_prefs = players[:]
+        return self._ranks.get(player)
 
     def prefers(self, player, other):
         """Determines whether the player prefers a player over some other
         player."""
 
-        prefs = self._original_prefs
-        return prefs.index(player) < prefs.index(other)
+        ranks = self._ranks
+        return ranks[player] < ranks[other]
 
     @abc.abstractmethod
     def _match(self, other):
@@ -0,0 +1,315 @@
+"""Benchmarks for the matcher, on synthetic markets of any size.
+
+Each run generates a seeded market, writes it out in the input file format, and then times each stage of
+the pipeline separately – parsing, fit computation, matching and output – recording the peak memory
+`tracemalloc` sees in each. The results are written as JSON, so that runs from two releases can be
+compared with ``--compare``.
+
+```shell
+# the default sizes: 10^3, 10^4 and 10^5 buyers
+python3 bench.py
+
+# a skewed market, where every buyer ranks the same neighborhood first
+python3 bench.py --buyers 1000000 --neighborhoods 1000 --skew top
+
+# compare against a previous run
+python3 bench.py --output bench_new.txt --compare bench_output.txt
+
+# a market with room for only half the buyers, where the rest are turned down by every neighborhood they
+# rank; also time the array engine's match with and without its vectorized scan of full neighborhoods
+python3 bench.py --buyers 20000 --neighborhoods 1000 --capacity 10 --scan
+
+# also load-test `match.py serve` against one-shot runs of the CLI, with 200 requests from 4 clients
+python3 bench.py --buyers 100000 --serve 200 --clients 4
+```
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, Iterator, List, Optional
+
+import engine
+import fits
+import match
+import reader
+import server
+from stats import MatchStats
+
+MATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'match.py')
+
+SKEWS = ('uniform', 'zipf', 'top')
+
+def _preferences(rng: random.Random, names: List[str], length: int, skew: str, weights: List[float]) -> List[str]:
+    if skew == 'uniform':
+        return rng.sample(names, length)
+    if skew == 'top':
+        # everyone wants the first neighborhood most: the worst case for displacements
+        return [names[0]] + rng.sample(names[1:], length - 1)
+    chosen = []
+    seen = set()
+    while len(chosen) < length:
+        for name in rng.choices(names, weights=weights, k=length - len(chosen)):
+            if name not in seen:
+                seen.add(name)
+                chosen.append(name)
+    return chosen
+
+def generate_lines(buyers: int, neighborhoods: int, seed: int = 0, skew: str = 'uniform',
+                   preferences: Optional[int] = None, max_value: int = 10,
+                   capacity: Optional[int] = None) -> Iterator[str]:
+    """The lines of a seeded random market, neighborhoods first.
+
+    Parameters
+    ----------
+    buyers, neighborhoods : int
+        The size of the market.
+    seed : int
+        Seed for the random number generator; the same arguments always give the same market.
+    skew : str
+        How preferences are distributed: 'uniform' at random, 'zipf' towards the first neighborhoods
+        with Zipfian popularity, or 'top', where every buyer ranks the first neighborhood first.
+    preferences : Optional[int]
+        How many neighborhoods each buyer ranks; every neighborhood by default.
+    max_value : int
+        The largest value in any goal or characteristic.
+    capacity : Optional[int]
+        A capacity for every neighborhood to declare; by default they split the buyers evenly. With less
+        room than buyers, those left over work their way down every preference before giving up.
+    """
+    if skew not in SKEWS:
+        raise ValueError(f"Unknown skew {skew!r}; expected one of {SKEWS}")
+    rng = random.Random(seed)
+    length = min(preferences or neighborhoods, neighborhoods)
+    names = [f'N{i}' for i in range(neighborhoods)]
+    weights = [1 / (rank + 1) for rank in range(neighborhoods)]
+    declared = '' if capacity is None else f' C:{capacity}'
+    for name in names:
+        yield (f'N {name} E:{rng.randint(0, max_value)} W:{rng.randint(0, max_value)} R:{rng.randint(0, max_value)}'
+               f'{declared}')
+    for i in range(buyers):
+        prefs = _preferences(rng, names, length, skew, weights)
+        yield (f'H H{i} E:{rng.randint(0, max_value)} W:{rng.randint(0, max_value)} R:{rng.randint(0, max_value)} '
+               f'{">".join(prefs)}')
+
+def generate_market(file_name: str, buyers: int, neighborhoods: int, **kwargs) -> None:
+    """Write a market from `generate_lines` to `file_name`."""
+    with open(file_name, 'w', buffering=1 << 20) as output_file:
+        for line in generate_lines(buyers, neighborhoods, **kwargs):
+            output_file.write(line)
+            output_file.write('\n')
+
+class Stages:
+    """Times a sequence of named stages, and their peak traced memory."""
+
+    def __init__(self, trace_memory: bool = True) -> None:
+        self.trace_memory = trace_memory
+        self.results: Dict[str, Dict[str, float]] = {}
+
+    def run(self, name: str, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.results[name] = {'seconds': time.perf_counter() - start}
+            if self.trace_memory:
+                self.results[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+def run_benchmark(input_file: str, engine_name: str = 'array', trace_memory: bool = True) -> Dict[str, Dict[str, float]]:
+    """Time each stage of matching the market in `input_file`.
+
+    The object engine's fits are computed by `match.read_input_file` as it builds the buyers, so they are part
+    of its parse stage rather than a separate fit stage.
+    """
+    stages = Stages(trace_memory)
+    if engine_name == 'array':
+        market = stages.run('parse', reader.read_market, input_file)
+        pref_fits, order = stages.run('fit', engine.fit_stage, market)
+        result = stages.run('match', engine.array_optimal_match, market, order=order, fits=pref_fits)
+        stages.run('output', match.write_matching, os.devnull, result)
+    else:
+        input_data = stages.run('parse', match.read_input_file, input_file)
+        matches = stages.run('match', match.buyer_optimal_match, input_data['homebuyers'], input_data['neighborhoods'])
+        stages.run('output', match.write_output_file, os.devnull, matches)
+    return stages.results
+
+def scan_benchmark(input_file: str, repeats: int = 3) -> Dict[str, Dict[str, float]]:
+    """Time the array engine's match with and without its vectorized scan, taking the best of `repeats`.
+
+    Both find the same matching with the same number of proposals; ``scanned`` is how many of those were
+    rejections the scan found at once, rather than one proposal at a time.
+    """
+    market = reader.read_market(input_file)
+    pref_fits, order = engine.fit_stage(market)
+    results = {}
+    for name, scan in (('one_at_a_time', False), ('scan', True)):
+        best = None
+        for _ in range(repeats):
+            stats = MatchStats()
+            start = time.perf_counter()
+            engine.array_optimal_match(market, order=order, fits=pref_fits, stats=stats, scan=scan)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        results[name] = {'seconds': best, 'proposals': stats.proposals, 'scanned': stats.scanned}
+    return results
+
+def _wait_for(path: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError("The match server didn't start")
+        time.sleep(0.01)
+
+def serve_benchmark(input_file: str, requests: int = 20, clients: int = 4, workers: Optional[int] = None,
+                    cli_requests: int = 5) -> Dict[str, float]:
+    """Requests per second from a warm `match.py serve`, against one-shot runs of the CLI.
+
+    The server is started in its own process and loads the market once; then `clients` connections send
+    `requests` match requests between them. The CLI is run `cli_requests` times, each a fresh process that
+    parses the market and solves it with the array engine.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'match.sock')
+        command = [sys.executable, MATCH, 'serve', '--socket', path]
+        if workers is not None:
+            command += ['--workers', str(workers)]
+        process = subprocess.Popen(command, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for(path, process)
+            with server.MatchClient(path) as client:
+                client.load('bench', os.path.abspath(input_file))
+                # the first solve in each worker loads the market there
+                client.match('bench')
+
+            def run(count: int) -> None:
+                with server.MatchClient(path) as client:
+                    for _ in range(count):
+                        client.match('bench')
+
+            shares = [requests // clients + (i < requests % clients) for i in range(clients)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                for future in [executor.submit(run, share) for share in shares]:
+                    future.result()
+            server_seconds = time.perf_counter() - start
+            with server.MatchClient(path) as client:
+                client.shutdown()
+            process.wait(timeout=30)
+        finally:
+            if process.poll() is None:
+                process.kill()
+
+    start = time.perf_counter()
+    for _ in range(cli_requests):
+        subprocess.run([sys.executable, MATCH, input_file, '--reader=stream', '--output', os.devnull],
+                       check=True, stderr=subprocess.DEVNULL)
+    cli_seconds = time.perf_counter() - start
+    server_rps = requests / server_seconds
+    cli_rps = cli_requests / cli_seconds
+    return {'requests': requests, 'clients': clients, 'server_rps': server_rps, 'cli_rps': cli_rps,
+            'speedup': server_rps / cli_rps}
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> List[str]:
+    """Describe every stage that got more than `tolerance` slower or bigger than in `baseline`."""
+    def key(run):
+        return (run['buyers'], run['neighborhoods'], run['skew'], run['preferences'], run.get('capacity'),
+                run['engine'])
+
+    previous = {key(run): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        before = previous.get(key(run))
+        if before is None:
+            continue
+        for stage, measures in run['stages'].items():
+            for measure, value in measures.items():
+                old = before['stages'].get(stage, {}).get(measure)
+                if old and value > old * (1 + tolerance):
+                    regressions.append(f"{key(run)} {stage} {measure}: {old:.4g} -> {value:.4g}")
+    return regressions
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the matcher on synthetic markets')
+    parser.add_argument('--buyers', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Market sizes to run, in buyers.')
+    parser.add_argument('--neighborhoods', type=int, default=10)
+    parser.add_argument('--preferences', type=int, required=False,
+                        help='Neighborhoods ranked by each buyer (default: all of them).')
+    parser.add_argument('--skew', choices=SKEWS, default='uniform')
+    parser.add_argument('--capacity', type=int, required=False,
+                        help='A capacity for every neighborhood to declare (default: an even split of the buyers).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=match.ENGINES, default='array',
+                        help='Matching implementation to benchmark; "array" is much faster for large markets.')
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+                        help="Don't trace memory; tracing slows every stage down.")
+    parser.add_argument('--scan', action='store_true',
+                        help="Also time the array engine's match with and without its vectorized scan.")
+    parser.add_argument('--serve', type=int, required=False, metavar='REQUESTS',
+                        help='Also send this many match requests to a warm "match.py serve", and compare its '
+                             'requests per second with one-shot runs of the CLI.')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent connections for --serve.')
+    parser.add_argument('--output', type=str, default='bench_output.txt', help='Where to write the JSON results.')
+    parser.add_argument('--compare', type=str, required=False,
+                        help='A previous results file; regressions of more than 10%% are reported.')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python': platform.python_version(),
+        'numpy': fits.numpy is not None,
+        'runs': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for buyers in args.buyers:
+            input_file = os.path.join(directory, f'market_{buyers}.txt')
+            generate_market(input_file, buyers, args.neighborhoods, seed=args.seed, skew=args.skew,
+                            preferences=args.preferences, capacity=args.capacity)
+            stages = run_benchmark(input_file, args.engine, args.trace_memory)
+            run = {
+                'buyers': buyers,
+                'neighborhoods': args.neighborhoods,
+                'preferences': args.preferences,
+                'capacity': args.capacity,
+                'skew': args.skew,
+                'seed': args.seed,
+                'engine': args.engine,
+                'stages': stages,
+            }
+            print(f"{buyers} buyers: " + ', '.join(f"{stage} {measures['seconds']:.3f}s"
+                                                   for stage, measures in stages.items()), file=sys.stderr)
+            if args.scan:
+                run['scan'] = scan_benchmark(input_file)
+                print(f"{buyers} buyers: match {run['scan']['one_at_a_time']['seconds']:.3f}s one proposal at a time, "
+                      f"{run['scan']['scan']['seconds']:.3f}s with the scan, which turned down "
+                      f"{run['scan']['scan']['scanned']} of {run['scan']['scan']['proposals']} proposals at once",
+                      file=sys.stderr)
+            if args.serve:
+                run['serve'] = serve_benchmark(input_file, args.serve, args.clients)
+                print(f"{buyers} buyers: server {run['serve']['server_rps']:.1f} requests/s, "
+                      f"CLI {run['serve']['cli_rps']:.1f} requests/s", file=sys.stderr)
+            results['runs'].append(run)
+            os.remove(input_file)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,88 @@
-from typing import List, Type
+from array import array
+from typing import List, Sequence, Type
 
 from base import BasePlayer
 from neighborhood import Neighborhood
 from vector import PearlVector
 
 class Homebuyer(BasePlayer):
-    def __init__(self, name: str, goals: Type[PearlVector], preferences: List[Neighborhood]) -> None:
+    """A buyer, with goals and a ranked list of neighborhoods.
+
+    The buyer's fit to each of their preferences is kept in an ``array`` parallel to ``prefs``, rather than
+    in a dictionary keyed by name; ``fits`` rebuilds that dictionary on demand.
+    """
+
+    __slots__ = ('_fits',)
+
+    def __init__(self, name: str, goals: Type[PearlVector], preferences: List[Neighborhood],
+                 compute_fits: bool = True) -> None:
         super().__init__(name, vector=goals)
-        self.goals = goals
         self.matching = None
         self.set_prefs(preferences)
-        self.fits = {n.name: self.goals @ n.characteristics for n in preferences}
+        # when building many buyers at once, leave this to `fits.assign_fits`, which batches the work
+        if compute_fits:
+            self.set_fits([goals @ n.characteristics for n in preferences])
+
+    @property
+    def goals(self) -> PearlVector:
+        return self.vector
+
+    @goals.setter
+    def goals(self, goals: PearlVector) -> None:
+        self.vector = goals
+
+    @property
+    def fits(self):
+        """The buyer's stored fit to each of their preferences, by name."""
+        if self._fits is None:
+            return {}
+        return {n.name: fit for n, fit in zip(self.prefs, self._fits)}
+
+    def set_fits(self, fits: Sequence, copy: bool = True) -> None:
+        """Store the buyer's fit to each of their preferences, in preference order.
+
+        With ``copy=False``, `fits` must be an `array`, and is kept as it is: buyers who share their goals and
+        their preference list can share their fits too, since any update to one is the same for all.
+        """
+        self._fits = array(self.vector.schema.fit_typecode, fits) if copy else fits
+
+    def ranked_fits(self) -> Sequence:
+        """The buyer's fit to each of their preferences, in preference order."""
+        if self._fits is not None:
+            return self._fits
+        return [self.vector @ n.vector for n in self.prefs]
+
+    def update_fit(self, neighborhood: Neighborhood) -> None:
+        """Recompute the stored fit to `neighborhood`, after its characteristics change."""
+        rank = self._ranks.get(neighborhood)
+        if self._fits is None or rank is None:
+            return
+        fit = self._fits[rank] = self.vector @ neighborhood.vector
+        if len(self._ranks) < len(self.prefs):
+            # listed more than once
+            for i in range(rank + 1, len(self.prefs)):
+                if self.prefs[i] is neighborhood:
+                    self._fits[i] = fit
+
+    def get_fitness(self, other) -> int:
+        fits = self._fits
+        if fits is not None:
+            rank = self._ranks.get(other)
+            if rank is not None:
+                return fits[rank]
+        return self.vector @ other.vector
+
+    def set_prefs(self, players: List[Neighborhood]) -> None:
+        super().set_prefs(players)
+        self._fits = None
+
+    def _forget(self, other):
+        fits = self._fits
+        if fits is not None:
+            fits = [fit for n, fit in zip(self.prefs, fits) if n != other]
+        super()._forget(other)
+        if fits is not None:
+            self.set_fits(fits)
     
     def _match(self, other):
         self.matching = other
@@ -18,11 +90,17 @@ class Homebuyer(BasePlayer):
     def _unmatch(self):
         self.matching = None
     
+    def check_if_match_is_unacceptable(self):
+        """A message if the buyer is matched to a neighborhood they don't list, otherwise ``None``."""
+        if self.matching is not None and self.matching not in self._ranks:
+            return self.not_in_preferences_message(self.matching)
+        return None
+
     def get_favorite(self) -> Neighborhood:
         return self.prefs[0]
 
     def get_successors(self):
         """Get all the successors to the current match of the buyer."""
 
-        idx = self.prefs.index(self.matching)
-        return self.prefs[idx + 1 :]
\ No newline at end of file
+        idx = self._ranks[self.matching]
+        return self.prefs[idx + 1 :]
@@ -0,0 +1,377 @@
+"""A cache of fits on disk, so that a market scored once isn't scored from scratch again.
+
+From one run to the next, a market's neighborhoods rarely change and most of its homebuyers don't either, but
+every run scores every preference again. A `FitCache` keeps the fits of the markets it has scored in a
+directory, one entry file per set of neighborhoods:
+
+* an entry is named for a hash of everything a fit depends on apart from the buyer – the neighborhoods'
+  characteristics, in order, the schema's weights and the type of the fits – so that runs against the same
+  neighborhoods share an entry, and any change to them starts a new one;
+* within an entry, each buyer profile – goals and preferences – is found by a 64-bit hash of its values. A
+  buyer who is new, or whose goals or preferences have changed, is scored; everyone else's fits are read
+  back. Buyers with the same profile share one set of fits;
+* the entry is then rewritten with the profiles of the market just scored, so that buyers who have left drop
+  out of it. It's left as it is if nothing changed.
+
+Two different profiles of one market would have to share a hash to be confused, which for 64 bits and even
+millions of profiles is vanishingly unlikely. Hashes are taken over fixed-width, little-endian values, so an
+entry written on one machine is found on another.
+
+Reading an entry marks it as recently used. Once the entries in the directory add up to more than
+`max_bytes`, the least recently used are removed until they fit, and an entry too big to fit on its own
+isn't written at all. An entry that can't be read is scored from scratch and replaced.
+
+An entry file is:
+
+* a header: the magic bytes, a format version, the typecode of the fits, the number of profiles and of
+  fits, and the seconds spent scoring the fits it has been filled with and how many that was, from which
+  the time the cache saves is estimated;
+* the profiles' hashes, in the order the market first listed them, the offset of each profile's fits and
+  then the fits, all little-endian.
+
+Entries are written to a temporary file and moved into place, so a run that is interrupted never leaves half
+an entry behind.
+"""
+from array import array
+import hashlib
+import logging
+import os
+import struct
+import sys
+import time
+from typing import Optional, Sequence, Tuple
+
+import exceptions
+from fits import _floating, gather_fits, numpy
+from stats import MatchStats
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'NBHDFITS'
+VERSION = 1
+SUFFIX = '.fits'
+
+# magic, version, fit typecode, profile count, fit count, seconds spent scoring, fits scored
+HEADER = struct.Struct('<8sIc3xQQdQ')
+
+# keep the entries within this many bytes by default
+MAX_BYTES = 1 << 30
+
+# preferences are hashed as 4-byte integers, whatever the size of a C int
+PREF_TYPECODE = next(code for code in ('i', 'l') if array(code).itemsize == 4)
+
+class Entry:
+    """The fits of every profile of one market, as a cache entry holds them.
+
+    Attributes
+    ----------
+    digests : array
+        The hash of each profile, in the order the market first listed them.
+    offsets : array
+        Profile ``p``'s fits are ``fits[offsets[p]:offsets[p + 1]]``.
+    fits : array
+        Every profile's fits, to its preferences in order.
+    scored_seconds : float
+        The time spent scoring the fits this entry has been filled with, over every run.
+    scored : int
+        How many fits that was.
+    """
+
+    def __init__(self, digests: array, offsets: array, fits: array, scored_seconds: float = 0.0,
+                 scored: int = 0) -> None:
+        self.digests = digests
+        self.offsets = offsets
+        self.fits = fits
+        self.scored_seconds = scored_seconds
+        self.scored = scored
+
+    @property
+    def nbytes(self) -> int:
+        return HEADER.size + sum(column.itemsize * len(column) for column in (self.digests, self.offsets, self.fits))
+
+def _canonical(column: Sequence, typecode: str) -> Sequence:
+    """`column` as a buffer of `typecode` values, copied only if it holds some other type."""
+    if getattr(column, 'typecode', getattr(column, 'format', None)) == typecode:
+        return column
+    return array(typecode, column)
+
+def _little_endian(column: Sequence, typecode: str) -> memoryview:
+    """The bytes of `column` as little-endian `typecode` values."""
+    column = _canonical(column, typecode)
+    if sys.byteorder != 'little':
+        column = array(typecode, column)
+        column.byteswap()
+    return memoryview(column).cast('B')
+
+def _vector_typecode(column: Sequence) -> str:
+    return 'd' if _floating(column) else 'q'
+
+def market_key(neighborhood_vectors: Sequence, dims: int, weights: Optional[Sequence[float]], typecode: str) -> str:
+    """The name of the entry for a set of neighborhoods, with fits of type `typecode`."""
+    digest = hashlib.blake2b(struct.pack('<cQQ', typecode.encode(), dims, 0 if weights is None else len(weights)),
+                             digest_size=16)
+    if weights is not None:
+        digest.update(_little_endian(weights, 'd'))
+    digest.update(_little_endian(neighborhood_vectors, _vector_typecode(neighborhood_vectors)))
+    return digest.hexdigest()
+
+def buyer_digests(buyer_vectors: Sequence, offsets: Sequence[int], indices: Sequence[int], dims: int = 3) -> array:
+    """The 64-bit hash of each buyer's profile: their goals, and the neighborhoods in their slice of a CSR
+    preference list."""
+    vectors = _little_endian(buyer_vectors, _vector_typecode(buyer_vectors))
+    prefs = _little_endian(indices, PREF_TYPECODE)
+    width = 8 * dims
+    size = 4
+    blake2b = hashlib.blake2b
+    digests = bytearray()
+    for buyer in range(len(offsets) - 1):
+        digest = blake2b(vectors[buyer * width:(buyer + 1) * width], digest_size=8)
+        digest.update(prefs[offsets[buyer] * size:offsets[buyer + 1] * size])
+        digests += digest.digest()
+    column = array('Q')
+    column.frombytes(digests)
+    return column
+
+def _write(output_file, column: array) -> None:
+    output_file.write(_little_endian(column, column.typecode))
+
+def _read(input_file, typecode: str, count: int, file_name: str) -> array:
+    column = array(typecode)
+    try:
+        column.fromfile(input_file, count)
+    except EOFError:
+        raise exceptions.DataParsingError(file_name)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+def save_entry(file_name: str, entry: Entry) -> None:
+    """Write `entry` to `file_name`, atomically."""
+    temporary = f"{file_name}.tmp"
+    with open(temporary, 'wb') as output_file:
+        output_file.write(HEADER.pack(MAGIC, VERSION, entry.fits.typecode.encode(), len(entry.digests),
+                                      len(entry.fits), entry.scored_seconds, entry.scored))
+        for column in (entry.digests, entry.offsets, entry.fits):
+            _write(output_file, column)
+    os.replace(temporary, file_name)
+
+def load_entry(file_name: str) -> Entry:
+    """Read an entry written by `save_entry`."""
+    with open(file_name, 'rb') as input_file:
+        header = input_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise exceptions.DataParsingError(file_name)
+        magic, version, typecode, profiles, count, scored_seconds, scored = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise exceptions.DataParsingError(file_name)
+        digests = _read(input_file, 'Q', profiles, file_name)
+        offsets = _read(input_file, 'q', profiles + 1, file_name)
+        fits = _read(input_file, typecode.decode(), count, file_name)
+    return Entry(digests, offsets, fits, scored_seconds, scored)
+
+def _select(offsets: Sequence[int], rows: Sequence[int]) -> Tuple[array, array]:
+    """The positions in a CSR column of the slices of `rows`, and the offsets of those slices once gathered."""
+    positions = array('q')
+    selected = array('q', [0])
+    for row in rows:
+        positions.extend(range(offsets[row], offsets[row + 1]))
+        selected.append(len(positions))
+    return positions, selected
+
+def _gather(column: Sequence, positions: Sequence[int], typecode: str) -> array:
+    return array(typecode, [column[k] for k in positions])
+
+class FitCache:
+    """Fits kept on disk from one run to the next, by the content of the market they were scored for.
+
+    Parameters
+    ----------
+    directory : str
+        Where the entries are kept. It's created if need be.
+    max_bytes : int
+        The most the entries may take up together.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = MAX_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def _load(self, file_name: str, typecode: str) -> Optional[Entry]:
+        try:
+            entry = load_entry(file_name)
+        except FileNotFoundError:
+            return None
+        except exceptions.DataParsingError:
+            logger.warning("ignoring unreadable fit cache entry %s", file_name)
+            return None
+        if entry.fits.typecode != typecode:
+            return None
+        os.utime(file_name)
+        return entry
+
+    def gather_fits(self, buyer_vectors: Sequence, neighborhood_vectors: Sequence, offsets: Sequence[int],
+                    indices: Sequence[int], dims: int = 3, weights: Optional[Sequence[float]] = None,
+                    stats: Optional[MatchStats] = None) -> array:
+        """`fits.gather_fits`, scoring only the buyers whose profiles aren't cached for these neighborhoods.
+
+        With `stats`, the buyers whose fits were read from the cache are counted as hits and the others as
+        misses, and the time saved is estimated from how long scoring has taken per fit.
+        """
+        start = time.perf_counter()
+        floating = _floating(buyer_vectors) or _floating(neighborhood_vectors) or weights is not None
+        typecode = 'd' if floating else 'q'
+        file_name = self._path(market_key(neighborhood_vectors, dims, weights, typecode))
+        entry = self._load(file_name, typecode) or Entry(array('Q'), array('q', [0]), array(typecode))
+        digests = buyer_digests(buyer_vectors, offsets, indices, dims)
+        if digests == entry.digests:
+            # the same buyers in the same order: the entry holds their fits just as they're wanted
+            fits, missed, scored, scored_seconds, updated = entry.fits, 0, 0, 0.0, None
+        else:
+            lookup = _lookup_vectorized if numpy is not None else _lookup
+            fits, missed, scored, scored_seconds, updated = lookup(entry, digests, buyer_vectors,
+                                                                   neighborhood_vectors, offsets, indices, dims,
+                                                                   weights, typecode)
+        if updated is not None:
+            updated.scored_seconds = entry.scored_seconds + scored_seconds
+            updated.scored = entry.scored + scored
+            self._save(file_name, updated)
+            entry = updated
+        if stats is not None:
+            stats.cache_hits += len(digests) - missed
+            stats.cache_misses += missed
+            if entry.scored:
+                estimate = entry.scored_seconds / entry.scored * len(indices)
+                stats.cache_seconds_saved += estimate - (time.perf_counter() - start)
+        return fits
+
+    def preference_fits(self, market, stats: Optional[MatchStats] = None) -> array:
+        """`fits.preference_fits` for a `market.Market`, through the cache."""
+        return self.gather_fits(market.buyer_vectors, market.neighborhood_vectors, market.pref_offsets,
+                                market.pref_indices, market.dims, market.schema.weights, stats)
+
+    def _save(self, file_name: str, entry: Entry) -> None:
+        if entry.nbytes > self.max_bytes:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            return
+        save_entry(file_name, entry)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the rest fit within `max_bytes`."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                status = os.stat(os.path.join(self.directory, name))
+                entries.append((status.st_mtime, name, status.st_size))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+def _lookup(entry: Entry, digests: array, buyer_vectors: Sequence, neighborhood_vectors: Sequence,
+            offsets: Sequence[int], indices: Sequence[int], dims: int, weights: Optional[Sequence[float]],
+            typecode: str) -> Tuple[array, int, int, float, Optional[Entry]]:
+    """Every buyer's fits; how many buyers, and how many of their fits, had to be scored and how long that
+    took; and the entry to save, if it changed."""
+    cached = {digest: p for p, digest in enumerate(entry.digests)}
+    missed = [buyer for buyer, digest in enumerate(digests) if digest not in cached]
+    started = time.perf_counter()
+    positions, scored_offsets = _select(offsets, missed)
+    vectors = array(_vector_typecode(buyer_vectors))
+    for buyer in missed:
+        vectors.extend(buyer_vectors[buyer * dims:(buyer + 1) * dims])
+    scored = gather_fits(vectors, neighborhood_vectors, scored_offsets, _gather(indices, positions, 'i'), dims,
+                         weights) if missed else array(typecode)
+    scored_seconds = time.perf_counter() - started
+
+    fits = array(typecode)
+    m = 0
+    for digest in digests:
+        p = cached.get(digest)
+        if p is None:
+            fits.extend(scored[scored_offsets[m]:scored_offsets[m + 1]])
+            m += 1
+        else:
+            fits.extend(entry.fits[entry.offsets[p]:entry.offsets[p + 1]])
+
+    first = {}
+    for buyer, digest in enumerate(digests):
+        first.setdefault(digest, buyer)
+    if not missed and len(first) == len(entry.digests):
+        return fits, len(missed), len(scored), scored_seconds, None
+    if len(first) == len(digests):
+        updated = Entry(digests, array('q', offsets), fits)
+    else:
+        positions, profile_offsets = _select(offsets, list(first.values()))
+        updated = Entry(array('Q', first), profile_offsets, _gather(fits, positions, typecode))
+    return fits, len(missed), len(scored), scored_seconds, updated
+
+def _ranges(starts, lengths):
+    """The positions ``starts[i]:starts[i] + lengths[i]`` for every ``i``, one after another."""
+    total = int(lengths.sum())
+    ends = numpy.cumsum(lengths)
+    return numpy.arange(total) + numpy.repeat(starts - (ends - lengths), lengths)
+
+def _lookup_vectorized(entry: Entry, digests: array, buyer_vectors: Sequence, neighborhood_vectors: Sequence,
+                       offsets: Sequence[int], indices: Sequence[int], dims: int, weights: Optional[Sequence[float]],
+                       typecode: str) -> Tuple[array, int, int, float, Optional[Entry]]:
+    """`_lookup`, with NumPy."""
+    digests = numpy.frombuffer(digests, dtype=numpy.uint64)
+    cached = numpy.frombuffer(entry.digests, dtype=numpy.uint64)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    lengths = numpy.diff(offsets)
+    # each buyer's profile in the entry, if it's there
+    order = numpy.argsort(cached)
+    where = numpy.minimum(numpy.searchsorted(cached[order], digests), max(len(cached) - 1, 0))
+    if len(cached):
+        where = order[where]
+        found = cached[where] == digests
+    else:
+        found = numpy.zeros(len(digests), dtype=bool)
+    missed = numpy.flatnonzero(~found)
+
+    started = time.perf_counter()
+    scored = numpy.zeros(0, dtype=typecode)
+    scored_offsets = numpy.zeros(1, dtype=numpy.int64)
+    if len(missed):
+        goals = numpy.asarray(buyer_vectors).reshape(-1, dims)[missed]
+        missed_lengths = lengths[missed]
+        scored_offsets = numpy.concatenate(([0], numpy.cumsum(missed_lengths)))
+        prefs = numpy.asarray(indices)[_ranges(offsets[missed], missed_lengths)]
+        scored = numpy.frombuffer(gather_fits(_column(_vector_typecode(buyer_vectors), goals), neighborhood_vectors,
+                                              scored_offsets, prefs, dims, weights), dtype=typecode)
+    scored_seconds = time.perf_counter() - started
+
+    if len(missed) == len(digests):
+        fits = scored
+    else:
+        pool = numpy.concatenate((numpy.frombuffer(entry.fits, dtype=typecode), scored))
+        rank = numpy.cumsum(~found) - 1
+        starts = numpy.where(found, numpy.asarray(entry.offsets)[where], len(entry.fits) + scored_offsets[rank])
+        fits = pool[_ranges(starts, lengths)]
+    result = _column(typecode, fits)
+
+    first = numpy.sort(numpy.unique(digests, return_index=True)[1])
+    if not len(missed) and len(first) == len(cached):
+        return result, 0, 0, scored_seconds, None
+    if len(first) == len(digests):
+        updated = Entry(_column('Q', digests), _column('q', offsets), result)
+    else:
+        profile_lengths = lengths[first]
+        updated = Entry(_column('Q', digests[first]),
+                        _column('q', numpy.concatenate(([0], numpy.cumsum(profile_lengths)))),
+                        _column(typecode, fits[_ranges(offsets[first], profile_lengths)]))
+    return result, len(missed), len(scored), scored_seconds, updated
+
+def _column(typecode: str, values) -> array:
+    """A NumPy array's values as an `array` of `typecode`."""
+    column = array(typecode)
+    column.frombytes(numpy.ascontiguousarray(values, dtype=typecode).tobytes())
+    return column
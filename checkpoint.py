@@ -0,0 +1,216 @@
+"""Checkpoints of a running match, so that a long run can resume where it left off.
+
+The whole state of `engine.array_optimal_match` between two proposals is a handful of flat columns: the
+pointer to each buyer's next preference, the queue of free buyers, the sequence counter and each
+neighborhood's heap of (fit, -sequence, buyer) entries. A `Checkpointer` given to the engine writes them to
+a file every so many proposals or seconds, whichever comes first, and a run resumed from that file carries
+on from exactly that point, so it finds exactly the matching an uninterrupted run would.
+
+A checkpoint file is:
+
+* a header: the magic bytes, a format version, the typecode of the fits, the sizes of the market and of
+  each column, the sequence counter and a CRC of the market's columns, so that a checkpoint is never
+  resumed against a different market;
+* the columns, back to back and little-endian: the capacities, the preference pointers, the free queue,
+  the length of each heap and then every heap entry's fit, sequence and buyer, and the displacement chain
+  of each buyer if they're being counted.
+
+Checkpoints are written to a temporary file alongside, flushed to disk and moved into place, so the file
+on disk is always a complete checkpoint; the one left by the last checkpoint of a finished run is removed.
+"""
+from array import array
+import os
+import struct
+import sys
+import time
+import zlib
+from typing import List, Optional, Sequence
+
+import exceptions
+from market import Market
+
+MAGIC = b'NBHDCKPT'
+VERSION = 2
+
+# magic, version, fit typecode, has chains, neighborhood count, buyer count, free count, heap entry count,
+# sequence, market CRC
+HEADER = struct.Struct('<8sIcc2xQQQQQI4x')
+
+# checkpoint every this many proposals, or this many seconds, by default
+PROPOSALS = 10_000_000
+SECONDS = 60.0
+
+class SolverState:
+    """The state of `engine.array_optimal_match` between two proposals.
+
+    Attributes
+    ----------
+    next_pref : array
+        For each buyer, the position in ``market.pref_indices`` of the next neighborhood they'll propose to.
+    free : Sequence[int]
+        The free buyers, in the order they'll propose.
+    heaps : List[list]
+        For each neighborhood, its heap of (fit, -sequence, buyer) entries.
+    sequence : int
+        The sequence number the next accepted proposal will get.
+    chains : Optional[array]
+        How many displacements led to each buyer being free, if they're being counted.
+    """
+
+    def __init__(self, next_pref: array, free: Sequence[int], heaps: List[list], sequence: int,
+                 chains: Optional[array] = None) -> None:
+        self.next_pref = next_pref
+        self.free = free
+        self.heaps = heaps
+        self.sequence = sequence
+        self.chains = chains
+
+def market_crc(market: Market, capacities: Sequence[int]) -> int:
+    """A CRC of the market's vectors, preferences and capacities."""
+    crc = 0
+    for column in (market.neighborhood_vectors, market.buyer_vectors, market.pref_offsets, market.pref_indices,
+                   array('q', capacities)):
+        crc = zlib.crc32(column, crc)
+    return crc
+
+def _write(output_file, column: array) -> None:
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    output_file.write(memoryview(column).cast('B'))
+
+def _read(input_file, typecode: str, count: int, file_name: str) -> array:
+    column = array(typecode)
+    try:
+        column.fromfile(input_file, count)
+    except EOFError:
+        raise exceptions.DataParsingError(file_name)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column
+
+def save_checkpoint(file_name: str, market: Market, capacities: Sequence[int], state: SolverState,
+                    crc: Optional[int] = None) -> None:
+    """Write `state` to `file_name`, atomically."""
+    if crc is None:
+        crc = market_crc(market, capacities)
+    typecode = market.schema.fit_typecode
+    lengths = array('q', [len(heap) for heap in state.heaps])
+    fits = array(typecode)
+    sequences = array('q')
+    buyers = array('i')
+    for heap in state.heaps:
+        fits.extend([entry[0] for entry in heap])
+        sequences.extend([entry[1] for entry in heap])
+        buyers.extend([entry[2] for entry in heap])
+
+    temporary = f"{file_name}.tmp"
+    with open(temporary, 'wb') as output_file:
+        output_file.write(HEADER.pack(MAGIC, VERSION, typecode.encode(), b'\1' if state.chains is not None else b'\0',
+                                      market.neighborhood_count, market.buyer_count, len(state.free), len(buyers),
+                                      state.sequence, crc))
+        for column in (array('q', capacities), state.next_pref, array('i', state.free), lengths, fits, sequences,
+                       buyers):
+            _write(output_file, column)
+        if state.chains is not None:
+            _write(output_file, state.chains)
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    os.replace(temporary, file_name)
+
+def load_checkpoint(file_name: str, market: Market, capacities: Sequence[int],
+                    crc: Optional[int] = None) -> SolverState:
+    """Read a checkpoint written by `save_checkpoint` for the same market and capacities."""
+    if crc is None:
+        crc = market_crc(market, capacities)
+    with open(file_name, 'rb') as input_file:
+        header = input_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise exceptions.DataParsingError(file_name)
+        (magic, version, typecode, has_chains, neighborhood_count, buyer_count, free_count, entry_count,
+         sequence, checkpoint_crc) = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise exceptions.DataParsingError(file_name)
+        if (typecode.decode() != market.schema.fit_typecode or neighborhood_count != market.neighborhood_count
+                or buyer_count != market.buyer_count or checkpoint_crc != crc):
+            raise ValueError(f"{file_name} is a checkpoint of a different market or capacities")
+        _read(input_file, 'q', neighborhood_count, file_name)
+        next_pref = _read(input_file, 'q', buyer_count, file_name)
+        free = _read(input_file, 'i', free_count, file_name)
+        lengths = _read(input_file, 'q', neighborhood_count, file_name)
+        fits = _read(input_file, typecode.decode(), entry_count, file_name)
+        sequences = _read(input_file, 'q', entry_count, file_name)
+        buyers = _read(input_file, 'i', entry_count, file_name)
+        chains = _read(input_file, 'i', buyer_count, file_name) if has_chains == b'\1' else None
+
+    heaps = []
+    start = 0
+    for length in lengths:
+        end = start + length
+        heaps.append(list(zip(fits[start:end], sequences[start:end], buyers[start:end])))
+        start = end
+    return SolverState(next_pref, free, heaps, sequence, chains)
+
+class Checkpointer:
+    """Decides when a running match is checkpointed, and writes and reads its checkpoints.
+
+    Parameters
+    ----------
+    file_name : str
+        Where the checkpoint is kept.
+    proposals : int
+        Checkpoint after at least this many proposals since the last checkpoint.
+    seconds : float
+        Checkpoint after at least this many seconds since the last checkpoint, or since the start.
+    resume : bool
+        Whether the engine should resume from the checkpoint in `file_name`, if there is one.
+
+    Attributes
+    ----------
+    saves : int
+        The number of checkpoints written.
+    seconds_saving : float
+        The time spent writing them.
+    """
+
+    def __init__(self, file_name: str, proposals: int = PROPOSALS, seconds: float = SECONDS,
+                 resume: bool = False) -> None:
+        self.file_name = file_name
+        self.proposals = proposals
+        self.seconds = seconds
+        self.resume = resume
+        self.saves = 0
+        self.seconds_saving = 0.0
+        self._pending = 0
+        self._last = time.monotonic()
+        self._crc: Optional[int] = None
+
+    def due(self, proposals: int) -> bool:
+        """Count `proposals` more, and say whether it's time for a checkpoint."""
+        self._pending += proposals
+        return self._pending >= self.proposals or time.monotonic() - self._last >= self.seconds
+
+    def _market_crc(self, market: Market, capacities: Sequence[int]) -> int:
+        if self._crc is None:
+            self._crc = market_crc(market, capacities)
+        return self._crc
+
+    def save(self, market: Market, capacities: Sequence[int], state: SolverState) -> None:
+        start = time.monotonic()
+        save_checkpoint(self.file_name, market, capacities, state, self._market_crc(market, capacities))
+        self._last = time.monotonic()
+        self._pending = 0
+        self.saves += 1
+        self.seconds_saving += self._last - start
+
+    def load(self, market: Market, capacities: Sequence[int]) -> Optional[SolverState]:
+        """The state to resume from: None if there's no checkpoint, or if we weren't asked to resume."""
+        if not self.resume or not os.path.exists(self.file_name):
+            return None
+        self._last = time.monotonic()
+        return load_checkpoint(self.file_name, market, capacities, self._market_crc(market, capacities))
+
+    def finish(self) -> None:
+        """Remove the checkpoint of a finished run."""
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
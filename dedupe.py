@@ -0,0 +1,219 @@
+"""Matching equivalent buyers as blocks.
+
+Real inputs often hold many buyers with the same goals and the same preferences. Such buyers are
+interchangeable as far as fits go: every fit one of them has, the others have too. Rather than score and
+propose for each of them separately, we intern them into weighted classes first:
+
+* fits are computed once per class, on a `Market` holding one buyer per class;
+* in matching, members of a class who are next to each other in the queue of free buyers, and who would
+  propose to the same neighborhood next, propose together as a block. A neighborhood takes as many of a
+  block as it has room for, or as it can make room for by displacing worse fits, and the rest of the block
+  moves on together, so a block is only ever split at a capacity boundary;
+* the blocks are then expanded back into individual buyers.
+
+Only neighbors in the queue are merged, because a block must do exactly what its members would have done
+one after another: proposal order decides who wins ties, so moving a buyer ahead of someone else in the
+queue could change the result. The split of a block is decided by that same order – the members who reach a
+neighborhood first are taken first, and the most recent arrival is displaced first – so the result is the
+one `engine.array_optimal_match` finds, down to which member of a class goes where. Equivalent buyers have
+the same fit to every neighborhood, so the proposal order, which sorts buyers by fit, brings them together
+whatever order the input lists them in. When most classes hold a single buyer, though, bookkeeping for
+blocks would only slow things down, so when the first blocks average fewer than `MIN_BLOCK` buyers the
+per-class fits are handed to `engine.array_optimal_match` instead.
+"""
+from array import array
+from collections import deque
+import heapq
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import engine
+from engine import ArrayMatching
+from fits import preference_fits
+from market import Market
+from stats import MatchStats, timed
+
+# the average size the first blocks must reach for matching by blocks to be worth its bookkeeping
+MIN_BLOCK = 2
+
+class BuyerClasses:
+    """The buyers of a market, interned by their goals and preferences.
+
+    Parameters
+    ----------
+    market : Market
+        The market the classes were found in.
+    class_market : Market
+        A market with one buyer per class, named for the class's first member.
+    members : List[array]
+        For each class, the indices of its buyers in `market`, in input order.
+    """
+
+    def __init__(self, market: Market, class_market: Market, members: List[array]) -> None:
+        self.market = market
+        self.class_market = class_market
+        self.members = members
+
+    def __len__(self):
+        return len(self.members)
+
+    def sizes(self) -> array:
+        return array('q', [len(members) for members in self.members])
+
+    def buyer_class(self) -> array:
+        """The class of every buyer in the market."""
+        classes = array('i', [0]) * self.market.buyer_count
+        for c, members in enumerate(self.members):
+            for buyer in members:
+                classes[buyer] = c
+        return classes
+
+def buyer_classes(market: Market) -> BuyerClasses:
+    """Intern the buyers of `market` that have the same goals and the same preferences."""
+    dims = market.dims
+    offsets = market.pref_offsets
+    pref_indices = market.pref_indices
+    index: Dict[Tuple[bytes, bytes], int] = {}
+    members: List[array] = []
+    representatives = array('i')
+    for buyer in range(market.buyer_count):
+        key = (market.buyer_vectors[buyer * dims:(buyer + 1) * dims].tobytes(),
+               pref_indices[offsets[buyer]:offsets[buyer + 1]].tobytes())
+        c = index.get(key)
+        if c is None:
+            c = index[key] = len(members)
+            members.append(array('i'))
+            representatives.append(buyer)
+        members[c].append(buyer)
+
+    buyer_vectors = array(market.schema.typecode)
+    pref_offsets = array('q', [0])
+    class_indices = array('i')
+    for buyer in representatives:
+        buyer_vectors.extend(market.buyer_vector(buyer))
+        class_indices.extend(market.buyer_prefs(buyer))
+        pref_offsets.append(len(class_indices))
+    class_market = Market(market.neighborhood_names, market.neighborhood_vectors,
+                          [market.buyer_names[b] for b in representatives], buyer_vectors,
+                          pref_offsets, class_indices, market.schema, market.neighborhood_capacities)
+    return BuyerClasses(market, class_market, members)
+
+def block_optimal_match(market: Market, capacities: Optional[Sequence[int]] = None,
+                        classes: Optional[BuyerClasses] = None,
+                        stats: Optional[MatchStats] = None) -> ArrayMatching:
+    """Solve the market as `engine.array_optimal_match` does, proposing for each class of buyers as a block.
+
+    Parameters
+    ----------
+    market : Market
+        The market to solve.
+    capacities : Optional[Sequence[int]]
+        Capacity per neighborhood. Defaults to the market's own, as `buyer_optimal_match` works them out.
+    classes : Optional[BuyerClasses]
+        The market's buyer classes, if already found.
+    stats : Optional[MatchStats]
+        Collects counts and timings, if given. Proposals, rejections and displacements are counted per
+        buyer, not per block, so they compare with the other engines' counts.
+
+    The result is for the individual buyers of `market`, as if they had been matched one by one.
+    """
+    if capacities is None:
+        capacities = market.capacities()
+    with timed(stats, 'dedupe'):
+        if classes is None:
+            classes = buyer_classes(market)
+    class_market = classes.class_market
+    with timed(stats, 'setup'):
+        fits = preference_fits(class_market)
+    pref_indices = class_market.pref_indices
+    offsets = class_market.pref_offsets
+
+    # heap entries are (fit, -sequence, class, members, next preference): a block of members of a class,
+    # who were given the sequence numbers from `sequence` up in order, and who would propose to the
+    # preference at `next preference` if displaced. The top of each heap is the block holding the lowest
+    # fit and, among equal fits, the most recent arrival; its last member arrived latest of all.
+    heaps: List[list] = [[] for _ in range(market.neighborhood_count)]
+    held = array('q', [0]) * market.neighborhood_count
+    # free blocks of (class, next preference, members, displacement chain), in proposal order
+    free: deque = deque()
+    buyer_class = classes.buyer_class()
+    for buyer in engine.proposal_order(market):
+        c = buyer_class[buyer]
+        _push(free, c, offsets[c], [buyer], 0)
+    if len(free) * MIN_BLOCK > market.buyer_count:
+        with timed(stats, 'setup'):
+            buyer_fits = array(fits.typecode)
+            for c in buyer_class:
+                buyer_fits.extend(fits[offsets[c]:offsets[c + 1]])
+        return engine.array_optimal_match(market, capacities, fits=buyer_fits, stats=stats)
+    sequence = 0
+    proposals = rejections = displacements = longest_chain = 0
+
+    with timed(stats, 'match'):
+        while free:
+            c, k, members, chain = free.popleft()
+            end = offsets[c + 1]
+            while k < end:
+                neighborhood = pref_indices[k]
+                fit = fits[k]
+                k += 1
+                count = len(members)
+                proposals += count
+                heap = heaps[neighborhood]
+                taken = min(capacities[neighborhood] - held[neighborhood], count)
+                # displace the latest arrivals among the lowest fits, as long as they fit worse
+                while taken < count and heap and fit > heap[0][0]:
+                    worst_fit, worst_sequence, worst_class, worst_members, worst_k = heap[0]
+                    displaced = min(len(worst_members), count - taken)
+                    if displaced == len(worst_members):
+                        heapq.heappop(heap)
+                    else:
+                        heap[0] = (worst_fit, worst_sequence, worst_class, worst_members[:-displaced], worst_k)
+                    held[neighborhood] -= displaced
+                    taken += displaced
+                    displacements += displaced
+                    # one at a time, the latest arrival goes first
+                    _push(free, worst_class, worst_k, worst_members[:-displaced - 1:-1], chain + 1)
+                    longest_chain = max(longest_chain, chain + 1)
+                if taken > 0:
+                    heapq.heappush(heap, (fit, -sequence, c, members[:taken], k))
+                    sequence += taken
+                    held[neighborhood] += taken
+                    if taken == count:
+                        break
+                    members = members[taken:]
+                rejections += count - taken
+
+    if stats is not None:
+        stats.proposals += proposals
+        stats.rejections += rejections
+        stats.displacements += displacements
+        stats.longest_chain = max(stats.longest_chain, longest_chain)
+
+    typecode = market.schema.fit_typecode
+    members = []
+    member_fits = []
+    for heap in heaps:
+        heap.sort(key=lambda entry: (-entry[0], -entry[1]))
+        neighborhood_members = array('i')
+        neighborhood_fits = array(typecode)
+        for fit, _, _, block, _ in heap:
+            neighborhood_members.extend(block)
+            neighborhood_fits.extend([fit] * len(block))
+        members.append(neighborhood_members)
+        member_fits.append(neighborhood_fits)
+    return ArrayMatching(market, array('q', capacities), members, member_fits)
+
+def _push(free: deque, c: int, k: int, members: List[int], chain: int) -> None:
+    """Queue free members of a class, merging them into the last block if they'd propose alongside it."""
+    if free:
+        last_class, last_k, last_members, last_chain = free[-1]
+        if last_class == c and last_k == k:
+            last_members.extend(members)
+            if chain > last_chain:
+                free[-1] = (c, k, last_members, chain)
+            return
+    free.append((c, k, members, chain))
+
+def match_players(buyers: List, neighborhoods: List, stats: Optional[MatchStats] = None) -> Dict:
+    """`engine.match_players`, matching equivalent buyers as blocks."""
+    return engine.match_players(buyers, neighborhoods, stats=stats, solver=block_optimal_match)
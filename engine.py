@@ -0,0 +1,464 @@
+"""An array-backed engine for the buyer-optimal match.
+
+This solves the same game as `match.buyer_optimal_match`, and produces the same result, but works on
+the integer-indexed columns of a `Market` rather than on `Homebuyer` and `Neighborhood` objects:
+
+* each buyer keeps a pointer to the next neighborhood it will propose to, so no neighborhood is ever
+  proposed to twice by the same buyer;
+* each neighborhood holds its matches in a min-heap bounded by its capacity and keyed on fit, so the
+  worst match is always at the top;
+* once a neighborhood is full, it publishes the fit at the top of its heap as its threshold. A full
+  neighborhood stays full, and only ever swaps its worst match for a better one, so the threshold only
+  rises: a buyer whose fit doesn't beat it is turned down without touching the heap, and one whose fit
+  does is sure to be taken.
+
+The total work is O(proposals * log(capacity)). Where room is scarce, most proposals are to neighborhoods
+that are already full, so with NumPy installed a buyer who has been turned down `SCAN_AFTER` times in a row
+and still has more than `SCAN_MIN` preferences to go compares them all with the thresholds in one
+vectorized scan, and goes straight to the first neighborhood that will take them.
+
+Given a `deadline`, the solver stops proposing when it runs out, and places the buyers who are still free
+with `greedy_fill` instead. Every buyer held by then is held stably: each neighborhood that turned them
+down was full, and stays full, of better fits. So only the buyers placed greedily can be in a blocking pair,
+and counting those pairs, to say how far the result is from stable, only looks at their preferences. The
+time those two steps are expected to take is kept back from the proposals, and both give up rather than
+run past the deadline: `greedy_fill` leaves whoever it hasn't placed yet unmatched, and the blocking pairs
+go uncounted.
+"""
+from array import array
+from collections import deque
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from checkpoint import Checkpointer, SolverState
+from fits import legacy_order, numpy, preference_fits
+from market import Market
+from stats import MatchStats, timed
+
+# rejections in a row, one proposal at a time, before a buyer's remaining preferences are scanned at once;
+# a scan costs about as much as a few hundred proposals, so only this many remaining preferences are scanned
+SCAN_AFTER = 8
+SCAN_MIN = 256
+# work between looks at the clock, when there's a deadline, counting one for each buyer taken off the queue
+# and one for each proposal they make; and roughly how many seconds it takes to build the result, per buyer,
+# and to place the buyers still free greedily and count their blocking pairs, per free buyer and per
+# preference of theirs, which a deadline keeps back. Counting the blocking pairs takes about
+# BLOCKING_PAIR_SECONDS per preference it looks at, and is skipped if there isn't time for it.
+CHECK_EVERY = 256
+RESULT_SECONDS = 0.75e-6
+if numpy is not None:
+    FALLBACK_SECONDS = 1e-6
+    FALLBACK_PREFERENCE_SECONDS = 1.5e-8
+    BLOCKING_PAIR_SECONDS = 2e-8
+else:
+    FALLBACK_SECONDS = 1e-6
+    FALLBACK_PREFERENCE_SECONDS = 5e-8
+    BLOCKING_PAIR_SECONDS = 1e-7
+
+class ArrayMatching:
+    """The result of `array_optimal_match`.
+
+    Parameters
+    ----------
+    market : Market
+        The market that was solved.
+    capacities : array
+        The capacity each neighborhood was solved with.
+    members : List[array]
+        For each neighborhood, the indices of its matched buyers, best fit first.
+    member_fits : List[array]
+        The fits of ``members``, in the same order.
+
+    Attributes
+    ----------
+    timed_out : bool
+        Whether the solver ran out of time, and placed the buyers still free then with `greedy_fill`.
+    greedy_placed : int
+        How many buyers it placed that way.
+    blocking_pairs : Optional[int]
+        How many blocking pairs that left: 0 unless it timed out, and None if there wasn't time to count them.
+    """
+
+    def __init__(self, market: Market, capacities: array, members: List[array], member_fits: List[array]) -> None:
+        self.market = market
+        self.capacities = capacities
+        self.members = members
+        self.member_fits = member_fits
+        self.timed_out = False
+        self.greedy_placed = 0
+        self.blocking_pairs = 0
+
+        self.buyer_match = array('i', [-1]) * market.buyer_count
+        for neighborhood, buyers in enumerate(members):
+            for buyer in buyers:
+                self.buyer_match[buyer] = neighborhood
+
+    def unmatched(self) -> List[int]:
+        """The indices of buyers that could not be placed."""
+        return [b for b, n in enumerate(self.buyer_match) if n < 0]
+
+    def to_dict(self, buyers: List, neighborhoods: List) -> 'Matches':
+        """Translate back into the ``{Neighborhood: [Homebuyer]}`` shape `buyer_optimal_match` returns.
+
+        `buyers` and `neighborhoods` must be in the same order the market was built from.
+        """
+        matches = Matches({n: [buyers[b] for b in self.members[i]] for i, n in enumerate(neighborhoods)})
+        matches.timed_out = self.timed_out
+        matches.blocking_pairs = self.blocking_pairs
+        return matches
+
+class Matches(dict):
+    """A ``{Neighborhood: [Homebuyer]}`` matching, as `match.buyer_optimal_match` returns it.
+
+    Attributes
+    ----------
+    timed_out : bool
+        Whether the match ran out of time, and placed the buyers still free then greedily.
+    blocking_pairs : Optional[int]
+        How many blocking pairs that left: 0 unless it timed out, and None if there wasn't time to count them.
+    """
+
+    timed_out = False
+    blocking_pairs = 0
+
+def proposal_order(market: Market) -> List[int]:
+    """The order in which `array_optimal_match` first lets the market's buyers propose, as `fits.legacy_order`
+    describes it: the order `buyer_optimal_match` has always used."""
+    return legacy_order(market.buyer_vectors, market.neighborhood_vectors, market.dims, market.schema.weights)
+
+def fit_stage(market: Market) -> Tuple[array, List[int]]:
+    """Everything `array_optimal_match` computes before the first proposal.
+
+    Returns the fit of every preference, parallel to ``market.pref_indices``, and the proposal order.
+    """
+    return preference_fits(market), proposal_order(market)
+
+def _thresholds(heaps: List[list], capacities: Sequence[int]) -> List:
+    """The fit a buyer must beat to be taken by each neighborhood: the worst it holds, once it's full."""
+    thresholds = []
+    for heap, capacity in zip(heaps, capacities):
+        if len(heap) < capacity:
+            thresholds.append(float('-inf'))
+        else:
+            thresholds.append(heap[0][0] if heap else float('inf'))
+    return thresholds
+
+def greedy_fill(buyers: Sequence[int], starts: Sequence[int], ends: Sequence[int], pref_indices: Sequence[int],
+                fits: Sequence, room: List[int], stop_at: Optional[float] = None) -> List[Tuple[int, int]]:
+    """Place `buyers` quickly, if not stably, in the room that's left.
+
+    Buyer ``buyers[i]`` ranks the neighborhoods at positions ``starts[i]`` up to ``ends[i]`` of `pref_indices`,
+    whose fits are `fits`. In each round, every buyer still waiting proposes to the best of those with room
+    left, and each neighborhood takes the best fits among its proposers, as many as it has room for; among
+    equal fits, whoever comes first in `buyers`. Nobody is displaced, so it takes at most one round per
+    preference, and it stops early once there's no room left anywhere. `room`, the places left in each
+    neighborhood, is updated in place. Given `stop_at`, a `time.perf_counter` reading, it also stops when it
+    finds the clock has passed it, even part way through a round, and whoever is still waiting then isn't
+    placed.
+
+    Returns (buyer, position) for every buyer placed, in the order they were placed.
+    """
+    if numpy is not None:
+        return _greedy_vectorized(buyers, starts, ends, pref_indices, fits, room, stop_at)
+    pointers = list(starts)
+    waiting = list(range(len(buyers)))
+    placed = []
+    while waiting and any(places > 0 for places in room):
+        proposals: Dict[int, list] = {}
+        for count, i in enumerate(waiting):
+            if stop_at is not None and not count % CHECK_EVERY and time.perf_counter() > stop_at:
+                return placed
+            k = pointers[i]
+            while k < ends[i] and room[pref_indices[k]] <= 0:
+                k += 1
+            pointers[i] = k
+            if k < ends[i]:
+                proposals.setdefault(pref_indices[k], []).append((-fits[k], i))
+        taken = set()
+        for n, proposers in proposals.items():
+            proposers.sort()
+            taken.update(i for _, i in proposers[:room[n]])
+            room[n] -= min(room[n], len(proposers))
+        still_waiting = []
+        for i in waiting:
+            if i in taken:
+                placed.append((buyers[i], pointers[i]))
+            elif pointers[i] < ends[i]:
+                pointers[i] += 1
+                still_waiting.append(i)
+        waiting = still_waiting
+    return placed
+
+def _greedy_vectorized(buyers: Sequence[int], starts: Sequence[int], ends: Sequence[int],
+                       pref_indices: Sequence[int], fits: Sequence, room: List[int],
+                       stop_at: Optional[float] = None) -> List[Tuple[int, int]]:
+    """`greedy_fill`, a round at a time with NumPy."""
+    buyers = numpy.asarray(buyers, dtype=numpy.int64)
+    pointers = numpy.array(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    # the column's own integer type indexes just as well, and converting all of it would cost more than the
+    # rounds themselves
+    pref_indices = numpy.asarray(pref_indices)
+    fits = numpy.asarray(fits)
+    places = numpy.array(room, dtype=numpy.int64)
+    waiting = numpy.arange(len(buyers))
+    placed_buyers = []
+    placed_positions = []
+    out_of_time = False
+    while len(waiting) and (places > 0).any():
+        if stop_at is not None and time.perf_counter() > stop_at:
+            break
+        k = pointers[waiting]
+        end = ends[waiting]
+        # skip the neighborhoods that have filled up
+        blocked = numpy.flatnonzero(k < end)
+        while len(blocked):
+            if stop_at is not None and time.perf_counter() > stop_at:
+                out_of_time = True
+                break
+            blocked = blocked[places[pref_indices[k[blocked]]] <= 0]
+            k[blocked] += 1
+            blocked = blocked[k[blocked] < end[blocked]]
+        if out_of_time:
+            break
+        live = k < end
+        waiting = waiting[live]
+        k = k[live]
+        pointers[waiting] = k
+        neighborhoods = pref_indices[k]
+        taken = numpy.ones(len(waiting), dtype=bool)
+        # only neighborhoods with more proposers than places have to choose between them
+        crowded = numpy.flatnonzero(numpy.bincount(neighborhoods, minlength=len(places))[neighborhoods]
+                                    > places[neighborhoods])
+        if len(crowded):
+            # by neighborhood, then best fit first; both sorts are stable, so equal fits keep the buyers' order
+            by_fit = crowded[numpy.argsort(-fits[k[crowded]], kind='stable')]
+            order = by_fit[numpy.argsort(neighborhoods[by_fit], kind='stable')]
+            grouped = neighborhoods[order]
+            rank = numpy.arange(len(order)) - numpy.searchsorted(grouped, grouped)
+            taken[order] = rank < places[grouped]
+        numpy.subtract.at(places, neighborhoods[taken], 1)
+        placed_buyers.append(waiting[taken])
+        placed_positions.append(k[taken])
+        pointers[waiting[~taken]] += 1
+        waiting = waiting[~taken]
+    room[:] = places.tolist()
+    if not placed_buyers:
+        return []
+    return list(zip(buyers[numpy.concatenate(placed_buyers)].tolist(), numpy.concatenate(placed_positions).tolist()))
+
+def count_blocking_pairs(starts: Sequence[int], stops: Sequence[int], pref_indices: Sequence[int], fits: Sequence,
+                         thresholds: Sequence) -> int:
+    """How many of the preferences at positions ``starts[i]`` up to ``stops[i]`` beat their neighborhood's threshold.
+
+    With `starts` and `stops` running from where a buyer began to the neighborhood they ended up in, that's
+    how many blocking pairs they're in.
+    """
+    if numpy is not None:
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        lengths = numpy.asarray(stops, dtype=numpy.int64) - starts
+        if not lengths.sum():
+            return 0
+        # every position in every range, one range after another
+        positions = numpy.arange(lengths.sum()) + numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        neighborhoods = numpy.asarray(pref_indices)[positions]
+        return int((numpy.asarray(fits)[positions] > numpy.array(thresholds, dtype=numpy.float64)[neighborhoods]).sum())
+    return sum(1 for start, stop in zip(starts, stops) for k in range(start, stop)
+               if fits[k] > thresholds[pref_indices[k]])
+
+def array_optimal_match(market: Market, capacities: Optional[Sequence[int]] = None,
+                        order: Optional[Sequence[int]] = None, fits: Optional[Sequence] = None,
+                        stats: Optional[MatchStats] = None,
+                        checkpoint: Optional[Checkpointer] = None, scan: bool = True,
+                        deadline: Optional[float] = None) -> ArrayMatching:
+    """Solve the market with buyer-proposing deferred acceptance.
+
+    Parameters
+    ----------
+    market : Market
+        The market to solve.
+    capacities : Optional[Sequence[int]]
+        Capacity per neighborhood. Defaults to the market's own, as `buyer_optimal_match` works them out.
+    order : Optional[Sequence[int]]
+        The order in which buyers first propose. Defaults to the order `buyer_optimal_match` uses.
+    fits : Optional[Sequence]
+        The fit of every preference, parallel to ``market.pref_indices``, if already known.
+    stats : Optional[MatchStats]
+        Collects counts and timings, if given. Apart from the displacement chains, every count is
+        worked out from the final state, so the proposal loop does no extra work for them.
+    checkpoint : Optional[Checkpointer]
+        Checkpoints the solver's state as it goes, if given, and resumes from its last checkpoint if
+        asked to. The checkpoint is removed once the match is finished.
+    scan : bool
+        Whether buyers who keep being turned down skip ahead with a vectorized scan of the neighborhoods'
+        thresholds. It only changes how fast the result is found, and needs NumPy.
+    deadline : Optional[float]
+        Seconds the match may take. If proposals are still being made when they run out – less a rough
+        estimate of the time it takes to finish up, from `RESULT_SECONDS` and the `FALLBACK_SECONDS` – the
+        buyers still free are placed with `greedy_fill`, and the result says how many blocking pairs that
+        left. The fits are computed before the clock is first looked at, so a deadline they use up leaves
+        no time for proposals; pass them in as `fits` to keep them out of it. With a `checkpoint`, the
+        exact match is checkpointed first, so that resuming finishes it.
+
+    Buyers who exhaust their preferences without being accepted are left unmatched rather than
+    proposing forever.
+    """
+    stop_at = None if deadline is None else time.perf_counter() + deadline - RESULT_SECONDS * market.buyer_count
+    if capacities is None:
+        capacities = market.capacities()
+    with timed(stats, 'setup'):
+        if fits is None:
+            fits = preference_fits(market)
+        if order is None:
+            order = proposal_order(market)
+    pref_indices = market.pref_indices
+    offsets = market.pref_offsets
+    next_pref = array('q', offsets[:-1])
+    # how many displacements led to each buyer being free, when we're asked to find the longest chain
+    chains = array('i', [0]) * market.buyer_count if stats is not None else None
+
+    # heap entries are (fit, -sequence, buyer): the top of each heap is the lowest fit and, among equal
+    # fits, the most recent arrival – exactly the buyer `Neighborhood.get_worst_match` would pick.
+    heaps: List[list] = [[] for _ in range(market.neighborhood_count)]
+    free = deque(order)
+    sequence = 0
+
+    state = checkpoint.load(market, capacities) if checkpoint is not None else None
+    if state is not None:
+        next_pref, heaps, free, sequence = state.next_pref, state.heaps, deque(state.free), state.sequence
+        if chains is not None and state.chains is not None:
+            chains = state.chains
+
+    thresholds = _thresholds(heaps, capacities)
+    # scan only if some buyer ranks enough neighborhoods for it to be worthwhile; the columns it compares
+    # are built when it's first needed
+    scanning = scan and numpy is not None and market.buyer_count and numpy.diff(offsets).max() > SCAN_AFTER + SCAN_MIN
+    vector_thresholds = None
+    scanned = 0
+    # how much more work before the next look at the clock: the first look is before the first proposal, in
+    # case setting up used up the time
+    countdown = 0
+    timed_out = False
+    fallback_seconds = FALLBACK_SECONDS + FALLBACK_PREFERENCE_SECONDS * len(pref_indices) / max(market.buyer_count, 1)
+
+    with timed(stats, 'match'):
+        while free:
+            if stop_at is not None and countdown <= 0:
+                countdown = CHECK_EVERY
+                if time.perf_counter() + fallback_seconds * len(free) >= stop_at:
+                    timed_out = True
+                    break
+            buyer = free.popleft()
+            k = next_pref[buyer]
+            end = offsets[buyer + 1]
+            # where to stop proposing one at a time and scan the rest, if there are enough left to be worth it
+            scan_from = k + SCAN_AFTER if scanning and end - k > SCAN_AFTER + SCAN_MIN else -1
+            while k < end:
+                neighborhood = pref_indices[k]
+                fit = fits[k]
+                k += 1
+                if fit <= thresholds[neighborhood]:
+                    if k == scan_from:
+                        if vector_thresholds is None:
+                            vector_fits = numpy.asarray(fits)
+                            vector_prefs = numpy.asarray(pref_indices, dtype=numpy.intp)
+                            vector_thresholds = numpy.array(thresholds, dtype=numpy.float64)
+                        # the first of the rest that beats its neighborhood's threshold is sure to be taken
+                        acceptable = vector_fits[k:end] > vector_thresholds[vector_prefs[k:end]]
+                        first = int(acceptable.argmax())
+                        skip_to = k + first if acceptable[first] else end
+                        scanned += skip_to - k
+                        k = skip_to
+                    continue
+                heap = heaps[neighborhood]
+                if len(heap) < capacities[neighborhood]:
+                    heapq.heappush(heap, (fit, -sequence, buyer))
+                    sequence += 1
+                    if len(heap) == capacities[neighborhood]:
+                        thresholds[neighborhood] = heap[0][0]
+                        if vector_thresholds is not None:
+                            vector_thresholds[neighborhood] = heap[0][0]
+                    break
+                worst = heapq.heapreplace(heap, (fit, -sequence, buyer))
+                sequence += 1
+                thresholds[neighborhood] = heap[0][0]
+                if vector_thresholds is not None:
+                    vector_thresholds[neighborhood] = heap[0][0]
+                free.append(worst[2])
+                if chains is not None:
+                    chains[worst[2]] = chains[buyer] + 1
+                break
+            countdown -= 1 + k - next_pref[buyer]
+            if checkpoint is not None and checkpoint.due(k - next_pref[buyer]):
+                next_pref[buyer] = k
+                checkpoint.save(market, capacities, SolverState(next_pref, free, heaps, sequence, chains))
+            next_pref[buyer] = k
+    if checkpoint is not None:
+        if timed_out:
+            checkpoint.save(market, capacities, SolverState(next_pref, free, heaps, sequence, chains))
+        else:
+            checkpoint.finish()
+
+    if stats is not None:
+        # every proposal advanced a pointer, and every accepted one took a sequence number
+        matched = sum(len(heap) for heap in heaps)
+        proposals = sum(next_pref[b] - offsets[b] for b in range(market.buyer_count))
+        stats.proposals += proposals
+        stats.rejections += proposals - sequence
+        stats.displacements += sequence - matched
+        stats.scanned += scanned
+        stats.longest_chain = max(stats.longest_chain, max(chains, default=0))
+
+    greedy_placed = blocking_pairs = 0
+    if timed_out:
+        with timed(stats, 'greedy'):
+            pending = list(free)
+            starts = [next_pref[b] for b in pending]
+            ends = [offsets[b + 1] for b in pending]
+            room = [capacity - len(heap) for capacity, heap in zip(capacities, heaps)]
+            placed_at = {}
+            for buyer, k in greedy_fill(pending, starts, ends, pref_indices, fits, room, stop_at):
+                heapq.heappush(heaps[pref_indices[k]], (fits[k], -sequence, buyer))
+                sequence += 1
+                placed_at[buyer] = k
+            greedy_placed = len(placed_at)
+            stops = [placed_at.get(buyer, end) for buyer, end in zip(pending, ends)]
+            if time.perf_counter() + BLOCKING_PAIR_SECONDS * (sum(stops) - sum(starts)) <= stop_at:
+                blocking_pairs = count_blocking_pairs(starts, stops, pref_indices, fits,
+                                                      _thresholds(heaps, capacities))
+            else:
+                blocking_pairs = None
+
+    members = []
+    member_fits = []
+    typecode = market.schema.fit_typecode
+    for heap in heaps:
+        heap.sort(key=lambda entry: (-entry[0], -entry[1]))
+        members.append(array('i', [entry[2] for entry in heap]))
+        member_fits.append(array(typecode, [entry[0] for entry in heap]))
+    result = ArrayMatching(market, array('q', capacities), members, member_fits)
+    result.timed_out = timed_out
+    result.greedy_placed = greedy_placed
+    result.blocking_pairs = blocking_pairs
+    return result
+
+def match_players(buyers: List, neighborhoods: List,
+                  solver: Callable[..., ArrayMatching] = array_optimal_match,
+                  stats: Optional[MatchStats] = None) -> Matches:
+    """Solve a game of `Homebuyer` and `Neighborhood` objects with the array engine.
+
+    The players' ``matching`` and ``capacity`` attributes are updated as `buyer_optimal_match` would
+    update them, and the same ``{Neighborhood: [Homebuyer]}`` dictionary is returned.
+    """
+    market = Market.from_players(buyers, neighborhoods)
+    result = solver(market, stats=stats)
+    matches = result.to_dict(buyers, neighborhoods)
+    for buyer in buyers:
+        buyer.matching = None
+    for i, (neighborhood, matched) in enumerate(matches.items()):
+        neighborhood.capacity = result.capacities[i]
+        neighborhood.matching = matched
+        for buyer in matched:
+            buyer.matching = neighborhood
+    return matches
@@ -5,4 +5,8 @@ class MatchingError(Exception):
 class DataParsingError(MatchingError):
     def __init__(self, failed: str, *args: object) -> None:
         super().__init__(*args)
-        self.failed = failed
\ No newline at end of file
+        self.failed = failed
+
+class ServerError(MatchingError):
+    """A request to the matching server failed; the message is the server's."""
+    pass
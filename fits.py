@@ -0,0 +1,233 @@
+"""Batched computation of buyer/neighborhood fits.
+
+Rather than asking each (buyer, neighborhood) pair for its fit one `PearlVector.__matmul__` at a time, we
+stack every buyer's goals and every neighborhood's characteristics into flat columns, and compute the fit of
+each buyer to each neighborhood they list, in one batch. Pairs no buyer lists are never scored, so the work
+grows with the number of preferences rather than with buyers × neighborhoods.
+
+NumPy does that a dimension at a time over whole columns of preferences when it is installed. It isn't
+required, though: without it the fits are computed buyer by buyer from the stacked `array` columns, which
+still avoids the per-pair method calls.
+
+A schema's weights are folded into the neighborhoods' side once, up front: the weighted fit
+``sum(w * b * n)`` is just the plain dot product of ``b`` with ``w * n``. Fits are integers for integer
+vectors without weights, as the E/W/R schema has, and floats otherwise.
+"""
+from array import array
+import itertools
+import operator
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# preferences `gather_fits` scores at a time with NumPy
+GATHER_CHUNK = 1 << 16
+
+def stack(vectors: Sequence) -> array:
+    """Stack a sequence of vectors into one flat, row-major array of their schema's type."""
+    stacked = array(vectors[0].schema.typecode if len(vectors) else 'q')
+    for vector in vectors:
+        stacked.extend(vector._to_list())
+    return stacked
+
+def _floating(column: Sequence) -> bool:
+    """Whether a column (an `array` or a `memoryview`) holds floats."""
+    return getattr(column, 'typecode', getattr(column, 'format', 'q')) in ('d', 'f')
+
+def _to_array(typecode: str, values) -> array:
+    """A NumPy vector as an `array` of `typecode`, copied as bytes rather than one Python number at a time."""
+    result = array(typecode)
+    result.frombytes(numpy.ascontiguousarray(values, dtype=numpy.float64 if typecode == 'd' else numpy.int64).tobytes())
+    return result
+
+def _weighted(neighborhood_vectors: Sequence, dims: int, weights: Optional[Sequence[float]]) -> Sequence:
+    if weights is None:
+        return neighborhood_vectors
+    return array('d', [value * weights[i % dims] for i, value in enumerate(neighborhood_vectors)])
+
+def _fit_typecode(buyer_vectors: Sequence, neighborhood_vectors: Sequence) -> str:
+    return 'd' if _floating(buyer_vectors) or _floating(neighborhood_vectors) else 'q'
+
+def gather_fits(buyer_vectors: Sequence, neighborhood_vectors: Sequence, offsets: Sequence[int],
+                indices: Sequence[int], dims: int = 3, weights: Optional[Sequence[float]] = None) -> array:
+    """The fit of each buyer to each neighborhood in its slice of a CSR preference list.
+
+    Only the listed pairs are ever computed. With NumPy, the fits are summed a
+    dimension at a time over `GATHER_CHUNK` preferences at a time, which keeps the temporaries small
+    instead of gathering a whole row of goals and of characteristics for every preference.
+    """
+    neighborhood_vectors = _weighted(neighborhood_vectors, dims, weights)
+    typecode = _fit_typecode(buyer_vectors, neighborhood_vectors)
+    if numpy is not None:
+        dtype = numpy.float64 if typecode == 'd' else numpy.int64
+        goals = numpy.asarray(buyer_vectors, dtype=dtype).reshape(-1, dims).T.copy()
+        characteristics = numpy.asarray(neighborhood_vectors, dtype=dtype).reshape(-1, dims).T.copy()
+        buyers = numpy.repeat(numpy.arange(goals.shape[1]), numpy.diff(numpy.asarray(offsets)))
+        indices = numpy.asarray(indices)
+        fits = numpy.zeros(len(indices), dtype=dtype)
+        for start in range(0, len(indices), GATHER_CHUNK):
+            chunk = fits[start:start + GATHER_CHUNK]
+            chunk_buyers = buyers[start:start + GATHER_CHUNK]
+            chunk_indices = indices[start:start + GATHER_CHUNK]
+            for d in range(dims):
+                chunk += goals[d][chunk_buyers] * characteristics[d][chunk_indices]
+        return _to_array(typecode, fits)
+    neighborhoods = [neighborhood_vectors[n * dims:(n + 1) * dims] for n in range(len(neighborhood_vectors) // dims)]
+    fits = array(typecode)
+    for buyer in range(len(offsets) - 1):
+        goals = buyer_vectors[buyer * dims:(buyer + 1) * dims]
+        fits.extend(sum(map(operator.mul, goals, neighborhoods[n]))
+                    for n in indices[offsets[buyer]:offsets[buyer + 1]])
+    return fits
+
+def legacy_order(buyer_vectors: Sequence, neighborhood_vectors: Sequence, dims: int = 3,
+                 weights: Optional[Sequence[float]] = None) -> List[int]:
+    """The order in which buyers first propose, which decides who wins ties.
+
+    `Neighborhood.set_prefs` used to sort the shared list of free buyers in place, once per neighborhood,
+    so the free buyers ended up stably sorted by fit to the last neighborhood, then the one before that,
+    and so on back to their input order. Buyers with the same goals tie everywhere and keep their input
+    order, so only the distinct goals are ranked. Fits to earlier neighborhoods only matter among goals
+    still tied, so rather than score every goal against every neighborhood, each group of tied goals is
+    sorted by the next neighborhood back until no ties are left; that usually takes a single pass.
+    """
+    buyer_count = len(buyer_vectors) // dims
+    neighborhood_count = len(neighborhood_vectors) // dims
+    characteristics = _weighted(neighborhood_vectors, dims, weights)
+    if numpy is not None:
+        dtype = numpy.float64 if _fit_typecode(buyer_vectors, characteristics) == 'd' else numpy.int64
+        goals = numpy.asarray(buyer_vectors, dtype=dtype).reshape(buyer_count, dims)
+        characteristics = numpy.asarray(characteristics, dtype=dtype).reshape(neighborhood_count, dims)
+        # intern the goals; numpy.unique(axis=0) does the same, but several times slower
+        interned = numpy.lexsort(goals.T[::-1])
+        starts = numpy.ones(buyer_count, dtype=bool)
+        starts[1:] = (goals[interned[1:]] != goals[interned[:-1]]).any(axis=1)
+        profile = numpy.empty(buyer_count, dtype=numpy.int64)
+        profile[interned] = numpy.cumsum(starts) - 1
+        goals = goals[interned[starts]]
+        order = numpy.arange(len(goals))
+        # for each position in the order, the position its group of tied goals starts at; and the positions
+        # of every group of more than one
+        group = numpy.zeros(len(goals), dtype=numpy.int64)
+        tied = numpy.arange(len(goals))
+        for n in reversed(range(neighborhood_count)):
+            if not len(tied):
+                break
+            ranked = order[tied]
+            fits = goals[ranked] @ characteristics[n]
+            # lexsort is stable and treats its last key as the primary one
+            resorted = numpy.lexsort((-fits, group[tied]))
+            ranked, fits, groups = ranked[resorted], fits[resorted], group[tied][resorted]
+            order[tied] = ranked
+            starts = numpy.ones(len(tied), dtype=bool)
+            starts[1:] = (groups[1:] != groups[:-1]) | (fits[1:] != fits[:-1])
+            first = numpy.flatnonzero(starts)
+            lengths = numpy.diff(numpy.append(first, len(tied)))
+            group[tied] = numpy.repeat(tied[first], lengths)
+            tied = tied[numpy.repeat(lengths > 1, lengths)]
+        rank = numpy.empty_like(group)
+        rank[order] = group
+        return numpy.argsort(rank[profile], kind='stable').tolist()
+    profiles: Dict[tuple, int] = {}
+    profile = [profiles.setdefault(tuple(buyer_vectors[b * dims:(b + 1) * dims]), len(profiles))
+               for b in range(buyer_count)]
+    goals = list(profiles)
+    groups = [list(range(len(goals)))]
+    for n in reversed(range(neighborhood_count)):
+        if len(groups) == len(goals):
+            break
+        characteristic = characteristics[n * dims:(n + 1) * dims]
+        refined = []
+        for group in groups:
+            if len(group) == 1:
+                refined.append(group)
+                continue
+            fits = {p: sum(map(operator.mul, goals[p], characteristic)) for p in group}
+            group.sort(key=fits.__getitem__, reverse=True)
+            refined += [list(run) for _, run in itertools.groupby(group, key=fits.__getitem__)]
+        groups = refined
+    rank = [0] * len(goals)
+    for r, group in enumerate(groups):
+        for p in group:
+            rank[p] = r
+    return sorted(range(buyer_count), key=lambda b: rank[profile[b]])
+
+def preference_fits(market) -> array:
+    """`gather_fits` for every preference in a `market.Market`, with its schema's weights."""
+    return gather_fits(market.buyer_vectors, market.neighborhood_vectors, market.pref_offsets,
+                       market.pref_indices, market.dims, market.schema.weights)
+
+def refit(market, fits: Sequence, neighborhoods: Sequence[int], neighborhood_vectors: Sequence) -> array:
+    """A copy of `fits`, the fit of every preference in `market`, with the fits to `neighborhoods` recomputed.
+
+    `neighborhood_vectors` are the market's neighborhood vectors after `neighborhoods` have changed; every other
+    fit is kept as it is.
+    """
+    dims = market.dims
+    typecode = market.schema.fit_typecode
+    characteristics = _weighted(neighborhood_vectors, dims, market.schema.weights)
+    if numpy is not None:
+        dtype = numpy.float64 if typecode == 'd' else numpy.int64
+        pref_indices = numpy.asarray(market.pref_indices, dtype=numpy.int64)
+        positions = numpy.flatnonzero(numpy.isin(pref_indices, numpy.asarray(neighborhoods, dtype=numpy.int64)))
+        owners = numpy.searchsorted(numpy.asarray(market.pref_offsets), positions, side='right') - 1
+        goals = numpy.asarray(market.buyer_vectors, dtype=dtype).reshape(-1, dims)
+        characteristics = numpy.asarray(characteristics, dtype=dtype).reshape(-1, dims)
+        refitted = numpy.array(fits, dtype=dtype)
+        refitted[positions] = (goals[owners] * characteristics[pref_indices[positions]]).sum(axis=1)
+        return _to_array(typecode, refitted)
+    changed = set(neighborhoods)
+    offsets = market.pref_offsets
+    pref_indices = market.pref_indices
+    buyer_vectors = market.buyer_vectors
+    refitted = array(typecode, fits)
+    for buyer in range(market.buyer_count):
+        for k in range(offsets[buyer], offsets[buyer + 1]):
+            n = pref_indices[k]
+            if n in changed:
+                refitted[k] = sum(map(operator.mul, buyer_vectors[buyer * dims:(buyer + 1) * dims],
+                                      characteristics[n * dims:(n + 1) * dims]))
+    return refitted
+
+def assign_fits(buyers: Sequence, neighborhoods: Sequence, fit_cache=None, stats=None) -> None:
+    """Store every buyer's fit to each of their preferences, computed in one batch.
+
+    Every preference must be one of `neighborhoods`. Neighborhoods keep no fits of their own:
+    `Neighborhood.get_fitness` asks the buyer. Buyers who share the same goals object and the same
+    preference list, as `match.read_input_file` interns them when deduplicating, are scored once and share
+    one array of fits. With a `cache.FitCache` as `fit_cache`, only the buyers it doesn't hold are scored, and
+    its hits and misses are counted into `stats`, if given.
+    """
+    if not neighborhoods:
+        return
+    schema = neighborhoods[0].vector.schema
+    index: Dict[object, int] = {n: i for i, n in enumerate(neighborhoods)}
+    profiles: Dict[Tuple[int, int], int] = {}
+    unique = []
+    for buyer in buyers:
+        key = (id(buyer.vector), id(buyer.prefs))
+        if key not in profiles:
+            profiles[key] = len(unique)
+            unique.append(buyer)
+    offsets = array('q', [0])
+    indices = array('i')
+    for buyer in unique:
+        indices.extend(index[n] for n in buyer.prefs)
+        offsets.append(len(indices))
+    buyer_vectors = stack([b.vector for b in unique])
+    neighborhood_vectors = stack([n.vector for n in neighborhoods])
+    if fit_cache is not None:
+        fits = fit_cache.gather_fits(buyer_vectors, neighborhood_vectors, offsets, indices, schema.dims,
+                                     schema.weights, stats)
+    else:
+        fits = gather_fits(buyer_vectors, neighborhood_vectors, offsets, indices, schema.dims, schema.weights)
+    if len(unique) == len(buyers):
+        for b, buyer in enumerate(buyers):
+            buyer.set_fits(fits[offsets[b]:offsets[b + 1]])
+        return
+    shared = [fits[offsets[p]:offsets[p + 1]] for p in range(len(unique))]
+    for buyer in buyers:
+        buyer.set_fits(shared[profiles[id(buyer.vector), id(buyer.prefs)]], copy=False)
@@ -0,0 +1,180 @@
+"""A columnar representation of a matching market.
+
+The object model in `buyer`, `neighborhood` and `base` is convenient to work with, but every homebuyer
+carries a handful of Python objects around with it. For large markets we instead describe buyers and
+neighborhoods by integer index, and keep their vectors and preferences in flat `array` columns.
+"""
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+
+from vector import PEARL, Schema
+
+class NameTable:
+    """A compact, append-only sequence of names.
+
+    The names are stored back to back as UTF-8 in one buffer, with their offsets in an array, rather
+    than as one `str` object each.
+    """
+
+    def __init__(self, blob: Union[bytes, bytearray, memoryview] = b'', offsets: Sequence[int] = (0,)) -> None:
+        self.blob = blob if isinstance(blob, (bytearray, memoryview)) else bytearray(blob)
+        self.offsets = offsets if isinstance(offsets, (array, memoryview)) else array('q', offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def raw(self, i: int) -> bytes:
+        """The encoded name at `i`."""
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def append(self, name: Union[str, bytes]) -> None:
+        self.blob += name.encode() if isinstance(name, str) else name
+        self.offsets.append(len(self.blob))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.blob) + len(self.offsets) * self.offsets.itemsize
+
+def split_capacities(buyer_count: int, declared: Sequence[Optional[int]]) -> array:
+    """The capacity of each neighborhood: its declared capacity, or an even share of what's left.
+
+    Neighborhoods with no declared capacity (``None``) split the buyers the declared capacities don't
+    account for evenly between them, rounding down; with none declared at all, every neighborhood gets
+    ``buyer_count // len(declared)``, as the brief has it.
+    """
+    undeclared = sum(1 for capacity in declared if capacity is None)
+    if not undeclared:
+        return array('q', declared)
+    remaining = max(buyer_count - sum(capacity for capacity in declared if capacity is not None), 0)
+    share = remaining // undeclared
+    return array('q', [share if capacity is None else capacity for capacity in declared])
+
+class Market:
+    """A matching market stored as flat, index-addressed columns.
+
+    Parameters
+    ----------
+    neighborhood_names : Sequence[str]
+        The neighborhood names; neighborhood ``i`` is ``neighborhood_names[i]``.
+    neighborhood_vectors : array
+        Row-major characteristics, ``dims`` values per neighborhood.
+    buyer_names : Sequence[str]
+        The homebuyer names; buyer ``b`` is ``buyer_names[b]``.
+    buyer_vectors : array
+        Row-major goals, ``dims`` values per buyer.
+    pref_offsets : array
+        ``len(buyer_names) + 1`` offsets into ``pref_indices``; buyer ``b`` ranks the neighborhoods
+        ``pref_indices[pref_offsets[b]:pref_offsets[b + 1]]``, most preferred first.
+    pref_indices : array
+        Neighborhood indices for every buyer's preferences, concatenated.
+    schema : Schema
+        What the values of each vector are; `vector.PEARL` unless the input declared another.
+    neighborhood_capacities : Optional[array]
+        The capacity each neighborhood declared, or -1 where it declared none; ``None`` if none did.
+    """
+
+    def __init__(self, neighborhood_names: Sequence[str], neighborhood_vectors: array,
+                 buyer_names: Sequence[str], buyer_vectors: array,
+                 pref_offsets: array, pref_indices: array, schema: Schema = PEARL,
+                 neighborhood_capacities: Optional[array] = None) -> None:
+        self.neighborhood_names = neighborhood_names
+        self.neighborhood_vectors = neighborhood_vectors
+        self.buyer_names = buyer_names
+        self.buyer_vectors = buyer_vectors
+        self.pref_offsets = pref_offsets
+        self.pref_indices = pref_indices
+        self.schema = schema
+        self.neighborhood_capacities = neighborhood_capacities
+
+    def __repr__(self):
+        return f"Market({self.buyer_count} buyers, {self.neighborhood_count} neighborhoods)"
+
+    @property
+    def dims(self) -> int:
+        """Number of values in each vector."""
+        return self.schema.dims
+
+    @property
+    def buyer_count(self) -> int:
+        return len(self.buyer_names)
+
+    @property
+    def neighborhood_count(self) -> int:
+        return len(self.neighborhood_names)
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the market's columns, in bytes."""
+        total = 0
+        for names in (self.neighborhood_names, self.buyer_names):
+            total += names.nbytes if isinstance(names, NameTable) else sum(len(name) for name in names)
+        for column in (self.neighborhood_vectors, self.buyer_vectors, self.pref_offsets, self.pref_indices):
+            total += len(column) * column.itemsize
+        return total
+
+    def buyer_vector(self, buyer: int) -> Sequence:
+        dims = self.dims
+        return self.buyer_vectors[buyer * dims:(buyer + 1) * dims]
+
+    def neighborhood_vector(self, neighborhood: int) -> Sequence:
+        dims = self.dims
+        return self.neighborhood_vectors[neighborhood * dims:(neighborhood + 1) * dims]
+
+    def buyer_prefs(self, buyer: int) -> Sequence[int]:
+        return self.pref_indices[self.pref_offsets[buyer]:self.pref_offsets[buyer + 1]]
+
+    def even_capacities(self) -> array:
+        """Capacities that split the buyers evenly among the neighborhoods, ignoring any declared capacities."""
+        return split_capacities(self.buyer_count, [None] * self.neighborhood_count)
+
+    def capacities(self) -> array:
+        """The capacity of every neighborhood, as `buyer_optimal_match` works them out: the declared ones,
+        with the rest of the buyers split evenly among the other neighborhoods."""
+        if self.neighborhood_capacities is None:
+            return self.even_capacities()
+        return split_capacities(self.buyer_count,
+                                [None if capacity < 0 else capacity for capacity in self.neighborhood_capacities])
+
+    @classmethod
+    def from_players(cls, buyers: List, neighborhoods: List) -> 'Market':
+        """Build a market from `Homebuyer` and `Neighborhood` objects.
+
+        Preferences for neighborhoods that aren't in `neighborhoods` are dropped.
+        """
+        schema = neighborhoods[0].vector.schema if neighborhoods else PEARL
+        index: Dict[object, int] = {n: i for i, n in enumerate(neighborhoods)}
+        neighborhood_capacities = None
+        if any(n.declared_capacity is not None for n in neighborhoods):
+            neighborhood_capacities = array('q', [-1 if n.declared_capacity is None else n.declared_capacity
+                                                  for n in neighborhoods])
+        neighborhood_vectors = array(schema.typecode)
+        for n in neighborhoods:
+            neighborhood_vectors.extend(n.vector._to_list())
+
+        buyer_vectors = array(schema.typecode)
+        pref_offsets = array('q', [0])
+        pref_indices = array('i')
+        for buyer in buyers:
+            buyer_vectors.extend(buyer.vector._to_list())
+            pref_indices.extend(index[n] for n in buyer.prefs if n in index)
+            pref_offsets.append(len(pref_indices))
+
+        return cls(
+            neighborhood_names=[n.name for n in neighborhoods],
+            neighborhood_vectors=neighborhood_vectors,
+            buyer_names=[b.name for b in buyers],
+            buyer_vectors=buyer_vectors,
+            pref_offsets=pref_offsets,
+            pref_indices=pref_indices,
+            schema=schema,
+            neighborhood_capacities=neighborhood_capacities,
+        )
@@ -8,14 +8,35 @@ also require setting up `matching` and its dependency `NumPy`, and I'm trying to
 falling into Dependency Hell.
 """
 import argparse
+from collections import deque
+from functools import partial
 import logging
 import sys
-from typing import Dict, List
+import time
+from typing import Dict, List, Optional
 
 from buyer import Homebuyer
+from cache import FitCache
+import cache
+from checkpoint import Checkpointer
+import checkpoint
+import dedupe
+from engine import (BLOCKING_PAIR_SECONDS, CHECK_EVERY, FALLBACK_PREFERENCE_SECONDS, FALLBACK_SECONDS, RESULT_SECONDS,
+                    ArrayMatching, Matches, array_optimal_match, count_blocking_pairs, greedy_fill, match_players)
 import exceptions
+from fits import assign_fits, legacy_order, stack
+from market import Market, split_capacities
 from neighborhood import Neighborhood
-from vector import PearlVector
+import output
+import partition
+import profiling
+import reader
+import scenarios
+import server
+import snapshot
+from stats import MatchStats, timed
+from vector import CAPACITY_KEY, PEARL, PearlVector, Schema, parse_capacity
+from verify import verify_array, verify_stable
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +52,11 @@ def _unmatch_pair(buyer: Homebuyer, neighborhood: Neighborhood):
     buyer._unmatch()
     neighborhood._unmatch(buyer)
 
-def buyer_optimal_match(buyers: List[Homebuyer], neighborhoods: List[Neighborhood]):
+ENGINES = ('object', 'array')
+
+def buyer_optimal_match(buyers: List[Homebuyer], neighborhoods: List[Neighborhood], engine: str = 'object',
+                        stats: Optional[MatchStats] = None, checkpoint: Optional[Checkpointer] = None,
+                        deadline: Optional[float] = None) -> Matches:
     """
     Solve a matching 'game' using an adapted Gale-Shapley algorithm in which residents rank their preferences
     for neighborhoods, and neighborhood preferences are based on 'fit' of residents who prefer them to that neighborhood.
@@ -42,48 +67,157 @@ def buyer_optimal_match(buyers: List[Homebuyer], neighborhoods: List[Neighborhoo
     which should produce an arrangement of homebuyers in neighborhoods such that no homebuyer would be a better fit for a 
     neighborhood they'd prefer more than the one they're in.
 
-    https://github.com/daffidwilde/matching/blob/main/src/matching/algorithms/hospital_resident.py"""
-
-    # operate on a copy of the residents list, not the original
-    free_buyers = buyers[:]
-
-    # we could assume that neighborhoods have varying capacities, but our prompt simplifies this to simply 
-    # distributing residents equally among neighborhoods, and further lets us assume an even division of 
-    # homebuyers (that is, we expect the number of homebuyers modulo the number of neighborhoods is zero).
-    # 
-    # TODO: check this assumption
-    # TODO: avoid division by zero – but if there were no neighborhoods, we'd have bigger problems
-    capacity = len(free_buyers) // len(neighborhoods)
-
-    for n in neighborhoods:
-        # initialize capacity and neighborhood fits for buyers
-        n.capacity = capacity
-        n.set_prefs(free_buyers)
-
-    while free_buyers:
-        buyer = free_buyers.pop(0)
-        logger.debug("Starting with buyer " + buyer.name)
-        while not buyer.matching:
-            for neighborhood in buyer.prefs:
-                logger.debug("\t checking neighborhood " + neighborhood.name)
-                if buyer.matching:
-                    logger.debug("\t buyer is matched, continuing")
-                    continue
-                if len(neighborhood.matching) < neighborhood.capacity:
-                    logger.debug("\t it's a match!")
+    https://github.com/daffidwilde/matching/blob/main/src/matching/algorithms/hospital_resident.py
+
+    `engine` selects the implementation: 'object' works directly on the players, while 'array' hands the
+    game to `engine.array_optimal_match`, which reaches the same result on flat arrays and is much faster
+    for large markets.
+
+    Pass a `stats.MatchStats` as `stats` to have it count proposals, rejections and displacements and time
+    each phase of the run; without one, nothing is counted.
+
+    Neighborhoods hold their declared capacity, and those without one split the remaining buyers evenly.
+    Buyers who can't be placed in any of their preferences are left unmatched; `unmatched_buyers` lists them.
+
+    Pass a `checkpoint.Checkpointer` as `checkpoint` to have a long run checkpointed as it goes, and resumed
+    from its last checkpoint if asked; only the 'array' engine keeps its state in a form that can be saved.
+
+    Pass a number of seconds as `deadline` to have the match stop proposing when they run out, and place the
+    buyers still free then greedily, each in the best of their preferences with room left, without displacing
+    anyone. The ``timed_out`` and ``blocking_pairs`` attributes of the result say whether that happened, and
+    how many blocking pairs it left: how far the matching is from stable. As with `engine.array_optimal_match`,
+    the time that takes is kept back from the proposals, and the greedy pass and the count give up rather
+    than run past the deadline, leaving buyers unmatched and the blocking pairs None."""
+    if engine == 'array':
+        if checkpoint is not None or deadline is not None:
+            return match_players(buyers, neighborhoods, stats=stats,
+                                 solver=partial(array_optimal_match, checkpoint=checkpoint, deadline=deadline))
+        return match_players(buyers, neighborhoods, stats=stats)
+    elif engine != 'object':
+        raise ValueError(f"Unknown engine {engine!r}; expected one of {ENGINES}")
+    if checkpoint is not None:
+        raise ValueError("Only the 'array' engine can be checkpointed")
+
+    # only count and time things if we've been asked to, and only build log messages if they'll be logged
+    counting = stats is not None
+    debug = logger.isEnabledFor(logging.DEBUG)
+    chains = {}
+    stop_at = None if deadline is None else time.perf_counter() + deadline - RESULT_SECONDS * len(buyers)
+    # how much more work before the next look at the clock, counted as `engine.CHECK_EVERY` counts it
+    countdown = 0
+    timed_out = False
+
+    with timed(stats, 'setup'):
+        # operate on a queue of the residents, not the original list, in the order that decides who wins ties
+        schema = neighborhoods[0].vector.schema if neighborhoods else PEARL
+        order = legacy_order(stack([b.vector for b in buyers]), stack([n.vector for n in neighborhoods]), schema.dims,
+                             schema.weights)
+        free_buyers = deque(buyers[i] for i in order)
+
+        # neighborhoods that declared a capacity keep it, and the rest split the remaining buyers evenly; if
+        # none declared one, that's an even split of every buyer, as the brief has it. Whoever doesn't fit
+        # is left unmatched, and `unmatched_buyers` reports them.
+        capacities = split_capacities(len(free_buyers), [n.declared_capacity for n in neighborhoods])
+
+        # neighborhoods aren't ranked up front: each only ever compares the buyers who propose to it, by
+        # fits the buyers already hold, and keeps its current matches in order
+        for n, capacity in zip(neighborhoods, capacities):
+            n.capacity = capacity
+        # the time a deadline keeps back for each buyer still free, to place them greedily
+        preferences = sum(len(b.prefs) for b in buyers)
+        fallback_seconds = FALLBACK_SECONDS + FALLBACK_PREFERENCE_SECONDS * preferences / max(len(buyers), 1)
+
+    with timed(stats, 'match'):
+        while free_buyers:
+            if stop_at is not None and countdown <= 0:
+                countdown = CHECK_EVERY
+                if time.perf_counter() + fallback_seconds * len(free_buyers) >= stop_at:
+                    timed_out = True
+                    break
+            countdown -= 1
+            buyer = free_buyers.popleft()
+            if debug:
+                logger.debug("Starting with buyer %s", buyer.name)
+            # one pass down the buyer's preferences: a neighborhood that turned them down would turn them
+            # down again, so a buyer who reaches the end unmatched leaves the queue unmatched. A full
+            # neighborhood's threshold is the worst fit it holds, so a buyer who doesn't beat it is turned
+            # down without looking at who that is.
+            for neighborhood, buyer_fit in zip(buyer.prefs, buyer.ranked_fits()):
+                if debug:
+                    logger.debug("\t checking neighborhood %s", neighborhood.name)
+                countdown -= 1
+                if counting:
+                    stats.proposals += 1
+                threshold = neighborhood.threshold
+                if threshold is None:
+                    if debug:
+                        logger.debug("\t it's a match!")
                     _match_pair(buyer, neighborhood)
-                else:
-                    worst_match = neighborhood.get_worst_match()
-                    worst_fit = neighborhood.get_fitness(worst_match)
-                    buyer_fit = neighborhood.get_fitness(buyer)
-                    if buyer_fit > worst_fit:
+                    break
+                if buyer_fit > threshold:
+                    if debug:
                         logger.debug("\t buyer is a better fit than the worst match")
-                        _unmatch_pair(worst_match, neighborhood)
-                        free_buyers.append(worst_match)
-                        _match_pair(buyer, neighborhood)
-                    else:
-                        logger.debug("\t buyer is not as good a fit, continuing to check")
-    return {n: n.matching for n in neighborhoods}
+                    worst_match = neighborhood.get_worst_match()
+                    _unmatch_pair(worst_match, neighborhood)
+                    free_buyers.append(worst_match)
+                    _match_pair(buyer, neighborhood)
+                    if counting:
+                        stats.displacements += 1
+                        chains[worst_match] = chains.get(buyer, 0) + 1
+                        stats.longest_chain = max(stats.longest_chain, chains[worst_match])
+                    break
+                if debug:
+                    logger.debug("\t buyer is not as good a fit, continuing to check")
+                if counting:
+                    stats.rejections += 1
+            else:
+                if debug:
+                    logger.debug("\t buyer %s exhausted their preferences and is unmatched", buyer.name)
+    if timed_out:
+        with timed(stats, 'greedy'):
+            return _greedy_fill_players(list(free_buyers), neighborhoods, stop_at)
+    return Matches({n: n.matching for n in neighborhoods})
+
+def _greedy_fill_players(pending: List[Homebuyer], neighborhoods: List[Neighborhood], stop_at: float) -> Matches:
+    """Place the buyers left over when a match runs out of time, and count the blocking pairs that leaves.
+
+    They're placed with `engine.greedy_fill`. Every other buyer is held stably, so only these can be in a
+    blocking pair. Neither step runs past `stop_at`.
+    """
+    index = {n: i for i, n in enumerate(neighborhoods)}
+    pref_indices = []
+    fits = []
+    starts = []
+    ends = []
+    for buyer in pending:
+        starts.append(len(pref_indices))
+        for neighborhood, fit in zip(buyer.prefs, buyer.ranked_fits()):
+            if neighborhood in index:
+                pref_indices.append(index[neighborhood])
+                fits.append(fit)
+        ends.append(len(pref_indices))
+    room = [n.capacity - len(n.matching) for n in neighborhoods]
+    stops = ends[:]
+    for i, k in greedy_fill(range(len(pending)), starts, ends, pref_indices, fits, room, stop_at):
+        _match_pair(pending[i], neighborhoods[pref_indices[k]])
+        stops[i] = k
+    matches = Matches({n: n.matching for n in neighborhoods})
+    matches.timed_out = True
+    matches.blocking_pairs = None
+    if time.perf_counter() + BLOCKING_PAIR_SECONDS * (sum(stops) - sum(starts)) <= stop_at:
+        thresholds = [float('-inf') if n.threshold is None else n.threshold for n in neighborhoods]
+        matches.blocking_pairs = count_blocking_pairs(starts, stops, pref_indices, fits, thresholds)
+    return matches
+
+def unmatched_buyers(buyers: List[Homebuyer]) -> List[Homebuyer]:
+    """The buyers `buyer_optimal_match` couldn't place in any of their preferences, in input order."""
+    return [buyer for buyer in buyers if buyer.matching is None]
+
+def unmatched_message(names: List[str], limit: int = 20) -> str:
+    """Say which buyers are unmatched, naming no more than `limit` of them."""
+    shown = ' '.join(names[:limit])
+    more = f" and {len(names) - limit} more" if len(names) > limit else ''
+    return f"{len(names)} homebuyer{'' if len(names) == 1 else 's'} unmatched: {shown}{more}"
 
 def tokens_for_type(data_string: str, type_indicator: str) -> List[str]:
     # let's start by being case tolerant; we'll work in uppercase:
@@ -93,11 +227,21 @@ def tokens_for_type(data_string: str, type_indicator: str) -> List[str]:
         raise exceptions.DataParsingError(data_string)
     return tokens
 
-def read_input_file(file_name: str) -> dict:
-    """Reads the file specified by file_name and returns a dictionary containing neighborhood and homebuyer dictionaries"""
+def read_input_file(file_name: str, intern_profiles: bool = False, fit_cache: Optional[FitCache] = None,
+                    stats: Optional[MatchStats] = None) -> dict:
+    """Reads the file specified by file_name and returns a dictionary containing neighborhood and homebuyer dictionaries
+
+    An ``S`` line declares the schema of every vector in the file, and must come before the first ``N`` line;
+    without one, vectors are E/W/R. The schema is returned too, as 'schema'.
+
+    With `intern_profiles`, homebuyers with the same goals and preferences are interned: they share one goals vector,
+    one preference list and one array of fits, which are parsed and computed only once.
+
+    With a `fit_cache`, fits are read from it where it has them, as `fits.assign_fits` describes."""
     neighborhoods = {}
     homebuyers = {}
     homebuyer_lines = []
+    schema = PEARL
     with open(file_name) as input_file:
         for line in input_file:
             stripped = line.rstrip()
@@ -105,15 +249,22 @@ def read_input_file(file_name: str) -> dict:
                 # Homebuyer creation depends on having the neighborhoods, so save these lines and parse them last
                 homebuyer_lines.append(stripped)
             elif line[0] == 'N':
-                neighborhood = neighborhood_from_string(stripped)
+                neighborhood = neighborhood_from_string(stripped, schema)
                 neighborhoods[neighborhood.name] = neighborhood
+            elif line[0] == 'S':
+                # every neighborhood has to be read with the same schema
+                if neighborhoods:
+                    raise exceptions.DataParsingError(stripped)
+                schema = schema_from_string(stripped)
             else:
                 # all other lines are ignored
                 pass
+    profiles = {} if intern_profiles else None
     for line in homebuyer_lines:
-        homebuyer = buyer_from_string(line, neighborhoods)
+        homebuyer = buyer_from_string(line, neighborhoods, compute_fits=False, schema=schema, profiles=profiles)
         homebuyers[homebuyer.name] = homebuyer
-    return { 'neighborhoods': list(neighborhoods.values()), 'homebuyers': list(homebuyers.values()) }
+    assign_fits(list(homebuyers.values()), list(neighborhoods.values()), fit_cache, stats)
+    return { 'neighborhoods': list(neighborhoods.values()), 'homebuyers': list(homebuyers.values()), 'schema': schema }
 
 def write_output_file(file_name: str, matches: Dict[str, List[Homebuyer]]) -> None:
     """Write the matches out to a file.
@@ -121,12 +272,23 @@ def write_output_file(file_name: str, matches: Dict[str, List[Homebuyer]]) -> No
     Matches are presumed to be provided in a dictionary whose keys are the names of the neighborhoods
     and whose values are ordered lists of the homebuyers matched to those neighborhoods.
     """
-    with open(file_name, "w") if file_name else sys.stdout as output_file:
-        for key, buyers in matches.items():
-            buyer_text = ' '.join([f"{buyer.name}({buyer.fits[key.name]})" for buyer in buyers])
-            print(f"{key}: {buyer_text}", file=output_file)
+    output.write_text(file_name, output.match_rows(matches))
 
-def buyer_from_string(h_string: str, neighborhoods: Dict[str, Neighborhood]) -> object:
+def write_matching(file_name: str, result: ArrayMatching) -> None:
+    """Write an `ArrayMatching` out to a file, in the same format as `write_output_file`."""
+    output.write_text(file_name, output.matching_rows(result))
+
+def _vector_from_tokens(tokens: List[str], schema: Schema, data_string: str) -> object:
+    if schema is PEARL:
+        return PearlVector.from_tokens(tokens)
+    return schema.parse(tokens, data_string)
+
+def buyer_from_string(h_string: str, neighborhoods: Dict[str, Neighborhood], compute_fits: bool = True,
+                      schema: Schema = PEARL, profiles: Optional[dict] = None) -> object:
+    """Build a homebuyer from an ``H`` line.
+
+    If `profiles` is given, it remembers the first buyer built with each set of goal and preference tokens,
+    and later buyers with the same tokens share that buyer's goals and preference list."""
     tokens = tokens_for_type(h_string, 'H')
 
     name_token = None
@@ -144,35 +306,110 @@ def buyer_from_string(h_string: str, neighborhoods: Dict[str, Neighborhood]) ->
         else:
             name_token = token
 
-    goal_vector = PearlVector.from_tokens(goal_tokens)
+    if profiles is not None:
+        profile = profiles.get((tuple(goal_tokens), preference_string))
+        if profile is not None:
+            return Homebuyer(name=name_token, goals=profile.goals, preferences=profile.prefs, compute_fits=compute_fits)
+
+    goal_vector = _vector_from_tokens(goal_tokens, schema, h_string)
     preference_keys = preference_string.split('>')
     preference_list = [neighborhoods[key] for key in preference_keys if key in neighborhoods.keys()]
-    return Homebuyer(name=name_token, goals=goal_vector, preferences=preference_list)
+    homebuyer = Homebuyer(name=name_token, goals=goal_vector, preferences=preference_list, compute_fits=compute_fits)
+    if profiles is not None:
+        profiles[tuple(goal_tokens), preference_string] = homebuyer
+    return homebuyer
 
-def neighborhood_from_string(n_string: str) -> Neighborhood:
+def neighborhood_from_string(n_string: str, schema: Schema = PEARL) -> Neighborhood:
     tokens = tokens_for_type(n_string, 'N')
 
     name_token = None
     score_tokens = []
+    capacity = None
 
     for token in tokens:
+        # a 'C:' token is the capacity, unless the schema has a 'C' of its own
+        if token.startswith(f'{CAPACITY_KEY}:') and CAPACITY_KEY not in schema.index:
+            try:
+                capacity = parse_capacity(token[len(CAPACITY_KEY) + 1:])
+            except ValueError:
+                raise exceptions.DataParsingError(n_string)
         # tokens with a ':' represent goal ratings:
-        if ':' in token:
+        elif ':' in token:
             score_tokens.append(token)
         # any other string must be the name
         else:
             name_token = token
 
-    characteristic_vector = PearlVector.from_tokens(score_tokens)
-    return Neighborhood(name=name_token, characteristics=characteristic_vector)
+    characteristic_vector = _vector_from_tokens(score_tokens, schema, n_string)
+    return Neighborhood(name=name_token, characteristics=characteristic_vector, capacity=capacity)
+
+def schema_from_string(s_string: str) -> Schema:
+    try:
+        return Schema.from_tokens(tokens_for_type(s_string, 'S'))
+    except ValueError:
+        raise exceptions.DataParsingError(s_string)
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Match homebuyers to neighborhoods, in a buyer-optimal way')
-    parser.add_argument('input_file', type=str, 
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(server.main(sys.argv[2:]))
+    parser = argparse.ArgumentParser(description='Match homebuyers to neighborhoods, in a buyer-optimal way',
+                                     epilog='Run "match.py serve --help" to keep markets warm in a server instead.')
+    parser.add_argument('input_file', type=str, nargs='?',
                         help='Input file with neighborhood and homebuyer defintions.')
     parser.add_argument('--output', type=str, required=False,  dest='output_file',
                         help='Name of file where output should be written (will use stdout if not specified).')
+    parser.add_argument('--format', choices=output.FORMATS, default='text', dest='output_format',
+                        help='"csv" or "binary" write one row per buyer with the index of their neighborhood and '
+                             'their fit; "shards" writes one file per neighborhood into the --output directory.')
+    parser.add_argument('--engine', choices=ENGINES, default='object',
+                        help='Matching implementation to use; "array" is much faster for large markets.')
+    parser.add_argument('--reader', choices=reader.READERS, required=False,
+                        help='Stream the input into compact columns instead of building player objects; '
+                             '"mmap" memory-maps the file, and "parallel" parses byte ranges of it in one process '
+                             'per CPU. Implies the array engine.')
+    parser.add_argument('--save-snapshot', type=str, required=False, dest='save_snapshot',
+                        help='Also save the parsed market as a binary snapshot, for a faster --load-snapshot later.')
+    parser.add_argument('--load-snapshot', type=str, required=False, dest='load_snapshot',
+                        help='Load the market from a binary snapshot instead of an input file. Implies the array engine.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Solve independent sub-markets in this many worker processes. Implies the array engine.')
+    parser.add_argument('--dedupe', dest='dedupe', action='store_true',
+                        help='Intern homebuyers with the same goals and preferences, and match each run of them as '
+                             'a block. Implies the array engine; the result is the same.')
+    parser.add_argument('--scenarios', type=str, required=False, dest='scenarios',
+                        help='Solve every what-if scenario in this deltas file against the market, spread over '
+                             '--workers processes, and write how each changes the matching. Implies the array engine.')
+    parser.add_argument('--checkpoint', type=str, required=False, dest='checkpoint',
+                        help='Checkpoint the solver to this file as it goes, so that an interrupted run can be '
+                             '--resumed. Implies the array engine.')
+    parser.add_argument('--checkpoint-every', type=int, default=checkpoint.PROPOSALS, dest='checkpoint_proposals',
+                        metavar='PROPOSALS', help='Checkpoint after this many proposals.')
+    parser.add_argument('--checkpoint-seconds', type=float, default=checkpoint.SECONDS, dest='checkpoint_seconds',
+                        metavar='SECONDS', help='Checkpoint after this many seconds.')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Resume from the --checkpoint file, if there is one. The matching is the same as an '
+                             'uninterrupted run\'s.')
+    parser.add_argument('--deadline', type=float, required=False, dest='deadline', metavar='SECONDS',
+                        help='Stop proposing after this many seconds, place the homebuyers still free greedily, and '
+                             'report on stderr how many blocking pairs that left.')
+    parser.add_argument('--cache', type=str, required=False, dest='cache', metavar='DIRECTORY',
+                        help='Keep the fits of each market in this directory, and on later runs only score the '
+                             'homebuyers whose goals or preferences have changed.')
+    parser.add_argument('--cache-size', type=float, default=cache.MAX_BYTES / 2 ** 20, dest='cache_size',
+                        metavar='MEGABYTES', help='Remove the least recently used markets from the --cache directory '
+                                                  'once it holds more than this.')
+    parser.add_argument('--profile', type=str, required=False, dest='profile', metavar='DIRECTORY',
+                        help='Profile each stage of the run, and write STAGE.pstats and flame-graph-ready '
+                             'STAGE.collapsed files into this directory.')
+    parser.add_argument('--profiler', choices=profiling.MODES, default='sample',
+                        help='"sample" looks at the stack every few milliseconds and costs a few percent; '
+                             '"cprofile" sees every call, and is much slower.')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='Print proposal counts and the time spent in each phase to stderr.')
+    parser.add_argument('--verify', dest='verify', action='store_true',
+                        help='Check that the matching is stable, report any problems to stderr, and exit with '
+                             'status 1 if it is not.')
     parser.add_argument('--debug', dest='debug', action='store_const', const=True, default=False, 
                         help='If present, turns on debug logging')
     parsed_args = parser.parse_args(sys.argv[1:])
@@ -182,6 +419,123 @@ if __name__ == '__main__':
     if parsed_args.debug:
         logger.setLevel(logging.DEBUG)
     
-    input_data = read_input_file(input_file)
-    matches = buyer_optimal_match(input_data['homebuyers'], input_data['neighborhoods'])
-    write_output_file(output_file, matches)
\ No newline at end of file
+    if not input_file and not parsed_args.load_snapshot:
+        parser.error('an input file or --load-snapshot is required')
+    if parsed_args.output_format == 'shards' and not output_file:
+        parser.error('--format=shards needs an --output directory')
+    if parsed_args.dedupe and parsed_args.workers > 1:
+        parser.error('--dedupe solves the whole market in one process, and cannot be combined with --workers')
+    if parsed_args.resume and not parsed_args.checkpoint:
+        parser.error('--resume needs a --checkpoint file')
+    if parsed_args.checkpoint and (parsed_args.dedupe or parsed_args.workers > 1):
+        parser.error('--checkpoint solves the whole market with the array engine, and cannot be combined with '
+                     '--dedupe or --workers')
+
+    if parsed_args.deadline is not None and (parsed_args.dedupe or parsed_args.workers > 1 or parsed_args.scenarios):
+        parser.error('--deadline solves the whole market in one process, and cannot be combined with --dedupe, '
+                     '--workers or --scenarios')
+
+    if parsed_args.cache and (parsed_args.scenarios or ((parsed_args.reader or parsed_args.load_snapshot)
+                                                        and (parsed_args.dedupe or parsed_args.workers > 1))):
+        parser.error('--cache scores the whole market up front, and cannot be combined with --scenarios, or with '
+                     '--dedupe or --workers when reading columns')
+
+    stats = MatchStats() if parsed_args.stats else None
+    if parsed_args.profile:
+        stats = profiling.Profiler(parsed_args.profile, parsed_args.profiler)
+    fit_cache = FitCache(parsed_args.cache, int(parsed_args.cache_size * 2 ** 20)) if parsed_args.cache else None
+    checkpointer = None
+    if parsed_args.checkpoint:
+        checkpointer = Checkpointer(parsed_args.checkpoint, parsed_args.checkpoint_proposals,
+                                    parsed_args.checkpoint_seconds, parsed_args.resume)
+    if parsed_args.scenarios:
+        with timed(stats, 'parse'):
+            if parsed_args.load_snapshot:
+                market = snapshot.load_snapshot(parsed_args.load_snapshot)
+            else:
+                market = reader.read_market(input_file, mode=parsed_args.reader or 'stream')
+            deltas = scenarios.read_scenarios(parsed_args.scenarios, market.schema)
+        with timed(stats, 'match'):
+            diffs = scenarios.ScenarioRunner.from_market(market, parsed_args.workers).run(deltas)
+        with timed(stats, 'output'):
+            scenarios.write_diffs(output_file, diffs)
+        if parsed_args.profile:
+            stats.close()
+        if parsed_args.stats:
+            print(stats, file=sys.stderr)
+        sys.exit(0)
+    if parsed_args.load_snapshot or parsed_args.reader:
+        with timed(stats, 'parse'):
+            if parsed_args.load_snapshot:
+                market = snapshot.load_snapshot(parsed_args.load_snapshot)
+            else:
+                market = reader.read_market(input_file, mode=parsed_args.reader)
+                print(f"{market}: {market.nbytes} bytes of columns, peak memory {reader.peak_memory()} bytes",
+                      file=sys.stderr)
+        if parsed_args.save_snapshot:
+            try:
+                snapshot.save_snapshot(parsed_args.save_snapshot, market)
+            except ValueError as error:
+                parser.error(f"--save-snapshot: {error}")
+        if parsed_args.workers > 1:
+            result = partition.partitioned_optimal_match(market, parsed_args.workers, stats=stats)
+        elif parsed_args.dedupe:
+            result = dedupe.block_optimal_match(market, stats=stats)
+        else:
+            fits = None
+            if fit_cache is not None:
+                with timed(stats, 'setup'):
+                    fits = fit_cache.preference_fits(market, stats)
+            result = array_optimal_match(market, fits=fits, stats=stats, checkpoint=checkpointer,
+                                         deadline=parsed_args.deadline)
+        timed_out, blocking_pairs = result.timed_out, result.blocking_pairs
+        with timed(stats, 'output'):
+            output.write(output_file, parsed_args.output_format, output.matching_rows(result),
+                         output.matching_assignments(result), market.schema.fit_typecode)
+        unmatched = [market.buyer_names[buyer] for buyer in result.unmatched()]
+        if parsed_args.verify:
+            with timed(stats, 'verify'):
+                report = verify_array(result)
+    else:
+        with timed(stats, 'parse'):
+            input_data = read_input_file(input_file, intern_profiles=parsed_args.dedupe, fit_cache=fit_cache,
+                                         stats=stats)
+        if parsed_args.save_snapshot:
+            try:
+                snapshot.save_snapshot(parsed_args.save_snapshot,
+                                       Market.from_players(input_data['homebuyers'], input_data['neighborhoods']))
+            except ValueError as error:
+                parser.error(f"--save-snapshot: {error}")
+        if parsed_args.workers > 1:
+            matches = partition.match_players(input_data['homebuyers'], input_data['neighborhoods'], parsed_args.workers,
+                                              stats=stats)
+        elif parsed_args.dedupe:
+            matches = dedupe.match_players(input_data['homebuyers'], input_data['neighborhoods'], stats=stats)
+        else:
+            matches = buyer_optimal_match(input_data['homebuyers'], input_data['neighborhoods'],
+                                          engine='array' if checkpointer else parsed_args.engine, stats=stats,
+                                          checkpoint=checkpointer, deadline=parsed_args.deadline)
+        timed_out, blocking_pairs = getattr(matches, 'timed_out', False), getattr(matches, 'blocking_pairs', 0)
+        with timed(stats, 'output'):
+            output.write(output_file, parsed_args.output_format, output.match_rows(matches),
+                         output.match_assignments(input_data['homebuyers'], matches),
+                         input_data['schema'].fit_typecode)
+        unmatched = [buyer.name for buyer in unmatched_buyers(input_data['homebuyers'])]
+        if parsed_args.verify:
+            with timed(stats, 'verify'):
+                report = verify_stable(matches, input_data['homebuyers'])
+    if timed_out:
+        left = (f"leaving {blocking_pairs} blocking pairs" if blocking_pairs is not None
+                else "without time to count the blocking pairs")
+        print(f"ran out of time after {parsed_args.deadline}s and placed the remaining homebuyers greedily, {left}",
+              file=sys.stderr)
+    if unmatched:
+        print(unmatched_message(unmatched), file=sys.stderr)
+    if parsed_args.profile:
+        stats.close()
+    if parsed_args.stats:
+        print(stats, file=sys.stderr)
+    if parsed_args.verify:
+        print(report, file=sys.stderr)
+        if not report.stable:
+            sys.exit(1)
\ No newline at end of file
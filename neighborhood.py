@@ -1,16 +1,60 @@
-from typing import List
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import List, Optional, Sequence
 
 from base import BasePlayer
 from vector import PearlVector
 
+def _find(players: Sequence[BasePlayer], keys: Sequence[int], player: BasePlayer, key: int) -> Optional[int]:
+    """The position of `player` in `players`, which are ordered by their `keys`; ``None`` if they're absent."""
+    for i in range(bisect_left(keys, key), bisect_right(keys, key)):
+        if players[i] is player:
+            return i
+    return None
+
 class Neighborhood(BasePlayer):
-    def __init__(self, name: str, characteristics: PearlVector) -> None:
+    """A neighborhood, with characteristics and a capacity.
+
+    ``declared_capacity`` is the capacity given in the input, if any; ``capacity`` is the one in force, which
+    `buyer_optimal_match` sets from it, or from an even split of the buyers if there isn't one.
+    A neighborhood keeps no fits of its own: fit is symmetric, so it asks the buyer, who has it stored.
+    Its preferences and its matching are both ordered from best fit to worst, and each is kept alongside
+    an array of the negated fits, so that a buyer's place in either is found by bisection.
+    """
+
+    __slots__ = ('capacity', 'declared_capacity', '_pref_keys', '_matching', '_match_keys')
+
+    def __init__(self, name: str, characteristics: PearlVector, capacity: Optional[int] = None) -> None:
         super().__init__(name=name, vector=characteristics)
-        self.capacity = 0
-        self.characteristics = characteristics
+        self.capacity = 0 if capacity is None else capacity
+        self.declared_capacity = capacity
+        self._pref_keys = array(characteristics.schema.fit_typecode)
+
+    @property
+    def characteristics(self) -> PearlVector:
+        return self.vector
+
+    @characteristics.setter
+    def characteristics(self, characteristics: PearlVector) -> None:
+        self.vector = characteristics
+
+    @property
+    def matching(self) -> List[BasePlayer]:
+        return self._matching
+
+    @matching.setter
+    def matching(self, buyers: List[BasePlayer]) -> None:
+        self._matching = sorted(buyers, key=self.get_fitness, reverse=True)
+        self._match_keys = array(self.vector.schema.fit_typecode, [-self.get_fitness(b) for b in self._matching])
+
+    def get_fitness(self, other: BasePlayer) -> int:
+        return other.get_fitness(self)
     
     def _unmatch(self, other):
-        self.matching = [b for b in self.matching if b != other]
+        i = _find(self._matching, self._match_keys, other, -self.get_fitness(other))
+        if i is not None:
+            del self._matching[i]
+            del self._match_keys[i]
     
     def prefers(self, buyer: BasePlayer, other: BasePlayer):
         """Determines whether the Neighborhood is a better fit for one buyer or another"""
@@ -25,40 +69,59 @@ class Neighborhood(BasePlayer):
         """
 
         for player in self.prefs:
-            if player not in self.matching:
+            if _find(self._matching, self._match_keys, player, -self.get_fitness(player)) is None:
                 return player
 
         return None
 
     def get_worst_match(self):
         return self.matching[-1]
+
+    @property
+    def threshold(self):
+        """The fit a buyer must beat to be taken: ``None`` while there's room, and the worst fit held once full.
+
+        While matching, a full neighborhood stays full and only swaps its worst match for a better one, so
+        its threshold only ever rises. A neighborhood with no room at all takes no-one.
+        """
+        if len(self._matching) < self.capacity:
+            return None
+        if not self._match_keys:
+            return float('inf')
+        return -self._match_keys[-1]
     
     def get_successors(self):
         """Get the successors to the neighborhoods's worst current match."""
 
         worst_match = self.get_worst_match()
-        if worst_match in self.prefs:
-            idx = self.prefs.index(self.get_worst_match())
+        idx = _find(self.prefs, self._pref_keys, worst_match, -self.get_fitness(worst_match))
+        if idx is not None:
             return self.prefs[idx + 1 :]
         else:
             return self.prefs
 
+    def check_if_match_is_unacceptable(self):
+        """Messages for every matched buyer who doesn't list the neighborhood."""
+        messages = (buyer.check_if_match_is_unacceptable() for buyer in self.matching)
+        return [message for message in messages if message]
+
     def _match(self, other: BasePlayer):
         """Make a match between this Neighborhood and some player.
         
-        This needs to add a player to the current prefs list, but put that list in order by fitness."""
-        if other in self.matching:
+        The matching stays in order by fitness; among equal fits, the latest match goes last."""
+        key = -self.get_fitness(other)
+        if _find(self._matching, self._match_keys, other, key) is not None:
             return self.matching
-        
-        self.matching.append(other)
-        self.matching.sort(key=lambda player: player.get_fitness(self), reverse=True)
+
+        i = bisect_right(self._match_keys, key)
+        self._matching.insert(i, other)
+        self._match_keys.insert(i, key)
     
     def set_prefs(self, buyers: List[BasePlayer]):
-        """Set the neighborhood's preferences to be a list of buyers."""
+        """Set the neighborhood's preferences to be the buyers, ordered from best fit to worst.
 
-        self.prefs = buyers
-        self.prefs.sort(key=lambda buyer: self.get_fitness(buyer), reverse=True)
-        self._pref_names = [player.name for player in self.prefs]
+        The neighborhood keeps its own sorted copy; `buyers` is left as it was.
+        """
 
-        if self._original_prefs is None:
-            self._original_prefs = self.prefs[:]
+        self.prefs = sorted(buyers, key=self.get_fitness, reverse=True)
+        self._pref_keys = array(self.vector.schema.fit_typecode, [-self.get_fitness(b) for b in self.prefs])
@@ -0,0 +1,176 @@
+"""Writing matchings out, in chunks.
+
+Every writer here streams: buyers are formatted a chunk at a time into a large buffered file, so no
+neighborhood's line is ever built as one giant string, the time taken grows linearly with the size of the
+output, and memory stays flat however big the matching is. There are three formats:
+
+* text, one line per neighborhood, as `match.write_output_file` has always written it;
+* assignments, one row per buyer with the index of their neighborhood and their fit to it, either as CSV
+  or as packed binary records;
+* shards, one text file per neighborhood with one buyer per line, written in parallel.
+
+Writers take plain rows, so the same code serves `buyer_optimal_match` results and `ArrayMatching`s; the
+``*_rows`` and ``*_assignments`` functions adapt each of those.
+"""
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
+from itertools import islice
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from engine import ArrayMatching
+
+FORMATS = ('text', 'csv', 'binary', 'shards')
+
+# buyers formatted per write, and the size of the output buffer
+CHUNK = 4096
+BUFFER = 1 << 20
+
+ASSIGNMENTS_MAGIC = b'NBHDASGN'
+# neighborhood index (-1 if unmatched), fit
+ASSIGNMENT = struct.Struct('<iq')
+# the same, for markets whose fits are floats
+FLOAT_ASSIGNMENTS_MAGIC = b'NBHDASGD'
+FLOAT_ASSIGNMENT = struct.Struct('<id')
+# magic and record layout, by the `array` typecode of the fits
+_RECORDS = {'q': (ASSIGNMENTS_MAGIC, ASSIGNMENT), 'd': (FLOAT_ASSIGNMENTS_MAGIC, FLOAT_ASSIGNMENT)}
+
+Row = Tuple[str, Iterable[Tuple[str, int]]]
+Assignment = Tuple[str, int, int]
+
+@contextmanager
+def _open(file_name: Optional[str], binary: bool = False) -> Iterator:
+    """A large buffered file, or stdout if there's no `file_name`. Stdout is left open."""
+    if not file_name:
+        yield sys.stdout.buffer if binary else sys.stdout
+        return
+    with open(file_name, 'wb' if binary else 'w', buffering=BUFFER) as output_file:
+        yield output_file
+
+def _chunks(items: Iterable) -> Iterator[list]:
+    items = iter(items)
+    chunk = list(islice(items, CHUNK))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, CHUNK))
+
+def _write_row(output_file, name: str, buyers: Iterable[Tuple[str, int]]) -> None:
+    output_file.write(f"{name}: ")
+    separator = ''
+    for chunk in _chunks(buyers):
+        output_file.write(separator)
+        output_file.write(' '.join([f"{buyer}({fit})" for buyer, fit in chunk]))
+        separator = ' '
+    output_file.write('\n')
+
+def write_text(file_name: Optional[str], rows: Iterable[Row]) -> None:
+    """Write one ``NAME: BUYER(FIT) BUYER(FIT) ...`` line per neighborhood, to stdout if there's no `file_name`."""
+    with _open(file_name) as output_file:
+        for name, buyers in rows:
+            _write_row(output_file, name, buyers)
+
+def write_assignments(file_name: Optional[str], assignments: Iterable[Assignment], binary: bool = False,
+                      typecode: str = 'q') -> None:
+    """Write one row per buyer: their name, the index of their neighborhood and their fit to it.
+
+    Unmatched buyers have neighborhood -1 and fit 0. As CSV, the rows follow a ``buyer,neighborhood,fit``
+    header. As binary, the file is `ASSIGNMENTS_MAGIC` followed by an `ASSIGNMENT` record per buyer in
+    input order; the names are left out, since they're in the input already. Float fits, for a `typecode`
+    of 'd', are written as `FLOAT_ASSIGNMENT` records after `FLOAT_ASSIGNMENTS_MAGIC` instead.
+    """
+    with _open(file_name, binary) as output_file:
+        if binary:
+            magic, record = _RECORDS[typecode]
+            output_file.write(magic)
+            pack = record.pack
+            for chunk in _chunks(assignments):
+                output_file.write(b''.join([pack(neighborhood, fit) for _, neighborhood, fit in chunk]))
+        else:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(('buyer', 'neighborhood', 'fit'))
+            for chunk in _chunks(assignments):
+                writer.writerows(chunk)
+
+def read_assignments(file_name: str) -> List[Tuple[int, int]]:
+    """The (neighborhood index, fit) of every buyer in a binary file from `write_assignments`."""
+    with open(file_name, 'rb') as input_file:
+        data = input_file.read()
+    for magic, record in _RECORDS.values():
+        if data.startswith(magic):
+            return list(record.iter_unpack(memoryview(data)[len(magic):]))
+    raise ValueError(f"{file_name} is not a binary assignments file")
+
+def _write_shard(file_name: str, buyers: Iterable[Tuple[str, int]]) -> None:
+    with _open(file_name) as output_file:
+        for chunk in _chunks(buyers):
+            output_file.write(''.join([f"{buyer}({fit})\n" for buyer, fit in chunk]))
+
+def write_shards(directory: str, rows: Iterable[Row], workers: Optional[int] = None) -> List[str]:
+    """Write each neighborhood's buyers to ``directory/NAME.txt``, one per line, `workers` files at a time.
+
+    Returns the names of the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for name, buyers in rows:
+            if not name or os.sep in name or name in (os.curdir, os.pardir):
+                raise ValueError(f"Can't write a shard for neighborhood {name!r}")
+            file_name = os.path.join(directory, f"{name}.txt")
+            file_names.append(file_name)
+            futures.append(executor.submit(_write_shard, file_name, buyers))
+        for future in futures:
+            future.result()
+    return file_names
+
+def match_rows(matches: Dict) -> Iterator[Row]:
+    """The rows of a ``{Neighborhood: [Homebuyer]}`` matching, as `buyer_optimal_match` returns it."""
+    for neighborhood, buyers in matches.items():
+        yield str(neighborhood), ((buyer.name, buyer.get_fitness(neighborhood)) for buyer in buyers)
+
+def match_assignments(buyers: Iterable, matches: Dict) -> Iterator[Assignment]:
+    """The assignment of each of `buyers`, with neighborhoods numbered in the order of `matches`."""
+    index = {neighborhood: i for i, neighborhood in enumerate(matches)}
+    for buyer in buyers:
+        neighborhood = buyer.matching
+        if neighborhood is None:
+            yield buyer.name, -1, 0
+        else:
+            yield buyer.name, index[neighborhood], buyer.get_fitness(neighborhood)
+
+def matching_rows(result: ArrayMatching) -> Iterator[Row]:
+    """The rows of an `ArrayMatching`."""
+    buyer_names = result.market.buyer_names
+    for name, members, fits in zip(result.market.neighborhood_names, result.members, result.member_fits):
+        yield name, ((buyer_names[buyer], fit) for buyer, fit in zip(members, fits))
+
+def matching_assignments(result: ArrayMatching) -> Iterator[Assignment]:
+    """The assignment of every buyer in an `ArrayMatching`, in input order."""
+    buyer_fits = array(result.market.schema.fit_typecode, [0]) * result.market.buyer_count
+    for members, fits in zip(result.members, result.member_fits):
+        for buyer, fit in zip(members, fits):
+            buyer_fits[buyer] = fit
+    for buyer, (name, neighborhood) in enumerate(zip(result.market.buyer_names, result.buyer_match)):
+        yield name, neighborhood, buyer_fits[buyer]
+
+def write(file_name: Optional[str], output_format: str, rows: Iterable[Row],
+          assignments: Iterable[Assignment], typecode: str = 'q') -> None:
+    """Write in any of the `FORMATS`; for 'shards', `file_name` is the directory.
+
+    `typecode` is the `array` typecode of the fits, as `vector.Schema.fit_typecode` gives it.
+    """
+    if output_format == 'text':
+        write_text(file_name, rows)
+    elif output_format in ('csv', 'binary'):
+        write_assignments(file_name, assignments, binary=output_format == 'binary', typecode=typecode)
+    elif output_format == 'shards':
+        if not file_name:
+            raise ValueError("Sharded output needs a directory to write to")
+        write_shards(file_name, rows)
+    else:
+        raise ValueError(f"Unknown output format {output_format!r}; expected one of {FORMATS}")
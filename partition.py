@@ -0,0 +1,127 @@
+"""Solving independent sub-markets in parallel.
+
+An input file often holds several markets that have nothing to do with each other – regions, say, whose
+buyers only rank their own neighborhoods. No proposal ever crosses from one such sub-market into another,
+so each can be solved on its own. We find them as the connected components of the buyer → neighborhood
+preference graph, solve each in a `concurrent.futures.ProcessPoolExecutor` worker, and stitch the results
+back together.
+
+Workers are sent only the compact columns of their sub-market, never player objects. Each sub-market is
+solved with the capacities and in the proposal order the whole market would have used, so the merged
+result is identical to solving the whole market at once.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import engine
+from engine import ArrayMatching, array_optimal_match
+from market import Market
+from stats import MatchStats
+
+def components(market: Market) -> List[Tuple[List[int], List[int]]]:
+    """The connected components of the market, as (neighborhood indices, buyer indices) pairs.
+
+    Buyers without any preferences can never be matched, and are left out of every component.
+    """
+    parent = list(range(market.neighborhood_count))
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    offsets = market.pref_offsets
+    pref_indices = market.pref_indices
+    for buyer in range(market.buyer_count):
+        start, end = offsets[buyer], offsets[buyer + 1]
+        if end - start < 2:
+            continue
+        root = find(pref_indices[start])
+        for k in range(start + 1, end):
+            other = find(pref_indices[k])
+            if other != root:
+                parent[other] = root
+
+    groups: Dict[int, Tuple[List[int], List[int]]] = {}
+    for n in range(market.neighborhood_count):
+        groups.setdefault(find(n), ([], []))[0].append(n)
+    for buyer in range(market.buyer_count):
+        if offsets[buyer] < offsets[buyer + 1]:
+            groups[find(pref_indices[offsets[buyer]])][1].append(buyer)
+    return list(groups.values())
+
+def _sub_market(market: Market, neighborhoods: List[int], buyers: List[int]) -> Market:
+    """The columns of one component, re-indexed from zero. Names are left behind."""
+    typecode = market.schema.typecode
+    local = {n: i for i, n in enumerate(neighborhoods)}
+    neighborhood_vectors = array(typecode)
+    for n in neighborhoods:
+        neighborhood_vectors.extend(market.neighborhood_vector(n))
+    buyer_vectors = array(typecode)
+    pref_offsets = array('q', [0])
+    pref_indices = array('i')
+    for buyer in buyers:
+        buyer_vectors.extend(market.buyer_vector(buyer))
+        pref_indices.extend(local[n] for n in market.buyer_prefs(buyer))
+        pref_offsets.append(len(pref_indices))
+    return Market(range(len(neighborhoods)), neighborhood_vectors, range(len(buyers)), buyer_vectors,
+                  pref_offsets, pref_indices, market.schema)
+
+def _solve(sub_market: Market, capacities: array, order: array,
+           counting: bool) -> Tuple[List[array], List[array], Optional[MatchStats]]:
+    stats = MatchStats() if counting else None
+    result = array_optimal_match(sub_market, capacities, order, stats=stats)
+    return result.members, result.member_fits, stats
+
+def partitioned_optimal_match(market: Market, workers: Optional[int] = None,
+                              capacities: Optional[Sequence[int]] = None,
+                              stats: Optional[MatchStats] = None) -> ArrayMatching:
+    """Solve each connected component of `market` separately, `workers` at a time.
+
+    With ``workers=1`` the components are solved one after another in this process. The result is the
+    same `ArrayMatching` that `engine.array_optimal_match` would return for the whole market. Any `stats`
+    are summed over the components, so their phase times are total worker time.
+    """
+    if capacities is None:
+        capacities = market.capacities()
+    order = engine.proposal_order(market)
+    position = array('q', [0]) * market.buyer_count
+    for i, buyer in enumerate(order):
+        position[buyer] = i
+
+    jobs = []
+    for neighborhoods, buyers in components(market):
+        if not buyers:
+            continue
+        local = {b: i for i, b in enumerate(buyers)}
+        sub_order = array('i', [local[b] for b in sorted(buyers, key=position.__getitem__)])
+        sub_capacities = array('q', [capacities[n] for n in neighborhoods])
+        jobs.append((neighborhoods, buyers,
+                     (_sub_market(market, neighborhoods, buyers), sub_capacities, sub_order, stats is not None)))
+    # start the biggest components first, so a large one doesn't finish last on its own
+    jobs.sort(key=lambda job: len(job[1]), reverse=True)
+
+    if workers == 1 or len(jobs) < 2:
+        results = [_solve(*arguments) for _, _, arguments in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_solve, *arguments) for _, _, arguments in jobs]
+            results = [future.result() for future in futures]
+
+    members = [array('i') for _ in range(market.neighborhood_count)]
+    member_fits = [array(market.schema.fit_typecode) for _ in range(market.neighborhood_count)]
+    for (neighborhoods, buyers, _), (sub_members, sub_fits, sub_stats) in zip(jobs, results):
+        if stats is not None:
+            stats.merge(sub_stats)
+        for n, local_members, fits in zip(neighborhoods, sub_members, sub_fits):
+            members[n] = array('i', [buyers[b] for b in local_members])
+            member_fits[n] = fits
+    return ArrayMatching(market, array('q', capacities), members, member_fits)
+
+def match_players(buyers: List, neighborhoods: List, workers: Optional[int] = None,
+                  stats: Optional[MatchStats] = None) -> Dict:
+    """`engine.match_players`, solving each independent sub-market in its own worker."""
+    return engine.match_players(buyers, neighborhoods, stats=stats,
+                                solver=lambda market, stats: partitioned_optimal_match(market, workers, stats=stats))
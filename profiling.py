@@ -0,0 +1,243 @@
+"""Profiling a run, stage by stage.
+
+A `Profiler` is a `stats.MatchStats`, so it goes wherever one does, and every phase that `stats.timed`
+marks out – 'parse', 'setup', 'match', 'output' and the rest – becomes a separately profiled stage. For the
+object engine, 'parse' is `match.read_input_file`, building every buyer and their preferences; 'setup' is
+setting neighborhood capacities; 'match' is the proposal loop; and 'output' is writing the result.
+
+There are two modes:
+
+* 'cprofile' runs each stage under `cProfile`. It sees every call, which makes it exact but slow:
+  expect a run to take two or three times as long;
+* 'sample' looks at the profiled thread's stack every `interval` seconds from a background thread, and
+  only costs a few percent.
+
+Either way, closing the profiler writes two files per stage into its directory: ``STAGE.pstats``, which
+`pstats.Stats` and tools such as snakeviz load, and ``STAGE.collapsed``, one ``frame;frame;frame count``
+line per stack, which flame-graph tools such as ``flamegraph.pl`` and speedscope load. For cProfile, which
+records calls rather than stacks, the stacks are rebuilt from the call graph, splitting each function's
+time between its callees in proportion to what each call cost.
+cProfile also only sees calls made after a stage starts, so a stage's stacks begin below the function that
+started it, and that function's own time – the body of the proposal loop, for one – goes unrecorded; use
+'sample' to see it.
+
+    with Profiler('profile') as profiler:
+        matches = buyer_optimal_match(buyers, neighborhoods, stats=profiler)
+"""
+from collections import Counter
+import cProfile
+from contextlib import contextmanager
+import marshal
+import os
+import pstats
+import sys
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from stats import MatchStats
+
+MODES = ('sample', 'cprofile')
+# seconds between samples
+INTERVAL = 0.005
+# stacks deeper than this, or paths taking less than this many seconds, are cut short when stacks are
+# rebuilt from a call graph
+MAX_DEPTH = 64
+MIN_SECONDS = 1e-6
+
+# a function, as pstats identifies it: (file name, line number, function name)
+Function = Tuple[str, int, str]
+
+def _label(function: Function) -> str:
+    file_name, line, name = function
+    if file_name == '~':
+        # a built-in, as cProfile names it
+        return name
+    return f"{name} ({os.path.basename(file_name)}:{line})"
+
+class Profiler(MatchStats):
+    """Profiles each phase of a run, as well as timing it.
+
+    Parameters
+    ----------
+    directory : str
+        Where the results are written, when the profiler is closed.
+    mode : str
+        One of `MODES`.
+    interval : float
+        Seconds between samples, in 'sample' mode.
+    """
+
+    def __init__(self, directory: str, mode: str = 'sample', interval: float = INTERVAL) -> None:
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}; expected one of {MODES}")
+        super().__init__()
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.samples: Dict[str, Counter] = {}
+        # the stages being profiled, innermost last
+        self._stages: List[str] = []
+        self._thread: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __enter__(self) -> 'Profiler':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time and profile the enclosed block as the stage `name`.
+
+        A stage inside another one pauses the outer stage's profile, so every moment is counted once.
+        """
+        outer = self._stages[-1] if self._stages else None
+        if self.mode == 'cprofile':
+            if outer is not None:
+                self.profiles[outer].disable()
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        else:
+            self._start_sampling()
+            self.samples.setdefault(name, Counter())
+        self._stages.append(name)
+        try:
+            with super().phase(name):
+                if self.mode == 'cprofile':
+                    profile.enable()
+                try:
+                    yield
+                finally:
+                    if self.mode == 'cprofile':
+                        profile.disable()
+        finally:
+            self._stages.pop()
+            if outer is not None and self.mode == 'cprofile':
+                self.profiles[outer].enable()
+
+    def _start_sampling(self) -> None:
+        if self._sampler is not None:
+            return
+        self._thread = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                stage = self._stages[-1]
+            except IndexError:
+                # between stages
+                continue
+            frame = sys._current_frames().get(self._thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            self.samples[stage][tuple(reversed(stack))] += 1
+
+    def close(self) -> None:
+        """Stop sampling, and write the results of every stage."""
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        os.makedirs(self.directory, exist_ok=True)
+        for stage in list(self.profiles) + list(self.samples):
+            if stage in self.profiles:
+                profile = self.profiles[stage]
+                profile.dump_stats(os.path.join(self.directory, f"{stage}.pstats"))
+                stacks = collapse_call_graph(pstats.Stats(profile).stats)
+            else:
+                stacks = self._sampled_stacks(stage)
+            write_collapsed(os.path.join(self.directory, f"{stage}.collapsed"), stacks)
+
+    def _sampled_stacks(self, stage: str) -> Dict[str, int]:
+        """Write the samples of `stage` as pstats, and return its collapsed stacks."""
+        samples = self.samples[stage]
+        # a busy thread holds on to the GIL, so samples come less often than `interval`; each stands for an
+        # equal share of the stage's measured time instead
+        total = sum(samples.values())
+        per_sample = self.phases.get(stage, 0.0) / total if total else self.interval
+        # pstats' own layout: function -> (primitive calls, calls, own time, cumulative time, callers), where
+        # callers maps each caller to the same four numbers for the calls it made
+        functions: Dict[Function, list] = {}
+        stacks: Dict[str, int] = {}
+        for stack, count in samples.items():
+            seconds = count * per_sample
+            for depth, function in enumerate(stack):
+                entry = functions.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                if function not in stack[:depth]:
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth:
+                    edge = entry[4].setdefault(stack[depth - 1], [0, 0, 0.0, 0.0])
+                    edge[0] += count
+                    edge[1] += count
+                    edge[3] += seconds
+                    if depth == len(stack) - 1:
+                        edge[2] += seconds
+            functions[stack[-1]][2] += seconds
+            label = ';'.join(_label(function) for function in stack)
+            stacks[label] = stacks.get(label, 0) + count
+        with open(os.path.join(self.directory, f"{stage}.pstats"), 'wb') as output_file:
+            marshal.dump({function: (entry[0], entry[1], entry[2], entry[3],
+                                     {caller: tuple(edge) for caller, edge in entry[4].items()})
+                          for function, entry in functions.items()}, output_file)
+        return stacks
+
+def collapse_call_graph(stats: Dict[Function, tuple]) -> Dict[str, int]:
+    """Collapsed stacks, in microseconds, rebuilt from a pstats call graph.
+
+    Each function's time is split between the paths that reach it in proportion to the cumulative time of
+    each call, the way gprof-style tools do; recursion is cut off where a function reappears on its own
+    path, and so are paths too deep or too brief to show up in a flame graph.
+    """
+    callees: Dict[Function, List[Tuple[Function, float]]] = {}
+    roots = []
+    for function, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+    # functions whose callers weren't profiled start stacks of their own
+    roots += [caller for caller in callees if caller not in stats]
+
+    stacks: Dict[str, int] = {}
+
+    def visit(function: Function, path: List[str], on_path: set, seconds: float) -> None:
+        label = ';'.join(path)
+        entry = stats.get(function)
+        cumulative = entry[3] if entry else sum(edge for _, edge in callees.get(function, []))
+        if cumulative <= 0:
+            return
+        own = seconds * (entry[2] / cumulative) if entry else 0.0
+        for callee, edge in callees.get(function, []):
+            share = seconds * edge / cumulative
+            if callee in on_path or len(path) >= MAX_DEPTH or share < MIN_SECONDS:
+                own += share
+                continue
+            on_path.add(callee)
+            path.append(_label(callee))
+            visit(callee, path, on_path, share)
+            path.pop()
+            on_path.discard(callee)
+        microseconds = int(round(own * 1e6))
+        if microseconds > 0:
+            stacks[label] = stacks.get(label, 0) + microseconds
+
+    for root in roots:
+        entry = stats.get(root)
+        seconds = entry[3] if entry else sum(edge for _, edge in callees.get(root, []))
+        visit(root, [_label(root)], {root}, seconds)
+    return stacks
+
+def write_collapsed(file_name: str, stacks: Dict[str, int]) -> None:
+    """Write ``frame;frame;frame count`` lines, heaviest first."""
+    with open(file_name, 'w') as output_file:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            output_file.write(f"{stack} {count}\n")
@@ -0,0 +1,399 @@
+"""Streaming readers that parse an input file straight into a columnar `Market`.
+
+`match.read_input_file` keeps every homebuyer line in memory and then builds a `Homebuyer` per line,
+which costs many times the size of the data itself. The readers here instead:
+
+1. make a first pass over the file that only parses the ``N`` lines, and then
+2. parse the ``H`` lines in fixed-size batches, appending each buyer straight onto the market's columns.
+
+`read_market` does this either by reading the file line by line ('stream') or by memory-mapping it and
+scanning the mapped bytes ('mmap'). Either way the peak memory is bounded by the column storage plus one
+batch of lines.
+
+The 'parallel' reader spreads the second pass over a pool of processes. It finds the ``N`` lines by
+searching the memory-mapped file for them, then splits the file into byte ranges that end on line
+boundaries, and each worker parses the ``H`` lines of one range into columns of its own, with the
+neighborhood-name→index table sent to it once, when it starts. The columns are then appended to the
+market's in file order, so names, duplicates and dropped preferences come out as they would from a single
+pass.
+
+The readers accept exactly what `read_input_file` accepts: lines are classified by their first character,
+tokens are upper-cased (ASCII only, as the readers work on bytes), duplicate names keep the position of
+their first appearance and the data of their last, and preferences for unknown neighborhoods are dropped.
+An ``S`` line, if there is one, declares the market's `vector.Schema` and must come before any ``N`` line,
+and an ``N`` line's ``C:`` token, if it has one, is its capacity.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import mmap
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import zlib
+
+import exceptions
+from market import Market, NameTable
+from vector import CAPACITY_KEY, PEARL, Schema, parse_capacity
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+READERS = ('stream', 'mmap', 'parallel')
+# the size of the byte ranges the 'parallel' reader hands its workers; there's at least one per worker
+RANGE_BYTES = 1 << 26
+VECTOR_KEYS = (b'E', b'W', b'R')
+
+def peak_memory() -> Optional[int]:
+    """The peak resident set size of this process in bytes, where the platform reports it."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _tokens(line: bytes, type_indicator: bytes) -> List[bytes]:
+    tokens = line.rstrip().upper().split(b' ')
+    if tokens[0] != type_indicator:
+        raise exceptions.DataParsingError(line.decode(errors='replace'))
+    return tokens[1:]
+
+def _vector(tokens: List[bytes], line: bytes, schema: Schema) -> Tuple:
+    if schema is not PEARL:
+        return tuple(schema.values(tokens, line.decode(errors='replace')))
+    values = {}
+    for token in tokens:
+        key, value = token.split(b':')
+        values[key] = int(value)
+    try:
+        return tuple(values[key] for key in VECTOR_KEYS)
+    except KeyError:
+        raise exceptions.DataParsingError(line.decode(errors='replace'))
+
+def parse_schema(line: bytes) -> Schema:
+    """Parse an ``S`` line into the schema it declares."""
+    try:
+        return Schema.from_tokens([token.decode() for token in _tokens(line, b'S')])
+    except ValueError:
+        raise exceptions.DataParsingError(line.decode(errors='replace'))
+
+def parse_neighborhood(line: bytes, schema: Schema = PEARL) -> Tuple[bytes, Tuple, Optional[int]]:
+    """Parse an ``N`` line into its name, characteristics and capacity, which is ``None`` if it has none."""
+    name = None
+    values = []
+    capacity = None
+    capacity_key = CAPACITY_KEY.encode() + b':' if CAPACITY_KEY not in schema.index else None
+    for token in _tokens(line, b'N'):
+        if capacity_key is not None and token.startswith(capacity_key):
+            try:
+                capacity = parse_capacity(token[len(capacity_key):])
+            except ValueError:
+                raise exceptions.DataParsingError(line.decode(errors='replace'))
+        elif b':' in token:
+            values.append(token)
+        else:
+            name = token
+    return name, _vector(values, line, schema), capacity
+
+def parse_buyer(line: bytes, schema: Schema = PEARL) -> Tuple[bytes, Tuple, List[bytes]]:
+    """Parse an ``H`` line into its name, goals and the names of its preferred neighborhoods."""
+    name = None
+    values = []
+    preference_string = None
+    for token in _tokens(line, b'H'):
+        if b':' in token:
+            values.append(token)
+        elif b'>' in token:
+            preference_string = token
+        else:
+            name = token
+    if preference_string is None:
+        raise exceptions.DataParsingError(line.decode(errors='replace'))
+    return name, _vector(values, line, schema), preference_string.split(b'>')
+
+class MarketBuilder:
+    """Accumulates neighborhoods and buyers into the columns of a `Market`.
+
+    Buyers are appended as they arrive. Names are only checked for duplicates once every buyer has
+    been added, by way of a compact column of name hashes, so that we never need a dictionary holding
+    every buyer's name.
+    """
+
+    def __init__(self, schema: Schema = PEARL) -> None:
+        self.schema = schema
+        self.neighborhoods: Dict[bytes, Tuple] = {}
+        self.capacities: Dict[bytes, int] = {}
+        self.index: Dict[bytes, int] = {}
+        self.buyer_names = NameTable()
+        self.buyer_vectors = array(schema.typecode)
+        self.pref_offsets = array('q', [0])
+        self.pref_indices = array('i')
+        self.name_hashes = array('I')
+
+    def set_schema(self, schema: Schema) -> None:
+        """Declare the market's schema; this must happen before anything is added."""
+        if self.neighborhoods or self.buyer_names:
+            raise ValueError("A market's schema must be declared before any neighborhood or buyer")
+        self.schema = schema
+        self.buyer_vectors = array(schema.typecode)
+
+    def add_neighborhood(self, name: bytes, vector: Tuple, capacity: Optional[int] = None) -> None:
+        # a redefined neighborhood keeps its original position, as it would in a dictionary
+        if name not in self.index:
+            self.index[name] = len(self.index)
+        self.neighborhoods[name] = vector
+        if capacity is None:
+            self.capacities.pop(name, None)
+        else:
+            self.capacities[name] = capacity
+
+    def add_buyer(self, name: bytes, vector: Iterable, preferences: Iterable[bytes]) -> None:
+        index = self.index
+        self.buyer_names.append(name)
+        self.name_hashes.append(zlib.crc32(name))
+        self.buyer_vectors.extend(vector)
+        self.pref_indices.extend(index[key] for key in preferences if key in index)
+        self.pref_offsets.append(len(self.pref_indices))
+
+    def extend(self, other: 'MarketBuilder') -> None:
+        """Append the buyers of `other`, which was given the same neighborhoods, after those already added."""
+        names = self.buyer_names
+        names.offsets.extend(_shifted(other.buyer_names.offsets[1:], len(names.blob)))
+        names.blob += other.buyer_names.blob
+        self.name_hashes.extend(other.name_hashes)
+        self.buyer_vectors.extend(other.buyer_vectors)
+        self.pref_offsets.extend(_shifted(other.pref_offsets[1:], len(self.pref_indices)))
+        self.pref_indices.extend(other.pref_indices)
+
+    def _duplicates(self) -> Dict[int, int]:
+        """Map the first row of every duplicated buyer name to the row of its last definition.
+
+        Later rows of a duplicated name map to -1, meaning they are dropped.
+        """
+        hashes = self.name_hashes
+        rows = sorted(range(len(hashes)), key=hashes.__getitem__)
+        replacements: Dict[int, int] = {}
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            while end < len(rows) and hashes[rows[end]] == hashes[rows[start]]:
+                end += 1
+            if end - start > 1:
+                # equal hashes might still be different names
+                by_name: Dict[bytes, List[int]] = {}
+                for row in sorted(rows[start:end]):
+                    by_name.setdefault(self.buyer_names.raw(row), []).append(row)
+                for same in by_name.values():
+                    if len(same) > 1:
+                        replacements[same[0]] = same[-1]
+                        for row in same[1:]:
+                            replacements.setdefault(row, -1)
+            start = end
+        return replacements
+
+    def build(self) -> Market:
+        typecode = self.schema.typecode
+        neighborhood_vectors = array(typecode)
+        for vector in self.neighborhoods.values():
+            neighborhood_vectors.extend(vector)
+        names, vectors, offsets, indices = self.buyer_names, self.buyer_vectors, self.pref_offsets, self.pref_indices
+
+        replacements = self._duplicates()
+        if replacements:
+            dims = self.schema.dims
+            names, vectors, offsets, indices = NameTable(), array(typecode), array('q', [0]), array('i')
+            for row in range(len(self.buyer_names)):
+                source = replacements.get(row, row)
+                if source < 0:
+                    continue
+                names.append(self.buyer_names.raw(row))
+                vectors.extend(self.buyer_vectors[source * dims:(source + 1) * dims])
+                indices.extend(self.pref_indices[self.pref_offsets[source]:self.pref_offsets[source + 1]])
+                offsets.append(len(indices))
+
+        capacities = None
+        if self.capacities:
+            capacities = array('q', [self.capacities.get(name, -1) for name in self.neighborhoods])
+
+        return Market(
+            neighborhood_names=[name.decode() for name in self.neighborhoods],
+            neighborhood_vectors=neighborhood_vectors,
+            buyer_names=names,
+            buyer_vectors=vectors,
+            pref_offsets=offsets,
+            pref_indices=indices,
+            schema=self.schema,
+            neighborhood_capacities=capacities,
+        )
+
+def _shifted(offsets: array, base: int) -> array:
+    """`offsets`, each plus `base`."""
+    if numpy is not None:
+        shifted = array('q')
+        shifted.frombytes((numpy.frombuffer(offsets, dtype=numpy.int64) + base).tobytes())
+        return shifted
+    return array('q', [offset + base for offset in offsets])
+
+def iter_lines(file_name: str, use_mmap: bool = False) -> Iterator[bytes]:
+    """Every line of the file, as bytes, either read through a buffered file or from a memory map."""
+    with open(file_name, 'rb') as input_file:
+        if not use_mmap:
+            yield from input_file
+            return
+        try:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            return
+        with mapped:
+            position = 0
+            size = len(mapped)
+            while position < size:
+                end = mapped.find(b'\n', position)
+                end = size if end < 0 else end + 1
+                yield mapped[position:end]
+                position = end
+
+def iter_buyer_batches(lines: Iterable[bytes], batch_size: int) -> Iterator[List[bytes]]:
+    """The ``H`` lines, gathered into lists of at most `batch_size`."""
+    batch = []
+    for line in lines:
+        if line[:1] == b'H':
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def _header_lines(mapped: mmap.mmap) -> List[bytes]:
+    """The ``S`` and ``N`` lines of a memory-mapped file, in order, found without looking at any other line."""
+    starts = []
+    for kind in (b'S', b'N'):
+        if mapped[:1] == kind:
+            starts.append(0)
+        position = mapped.find(b'\n' + kind)
+        while position >= 0:
+            starts.append(position + 1)
+            position = mapped.find(b'\n' + kind, position + 1)
+    lines = []
+    for start in sorted(starts):
+        end = mapped.find(b'\n', start)
+        lines.append(mapped[start:end + 1 if end >= 0 else len(mapped)])
+    return lines
+
+def _byte_ranges(mapped: mmap.mmap, count: int) -> List[Tuple[int, int]]:
+    """Split a memory-mapped file into about `count` ranges of whole lines."""
+    size = len(mapped)
+    ranges = []
+    start = 0
+    for i in range(1, count + 1):
+        end = size if i == count else mapped.find(b'\n', max(start, size * i // count)) + 1
+        if end <= 0:
+            end = size
+        if end > start:
+            ranges.append((start, end))
+        start = end
+        if start >= size:
+            break
+    return ranges
+
+# the neighborhood index and schema of the market a 'parallel' worker parses for, set by `_start_worker`
+_worker_index: Dict[bytes, int] = {}
+_worker_schema: Schema = PEARL
+
+def _start_worker(index: Dict[bytes, int], schema: Schema) -> None:
+    global _worker_index, _worker_schema
+    _worker_index = index
+    _worker_schema = schema
+
+def _parse_range(file_name: str, start: int, end: int) -> MarketBuilder:
+    """Parse the ``H`` lines in a byte range of the file into the columns of a `MarketBuilder`."""
+    builder = MarketBuilder(_worker_schema)
+    builder.index = _worker_index
+    with open(file_name, 'rb') as input_file:
+        input_file.seek(start)
+        data = input_file.read(end - start)
+    for line in data.split(b'\n'):
+        if line[:1] == b'H':
+            builder.add_buyer(*parse_buyer(line, _worker_schema))
+    # the index came from the parent, which has it already
+    builder.index = {}
+    return builder
+
+def read_market_parallel(file_name: str, workers: Optional[int] = None) -> Market:
+    """Read an input file into a `Market`, parsing its ``H`` lines in `workers` processes."""
+    workers = workers or os.cpu_count() or 1
+    builder = MarketBuilder()
+    with open(file_name, 'rb') as input_file:
+        try:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            return builder.build()
+        with mapped:
+            for line in _header_lines(mapped):
+                if line[:1] == b'N':
+                    builder.add_neighborhood(*parse_neighborhood(line, builder.schema))
+                elif builder.neighborhoods:
+                    raise exceptions.DataParsingError(line.decode(errors='replace'))
+                else:
+                    builder.set_schema(parse_schema(line))
+            ranges = _byte_ranges(mapped, max(workers, -(-len(mapped) // RANGE_BYTES)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker,
+                             initargs=(builder.index, builder.schema)) as executor:
+        for columns in executor.map(_parse_range, [file_name] * len(ranges), *zip(*ranges)):
+            builder.extend(columns)
+    return builder.build()
+
+def read_market(file_name: str, mode: str = 'stream', batch_size: int = 65536,
+                workers: Optional[int] = None) -> Market:
+    """Read an input file into a `Market`, without building any player objects.
+
+    Parameters
+    ----------
+    file_name : str
+        The input file.
+    mode : str
+        'stream' to read the file line by line, 'mmap' to scan a memory map of it, 'parallel' to parse it in
+        a pool of processes.
+    batch_size : int
+        The number of ``H`` lines parsed together.
+    workers : Optional[int]
+        The number of processes the 'parallel' reader uses; one per CPU by default.
+    """
+    if mode not in READERS:
+        raise ValueError(f"Unknown reader {mode!r}; expected one of {READERS}")
+    if mode == 'parallel':
+        market = read_market_parallel(file_name, workers)
+        logger.info("read %s: %d bytes of columns, peak memory %s bytes", market, market.nbytes, peak_memory())
+        return market
+    use_mmap = mode == 'mmap'
+
+    builder = MarketBuilder()
+    for line in iter_lines(file_name, use_mmap):
+        if line[:1] == b'N':
+            builder.add_neighborhood(*parse_neighborhood(line, builder.schema))
+        elif line[:1] == b'S':
+            if builder.neighborhoods:
+                raise exceptions.DataParsingError(line.decode(errors='replace'))
+            builder.set_schema(parse_schema(line))
+
+    schema = builder.schema
+    for batch in iter_buyer_batches(iter_lines(file_name, use_mmap), batch_size):
+        for line in batch:
+            builder.add_buyer(*parse_buyer(line, schema))
+
+    market = builder.build()
+    logger.info("read %s: %d bytes of columns, peak memory %s bytes", market, market.nbytes, peak_memory())
+    return market
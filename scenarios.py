@@ -0,0 +1,381 @@
+"""What-if scenarios, solved against one parsed market.
+
+Analysts ask many questions of the form "what if N2's resilience were 9?", and answering each by editing the
+input file and re-running everything repeats nearly all of the work. A `ScenarioRunner` parses and solves
+the market once, and then for each scenario only patches what the scenario changes:
+
+* the fit of every preference stays as it is unless the preference is for a neighborhood whose
+  characteristics the scenario overrides, or belongs to a buyer it adds or replaces;
+* the buyers' preference columns are shared with the baseline unless the scenario adds, replaces or removes
+  buyers;
+
+and then solves the scenario with `engine.array_optimal_match`, in a pool of worker processes when there
+are several. Each scenario's result is reported as a `ScenarioDiff` against the baseline: only the buyers
+whose neighborhood changed.
+
+A scenario gives the result that re-running ``match.py`` on an edited input file would: removed buyers'
+lines are deleted, added buyers' lines are appended, and a capacity override is declared on its
+neighborhood's line, so the buyers the declared capacities leave over are split evenly among the other
+neighborhoods. Scenarios are read from a deltas file, where each starts with a ``SCENARIO`` line and is
+followed by any of::
+
+    SCENARIO resilient_n2
+    N N2 R:9                      # override some of a neighborhood's characteristics
+    C N2 5                        # override a neighborhood's capacity
+    H H99 E:1 W:2 R:3 N0>N2       # add a buyer, or replace the one with that name
+    R H3                          # remove a buyer
+
+Other lines are ignored, as in the input file.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from engine import array_optimal_match
+import exceptions
+from fits import gather_fits, preference_fits, refit
+from market import Market, NameTable
+import reader
+from vector import PEARL
+
+class Scenario:
+    """A set of changes to a market.
+
+    Attributes
+    ----------
+    name : str
+        What the scenario is called.
+    characteristics : Dict[str, Dict[str, object]]
+        For each neighborhood overridden, its new values by key; keys not given keep their values.
+    capacities : Dict[str, int]
+        Capacity overrides, by neighborhood name.
+    added : List[Tuple[str, Tuple, List[str]]]
+        Buyers to add, as (name, goals, preferred neighborhood names); a buyer already in the market
+        with the same name is replaced in place.
+    removed : List[str]
+        The names of buyers to remove.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.characteristics: Dict[str, Dict[str, object]] = {}
+        self.capacities: Dict[str, int] = {}
+        self.added: List[Tuple[str, Tuple, List[str]]] = []
+        self.removed: List[str] = []
+
+    def __repr__(self):
+        return f"Scenario({self.name})"
+
+class ScenarioDiff:
+    """How a scenario's matching differs from the baseline's.
+
+    Attributes
+    ----------
+    name : str
+        The scenario's name.
+    moved : List[Tuple[str, Optional[str], Optional[str]]]
+        (buyer, neighborhood before, neighborhood after) for every buyer in both markets whose match
+        changed; ``None`` means unmatched.
+    added : List[Tuple[str, Optional[str]]]
+        (buyer, neighborhood) for every buyer the scenario added.
+    removed : List[Tuple[str, Optional[str]]]
+        (buyer, neighborhood before) for every buyer the scenario removed.
+    seconds : float
+        How long the scenario took to patch and solve.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.moved: List[Tuple[str, Optional[str], Optional[str]]] = []
+        self.added: List[Tuple[str, Optional[str]]] = []
+        self.removed: List[Tuple[str, Optional[str]]] = []
+        self.seconds = 0.0
+
+    def __str__(self):
+        def show(neighborhood):
+            return 'unmatched' if neighborhood is None else neighborhood
+
+        lines = [f"SCENARIO {self.name}: {len(self.moved)} moved, {len(self.added)} added, "
+                 f"{len(self.removed)} removed"]
+        lines += [f"  {buyer}: {show(before)} -> {show(after)}" for buyer, before, after in self.moved]
+        lines += [f"  + {buyer}: {show(after)}" for buyer, after in self.added]
+        lines += [f"  - {buyer}: {show(before)}" for buyer, before in self.removed]
+        return '\n'.join(lines)
+
+def read_scenarios(file_name: str, schema=None) -> List[Scenario]:
+    """Read the scenarios in a deltas file, whose values follow `schema` (E/W/R by default)."""
+    schema = schema or PEARL
+    scenarios: List[Scenario] = []
+    with open(file_name, 'rb') as deltas:
+        for line in deltas:
+            tokens = line.split()
+            if not tokens:
+                continue
+            kind = tokens[0].upper()
+            if kind == b'SCENARIO':
+                if len(tokens) != 2:
+                    raise exceptions.DataParsingError(line.decode(errors='replace'))
+                scenarios.append(Scenario(tokens[1].decode()))
+                continue
+            if kind not in (b'N', b'C', b'H', b'R'):
+                continue
+            if not scenarios:
+                raise exceptions.DataParsingError(line.decode(errors='replace'))
+            scenario = scenarios[-1]
+            try:
+                if kind == b'N':
+                    _override(scenario, line.upper().split(), schema)
+                elif kind == b'C':
+                    _, name, capacity = line.upper().split()
+                    scenario.capacities[name.decode()] = int(capacity)
+                elif kind == b'H':
+                    name, goals, preferences = reader.parse_buyer(line.upper(), schema)
+                    scenario.added.append((name.decode(), goals, [key.decode() for key in preferences]))
+                else:
+                    _, name = line.upper().split()
+                    scenario.removed.append(name.decode())
+            except ValueError:
+                raise exceptions.DataParsingError(line.decode(errors='replace'))
+    return scenarios
+
+def _override(scenario: Scenario, tokens: List[bytes], schema) -> None:
+    values = {}
+    name = None
+    for token in tokens[1:]:
+        if b':' in token:
+            key, value = token.decode().split(':')
+            if key not in schema.index:
+                raise ValueError(f"Unknown key {key}")
+            values[key] = schema.convert(value)
+        else:
+            name = token.decode()
+    if name is None:
+        raise ValueError("A neighborhood override needs a name")
+    scenario.characteristics.setdefault(name, {}).update(values)
+
+class ScenarioRunner:
+    """Solves scenarios against a market, sharing everything they leave unchanged.
+
+    Parameters
+    ----------
+    market : Market
+        The baseline market.
+    fits : array
+        The fit of every preference in `market`, as `fits.preference_fits` computes them.
+    baseline : ArrayMatching
+        The baseline matching; only its ``buyer_match`` is used.
+    workers : Optional[int]
+        Worker processes to spread scenarios over; one per CPU by default, or 1 to solve in this process.
+
+    `ScenarioRunner.from_market` computes the fits and the baseline from the market alone.
+    """
+
+    def __init__(self, market: Market, fits: array, baseline, workers: Optional[int] = None) -> None:
+        self.market = market
+        self.workers = workers
+        self.fits = fits
+        self.baseline = baseline
+        self.neighborhood_index = {name: n for n, name in enumerate(market.neighborhood_names)}
+        self._buyer_index: Optional[Dict[str, int]] = None
+
+    @classmethod
+    def from_market(cls, market: Market, workers: Optional[int] = None, fits: Optional[array] = None,
+                    baseline=None) -> 'ScenarioRunner':
+        """A runner for a parsed market, computing its fits and solving its baseline unless they're given.
+
+        `baseline` needs only the ``buyer_match`` of the market's `engine.ArrayMatching`.
+        """
+        if fits is None:
+            fits = preference_fits(market)
+        if baseline is None:
+            baseline = array_optimal_match(market, fits=fits)
+        return cls(market, fits, baseline, workers)
+
+    @property
+    def buyer_index(self) -> Dict[str, int]:
+        # only needed for scenarios that add or remove buyers
+        if self._buyer_index is None:
+            self._buyer_index = {name: b for b, name in enumerate(self.market.buyer_names)}
+        return self._buyer_index
+
+    def _neighborhood(self, name: str) -> int:
+        if name not in self.neighborhood_index:
+            raise ValueError(f"No neighborhood {name!r} in the market")
+        return self.neighborhood_index[name]
+
+    def apply(self, scenario: Scenario) -> Tuple[Market, array, array, array]:
+        """The scenario's market, its fits, its capacities, and the baseline index of each of its buyers.
+
+        Buyers the scenario adds have a baseline index of -1.
+        """
+        market = self.market
+        dims = market.dims
+        schema = market.schema
+
+        fits = self.fits
+        neighborhood_vectors = market.neighborhood_vectors
+        if scenario.characteristics:
+            neighborhood_vectors = array(schema.typecode, neighborhood_vectors)
+            changed = []
+            for name, values in scenario.characteristics.items():
+                n = self._neighborhood(name)
+                for key, value in values.items():
+                    neighborhood_vectors[n * dims + schema.index[key]] = value
+                changed.append(n)
+            fits = refit(market, fits, changed, neighborhood_vectors)
+
+        buyer_names = market.buyer_names
+        buyer_vectors = market.buyer_vectors
+        pref_offsets = market.pref_offsets
+        pref_indices = market.pref_indices
+        baseline_index = array('i', range(market.buyer_count))
+        if scenario.added or scenario.removed:
+            removed = set()
+            for name in scenario.removed:
+                if name not in self.buyer_index:
+                    raise ValueError(f"No buyer {name!r} in the market")
+                removed.add(self.buyer_index[name])
+            replaced: Dict[int, int] = {}
+            rows: List[Tuple[str, Tuple, List[int]]] = []
+            appended = []
+            for name, goals, preferences in scenario.added:
+                indices = [self.neighborhood_index[key] for key in preferences if key in self.neighborhood_index]
+                b = self.buyer_index.get(name)
+                if b is not None and b not in removed:
+                    replaced[b] = len(rows)
+                else:
+                    appended.append(len(rows))
+                rows.append((name, goals, indices))
+            row_offsets = array('q', [0])
+            row_indices = array('i')
+            row_vectors = array(schema.typecode)
+            for _, goals, indices in rows:
+                row_vectors.extend(goals)
+                row_indices.extend(indices)
+                row_offsets.append(len(row_indices))
+            row_fits = array(fits.typecode, gather_fits(row_vectors, neighborhood_vectors, row_offsets, row_indices,
+                                                        dims, schema.weights))
+
+            buyer_names = NameTable()
+            buyer_vectors = array(schema.typecode)
+            pref_offsets = array('q', [0])
+            pref_indices = array('i')
+            scenario_fits = array(fits.typecode)
+            baseline_index = array('i')
+
+            def add_row(row, baseline):
+                name, goals, indices = rows[row]
+                buyer_names.append(name)
+                buyer_vectors.extend(goals)
+                pref_indices.extend(indices)
+                pref_offsets.append(len(pref_indices))
+                scenario_fits.extend(row_fits[row_offsets[row]:row_offsets[row + 1]])
+                baseline_index.append(baseline)
+
+            offsets = market.pref_offsets
+            for b in range(market.buyer_count):
+                if b in removed:
+                    continue
+                if b in replaced:
+                    add_row(replaced[b], b)
+                    continue
+                buyer_names.append(market.buyer_names[b])
+                buyer_vectors.extend(market.buyer_vector(b))
+                pref_indices.extend(market.buyer_prefs(b))
+                pref_offsets.append(len(pref_indices))
+                scenario_fits.extend(fits[offsets[b]:offsets[b + 1]])
+                baseline_index.append(b)
+            for row in appended:
+                add_row(row, -1)
+            fits = scenario_fits
+
+        # overrides count as declared capacities, so the buyers they leave over are split among the rest
+        neighborhood_capacities = market.neighborhood_capacities
+        if scenario.capacities:
+            if neighborhood_capacities is None:
+                neighborhood_capacities = array('q', [-1]) * market.neighborhood_count
+            else:
+                neighborhood_capacities = array('q', neighborhood_capacities)
+            for name, capacity in scenario.capacities.items():
+                neighborhood_capacities[self._neighborhood(name)] = capacity
+        scenario_market = Market(market.neighborhood_names, neighborhood_vectors, buyer_names, buyer_vectors,
+                                 pref_offsets, pref_indices, schema, neighborhood_capacities)
+        return scenario_market, fits, scenario_market.capacities(), baseline_index
+
+    def solve(self, scenario: Scenario) -> ScenarioDiff:
+        """Solve one scenario, in this process."""
+        start = time.perf_counter()
+        scenario_market, fits, capacities, baseline_index = self.apply(scenario)
+        result = array_optimal_match(scenario_market, capacities, fits=fits)
+
+        diff = ScenarioDiff(scenario.name)
+        names = self.market.neighborhood_names
+
+        def name_of(neighborhood):
+            return None if neighborhood < 0 else names[neighborhood]
+
+        before = self.baseline.buyer_match
+        present = set()
+        for b, (baseline, after) in enumerate(zip(baseline_index, result.buyer_match)):
+            if baseline < 0:
+                diff.added.append((scenario_market.buyer_names[b], name_of(after)))
+                continue
+            present.add(baseline)
+            if before[baseline] != after:
+                diff.moved.append((scenario_market.buyer_names[b], name_of(before[baseline]), name_of(after)))
+        if len(present) < self.market.buyer_count:
+            for b in range(self.market.buyer_count):
+                if b not in present:
+                    diff.removed.append((self.market.buyer_names[b], name_of(before[b])))
+        diff.seconds = time.perf_counter() - start
+        return diff
+
+    def run(self, scenarios: Sequence[Scenario]) -> List[ScenarioDiff]:
+        """Solve every scenario, spread over the worker processes, in order."""
+        if self.workers == 1 or len(scenarios) < 2:
+            return [self.solve(scenario) for scenario in scenarios]
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_start_worker,
+                                 initargs=(_portable(self.market), self.fits, self.baseline.buyer_match)) as executor:
+            return list(executor.map(_solve, scenarios))
+
+def write_diffs(file_name: Optional[str], diffs: Sequence[ScenarioDiff]) -> None:
+    """Write every diff, one after another, to stdout if there's no `file_name`."""
+    if not file_name:
+        for diff in diffs:
+            print(diff)
+        return
+    with open(file_name, 'w') as output_file:
+        for diff in diffs:
+            output_file.write(f"{diff}\n")
+
+# the runner in each worker process, set up once by `_start_worker`
+_runner: Optional[ScenarioRunner] = None
+
+def _portable(market: Market) -> Market:
+    """`market` with any memory-mapped columns copied, so that it can be sent to another process."""
+    def names(table):
+        if isinstance(table, NameTable) and isinstance(table.blob, memoryview):
+            return NameTable(bytes(table.blob), array('q', table.offsets))
+        return table
+
+    def column(values, typecode):
+        return array(typecode, values) if isinstance(values, memoryview) else values
+
+    return Market(names(market.neighborhood_names), column(market.neighborhood_vectors, market.schema.typecode),
+                  names(market.buyer_names), column(market.buyer_vectors, market.schema.typecode),
+                  column(market.pref_offsets, 'q'), column(market.pref_indices, 'i'), market.schema,
+                  None if market.neighborhood_capacities is None else column(market.neighborhood_capacities, 'q'))
+
+def _start_worker(market: Market, fits: array, baseline_match: array) -> None:
+    global _runner
+    _runner = ScenarioRunner.from_market(market, workers=1, fits=fits, baseline=_Baseline(baseline_match))
+
+def _solve(scenario: Scenario) -> ScenarioDiff:
+    return _runner.solve(scenario)
+
+class _Baseline:
+    """As much of the baseline `ArrayMatching` as a worker needs."""
+
+    def __init__(self, buyer_match: array) -> None:
+        self.buyer_match = buyer_match
@@ -0,0 +1,392 @@
+"""A long-running matching server, with markets kept warm between requests.
+
+Every run of ``match.py`` re-imports its modules, re-parses the market and recomputes every fit, even when
+all that changed is the question asked of it. ``match.py serve`` instead keeps parsed markets and their fits
+resident, and answers requests over a local socket – a Unix socket, or TCP on localhost.
+
+The protocol is line-delimited JSON: each request is one JSON object on a line, and each gets one JSON
+object back on a line, ``{"ok": true, ...}`` or ``{"ok": false, "error": "..."}``, echoing the request's
+``id`` if it had one. The operations are:
+
+* ``{"op": "load", "market": NAME, "path": FILE, "reader": "stream"}`` parses an input file, or
+  ``{"op": "load", "market": NAME, "snapshot": FILE}`` maps a snapshot, and keeps it as NAME;
+* ``{"op": "match", "market": NAME, "capacities": [...]}`` solves it, with the given capacities or the
+  market's own, and optionally writes the result with ``"output"`` and ``"format"`` as the CLI would;
+* ``{"op": "assignment", "market": NAME, "buyers": [...]}`` looks up buyers in the latest solution;
+* ``{"op": "unload", "market": NAME}`` forgets a market, and ``{"op": "shutdown"}`` stops the server.
+
+Solves run in worker processes, so the event loop keeps answering other requests while one is being solved.
+Each worker is a `concurrent.futures.ProcessPoolExecutor` of its own, and a solve goes to whichever has the
+fewest solves waiting. A worker loads a market the first time it is asked to solve it, and keeps it, with its
+fits, until the server tells it to forget it: when the market is unloaded, or loaded again. Only the
+capacities go to a worker and only the matched buyers come back. A worker reads the market from its source,
+so it checks that what it read has the CRC the server's copy had, and refuses to solve it if the source has
+changed since. The server itself only parses a market, for its names; it never needs the fits. With
+``workers=0`` solves run in threads of the server process instead, on the server's own copy.
+"""
+import argparse
+import asyncio
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+import json
+import os
+import socket
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from checkpoint import market_crc
+from engine import ArrayMatching, array_optimal_match
+import exceptions
+from fits import preference_fits
+from market import Market
+import output
+import reader
+import snapshot
+
+OPERATIONS = ('load', 'match', 'assignment', 'unload', 'shutdown')
+
+# the longest request line we accept: assignment queries can list many buyers
+LIMIT = 1 << 24
+
+# the markets this process holds: name -> (generation, market, fits, or None until it's first solved)
+_resident: Dict[str, Tuple[int, Market, Optional[array]]] = {}
+
+def _read(source: Dict[str, str]) -> Market:
+    if source.get('snapshot'):
+        return snapshot.load_snapshot(source['snapshot'])
+    return reader.read_market(source['path'], mode=source.get('reader', 'stream'))
+
+def _crc(market: Market) -> int:
+    return market_crc(market, ())
+
+def _resident_market(name: str, generation: int, source: Dict[str, str], crc: int) -> Tuple[Market, array]:
+    """The market `name` and its fits as this process holds them, loading this generation of it if need be."""
+    entry = _resident.get(name)
+    if entry is None or entry[0] != generation:
+        market = _read(source)
+        if _crc(market) != crc:
+            raise ValueError(f"The source of market {name!r} has changed since it was loaded; load it again")
+        entry = (generation, market, None)
+    if entry[2] is None:
+        entry = (generation, entry[1], preference_fits(entry[1]))
+    _resident[name] = entry
+    return entry[1], entry[2]
+
+def _solve(name: str, generation: int, source: Dict[str, str], crc: int,
+           capacities: Optional[Sequence[int]]) -> Tuple[List[array], List[array]]:
+    market, fits = _resident_market(name, generation, source, crc)
+    result = array_optimal_match(market, capacities, fits=fits)
+    return result.members, result.member_fits
+
+def _evict(name: str, generation: int) -> None:
+    """Forget this process's copy of a generation of the market `name`, if it holds one."""
+    entry = _resident.get(name)
+    if entry is not None and entry[0] == generation:
+        del _resident[name]
+
+class _Market:
+    """What the server knows about a loaded market."""
+
+    def __init__(self, generation: int, source: Dict[str, str], market: Market, crc: int) -> None:
+        self.generation = generation
+        self.source = source
+        self.market = market
+        self.crc = crc
+        # the workers that have been asked to solve it, and so may hold it
+        self.workers: Set[int] = set()
+        self._result: Optional[ArrayMatching] = None
+        self._buyer_fits: Optional[array] = None
+        self._buyer_index: Optional[Dict[str, int]] = None
+
+    @property
+    def result(self) -> Optional[ArrayMatching]:
+        """The latest solution."""
+        return self._result
+
+    @result.setter
+    def result(self, result: ArrayMatching) -> None:
+        self._result = result
+        self._buyer_fits = None
+
+    def buyer_fits(self) -> array:
+        """Every buyer's fit to their neighborhood in the latest solution, 0 if they're unmatched."""
+        if self._buyer_fits is None:
+            self._buyer_fits = array(self.market.schema.fit_typecode, [0]) * self.market.buyer_count
+            for members, fits in zip(self._result.members, self._result.member_fits):
+                for buyer, fit in zip(members, fits):
+                    self._buyer_fits[buyer] = fit
+        return self._buyer_fits
+
+    def buyer_index(self) -> Dict[str, int]:
+        # only built once someone asks for an assignment
+        if self._buyer_index is None:
+            self._buyer_index = {name: b for b, name in enumerate(self.market.buyer_names)}
+        return self._buyer_index
+
+class MatchServer:
+    """Answers requests against resident markets.
+
+    Parameters
+    ----------
+    workers : Optional[int]
+        The number of worker processes to solve in; as many as there are CPUs by default, or 0 to solve in
+        threads of this process.
+    """
+
+    def __init__(self, workers: Optional[int] = None) -> None:
+        self.markets: Dict[str, _Market] = {}
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # a single-process executor per worker, rather than one pool, so that a market can be evicted from
+        # exactly the workers that hold it; and how many solves each has waiting
+        self._executors: List[Executor] = [ProcessPoolExecutor(1) for _ in range(workers)]
+        self._waiting = [0] * workers
+        self._generation = 0
+        self._stopping: Optional[asyncio.Event] = None
+        # the writer of every open connection, and the task serving it
+        self._writers: Dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    async def handle(self, request: dict) -> dict:
+        """The response to one request."""
+        operation = request.get('op')
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown op {operation!r}; expected one of {OPERATIONS}")
+        handler = getattr(self, f'_{operation}')
+        response = await handler(request)
+        response['ok'] = True
+        return response
+
+    def _market(self, request: dict) -> _Market:
+        name = request.get('market')
+        if name not in self.markets:
+            raise KeyError(f"No market {name!r} is loaded")
+        return self.markets[name]
+
+    def _forget(self, name: str) -> None:
+        """Drop the market `name`, if one is loaded, from this process and from every worker that holds it."""
+        entry = self.markets.pop(name, None)
+        if entry is None:
+            return
+        _resident.pop(name, None)
+        # each worker runs its tasks in order, so a busy one evicts once it's done with what it's solving
+        for worker in entry.workers:
+            self._executors[worker].submit(_evict, name, entry.generation)
+
+    async def _load(self, request: dict) -> dict:
+        name = request.get('market')
+        if not isinstance(name, str):
+            raise ValueError("load needs a market name")
+        if request.get('snapshot'):
+            source = {'snapshot': request['snapshot']}
+        elif request.get('path'):
+            source = {'path': request['path'], 'reader': request.get('reader', 'stream')}
+        else:
+            raise ValueError("load needs a path or a snapshot")
+        self._generation += 1
+        generation = self._generation
+        start = time.perf_counter()
+        # parsing is CPU-bound too; the thread at least lets the loop answer in between
+        loop = asyncio.get_running_loop()
+        market = await loop.run_in_executor(None, _read, source)
+        crc = await loop.run_in_executor(None, _crc, market)
+        self._forget(name)
+        self.markets[name] = _Market(generation, source, market, crc)
+        if not self._executors:
+            _resident[name] = (generation, market, None)
+        return {'market': name, 'buyers': market.buyer_count, 'neighborhoods': market.neighborhood_count,
+                'seconds': time.perf_counter() - start}
+
+    async def _match(self, request: dict) -> dict:
+        entry = self._market(request)
+        market = entry.market
+        capacities = request.get('capacities')
+        if capacities is not None:
+            if len(capacities) != market.neighborhood_count or not all(isinstance(c, int) for c in capacities):
+                raise ValueError(f"capacities must be {market.neighborhood_count} integers")
+            capacities = array('q', capacities)
+        else:
+            capacities = market.capacities()
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        executor = None
+        if self._executors:
+            worker = min(range(len(self._executors)), key=self._waiting.__getitem__)
+            entry.workers.add(worker)
+            executor = self._executors[worker]
+            self._waiting[worker] += 1
+        try:
+            members, member_fits = await loop.run_in_executor(executor, _solve, request['market'], entry.generation,
+                                                              entry.source, entry.crc, capacities)
+        finally:
+            if executor is not None:
+                self._waiting[worker] -= 1
+        result = ArrayMatching(market, capacities, members, member_fits)
+        entry.result = result
+        if request.get('output'):
+            output.write(request['output'], request.get('format', 'text'), output.matching_rows(result),
+                         output.matching_assignments(result), market.schema.fit_typecode)
+        matched = sum(len(m) for m in members)
+        return {'market': request['market'], 'matched': matched, 'unmatched': market.buyer_count - matched,
+                'seconds': time.perf_counter() - start}
+
+    async def _assignment(self, request: dict) -> dict:
+        entry = self._market(request)
+        if entry.result is None:
+            raise ValueError(f"Market {request['market']!r} hasn't been matched")
+        index = entry.buyer_index()
+        buyer_match = entry.result.buyer_match
+        buyer_fits = entry.buyer_fits()
+        names = entry.market.neighborhood_names
+        assignments = {}
+        for name in request.get('buyers', []):
+            buyer = index.get(name)
+            if buyer is None:
+                raise KeyError(f"No buyer {name!r} in market {request['market']!r}")
+            neighborhood = buyer_match[buyer]
+            assignments[name] = None if neighborhood < 0 else {'neighborhood': names[neighborhood],
+                                                              'fit': buyer_fits[buyer]}
+        return {'market': request['market'], 'assignments': assignments}
+
+    async def _unload(self, request: dict) -> dict:
+        self._market(request)
+        self._forget(request['market'])
+        return {'market': request['market']}
+
+    async def _shutdown(self, request: dict) -> dict:
+        self._stopping.set()
+        return {}
+
+    async def _connection(self, stream_reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await stream_reader.readline()
+                if not line:
+                    break
+                response = await self._respond(line)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._writers.pop(writer, None)
+            writer.close()
+
+    async def _respond(self, line: bytes) -> dict:
+        request = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object")
+            response = await self.handle(request)
+        except (KeyError, ValueError, TypeError, OSError, exceptions.MatchingError) as error:
+            message = error.args[0] if isinstance(error, KeyError) and error.args else str(error)
+            if isinstance(error, exceptions.DataParsingError):
+                message = f"Could not parse {error.failed!r}"
+            response = {'ok': False, 'error': message}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    async def serve(self, path: Optional[str] = None, host: str = '127.0.0.1', port: int = 0,
+                    ready: Optional[Callable[[object], None]] = None) -> None:
+        """Serve on the Unix socket `path`, or on `host` and `port`, until a shutdown request.
+
+        `ready` is called with the address once the server is listening.
+        """
+        self._stopping = asyncio.Event()
+        if path:
+            server = await asyncio.start_unix_server(self._connection, path, limit=LIMIT)
+            address = path
+        else:
+            server = await asyncio.start_server(self._connection, host, port, limit=LIMIT)
+            address = server.sockets[0].getsockname()[:2]
+        if ready is not None:
+            ready(address)
+        try:
+            async with server:
+                await self._stopping.wait()
+                # the server won't finish closing while clients are still connected
+                connections = list(self._writers.values())
+                for writer in list(self._writers):
+                    writer.close()
+                # let each connection see its end rather than being cancelled mid-read when the loop stops
+                await asyncio.gather(*connections, return_exceptions=True)
+        finally:
+            for executor in self._executors:
+                executor.shutdown()
+            if path and os.path.exists(path):
+                os.remove(path)
+
+class MatchClient:
+    """A blocking client for a `MatchServer`.
+
+    Connects to the Unix socket `path`, or to `host` and `port`. Every request method returns the server's
+    response, or raises `exceptions.ServerError` with the server's message.
+    """
+
+    def __init__(self, path: Optional[str] = None, host: str = '127.0.0.1', port: Optional[int] = None) -> None:
+        if path:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rwb')
+
+    def request(self, op: str, **fields) -> dict:
+        self._file.write(json.dumps(dict(fields, op=op)).encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise exceptions.ServerError("The server closed the connection")
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise exceptions.ServerError(response.get('error'))
+        return response
+
+    def load(self, market: str, path: Optional[str] = None, reader: str = 'stream',
+             snapshot: Optional[str] = None) -> dict:
+        if snapshot:
+            return self.request('load', market=market, snapshot=snapshot)
+        return self.request('load', market=market, path=path, reader=reader)
+
+    def match(self, market: str, capacities: Optional[List[int]] = None, **fields) -> dict:
+        if capacities is not None:
+            fields['capacities'] = list(capacities)
+        return self.request('match', market=market, **fields)
+
+    def assignment(self, market: str, buyers: List[str]) -> Dict[str, Optional[dict]]:
+        return self.request('assignment', market=market, buyers=list(buyers))['assignments']
+
+    def unload(self, market: str) -> dict:
+        return self.request('unload', market=market)
+
+    def shutdown(self) -> dict:
+        return self.request('shutdown')
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self) -> 'MatchClient':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog='match.py serve',
+                                     description='Serve matches over a local socket, keeping markets warm')
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', type=str, help='Listen on this Unix socket.')
+    address.add_argument('--port', type=int, help='Listen on this TCP port (0 picks a free one).')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on with --port.')
+    parser.add_argument('--workers', type=int, required=False,
+                        help='Worker processes to solve in (default: one per CPU); 0 solves in threads instead.')
+    args = parser.parse_args(argv)
+
+    server = MatchServer(args.workers)
+    asyncio.run(server.serve(args.socket, args.host, args.port or 0,
+                             ready=lambda address: print(f"listening on {address}", file=sys.stderr, flush=True)))
+    return 0
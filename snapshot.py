@@ -0,0 +1,135 @@
+"""A compact binary snapshot of a parsed `Market`.
+
+Re-running the same market means re-parsing the same text every time. A snapshot stores the market's
+columns as they sit in memory, so that loading one is a memory map rather than a parse:
+
+* a header: the magic bytes, a format version, the vector width and the number of neighborhoods and
+  buyers, followed by a table of sections;
+* a name table: the UTF-8 names of the neighborhoods and buyers, back to back, with their offsets;
+* packed columns: int32 neighborhood characteristics and buyer goals, int64 preference offsets and
+  int32 preference indices, and the int64 capacities the neighborhoods declared (-1 where they declared
+  none), if any did.
+
+Everything is little-endian and every section starts on an 8-byte boundary, so a loaded snapshot's
+columns are `memoryview` casts straight over the mapped file. Only markets of the E/W/R `vector.PEARL`
+schema can be snapshotted.
+"""
+from array import array
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Tuple
+
+import exceptions
+from market import Market, NameTable
+from vector import PEARL
+
+MAGIC = b'NBHDSNAP'
+VERSION = 1
+
+# magic, version, dims, neighborhood count, buyer count, section count
+HEADER = struct.Struct('<8sIIQQI4x')
+# tag, typecode, offset, length in bytes
+SECTION = struct.Struct('<8s1s7xQQ')
+
+def _columns(market: Market) -> Dict[bytes, Tuple[str, object]]:
+    if market.schema is not PEARL:
+        raise ValueError(f"Snapshots hold E/W/R markets only, not {market.schema}")
+    neighborhood_names = market.neighborhood_names
+    if not isinstance(neighborhood_names, NameTable):
+        neighborhood_names = NameTable()
+        for name in market.neighborhood_names:
+            neighborhood_names.append(name)
+    buyer_names = market.buyer_names
+    if not isinstance(buyer_names, NameTable):
+        buyer_names = NameTable()
+        for name in market.buyer_names:
+            buyer_names.append(name)
+    try:
+        neighborhood_vectors = array('i', market.neighborhood_vectors)
+        buyer_vectors = array('i', market.buyer_vectors)
+    except OverflowError:
+        raise ValueError("Snapshot vectors are packed as int32, and this market's values don't fit")
+    columns = {
+        b'NNAMEOFF': ('q', array('q', neighborhood_names.offsets)),
+        b'NNAMES': ('B', bytes(neighborhood_names.blob)),
+        b'BNAMEOFF': ('q', array('q', buyer_names.offsets)),
+        b'BNAMES': ('B', bytes(buyer_names.blob)),
+        b'NVECTORS': ('i', neighborhood_vectors),
+        b'BVECTORS': ('i', buyer_vectors),
+        b'PREFOFFS': ('q', array('q', market.pref_offsets)),
+        b'PREFIDX': ('i', array('i', market.pref_indices)),
+    }
+    if market.neighborhood_capacities is not None:
+        columns[b'NCAPS'] = ('q', array('q', market.neighborhood_capacities))
+    return columns
+
+def save_snapshot(file_name: str, market: Market) -> None:
+    """Write `market` to `file_name`.
+
+    The snapshot is written to a temporary file alongside and moved into place, so a reader never
+    sees a partial snapshot.
+    """
+    columns = _columns(market)
+    offset = HEADER.size + SECTION.size * len(columns)
+    table = []
+    payloads = []
+    for tag, (typecode, column) in columns.items():
+        if isinstance(column, array) and sys.byteorder != 'little':
+            column = array(typecode, column)
+            column.byteswap()
+        payload = column.tobytes() if isinstance(column, array) else column
+        padding = -len(payload) % 8
+        table.append(SECTION.pack(tag, typecode.encode(), offset, len(payload)))
+        payloads.append(payload + b'\0' * padding)
+        offset += len(payload) + padding
+
+    temporary = f"{file_name}.tmp"
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, VERSION, market.dims, market.neighborhood_count,
+                                   market.buyer_count, len(columns)))
+        for entry in table:
+            snapshot.write(entry)
+        for payload in payloads:
+            snapshot.write(payload)
+    os.replace(temporary, file_name)
+
+def load_snapshot(file_name: str) -> Market:
+    """Memory-map a snapshot written by `save_snapshot` and return its market.
+
+    The market's columns are views of the mapped file: nothing is copied until it is used.
+    """
+    with open(file_name, 'rb') as snapshot:
+        mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    if len(view) < HEADER.size:
+        raise exceptions.DataParsingError(file_name)
+    magic, version, dims, neighborhood_count, buyer_count, section_count = HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION or dims != PEARL.dims:
+        raise exceptions.DataParsingError(file_name)
+
+    sections = {}
+    for i in range(section_count):
+        tag, typecode, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+        column = view[offset:offset + length]
+        typecode = typecode.decode()
+        if typecode != 'B':
+            column = column.cast(typecode)
+            if sys.byteorder != 'little':
+                column = array(typecode, column.tobytes())
+                column.byteswap()
+        sections[tag.rstrip(b'\0')] = column
+
+    market = Market(
+        neighborhood_names=NameTable(sections[b'NNAMES'], sections[b'NNAMEOFF']),
+        neighborhood_vectors=sections[b'NVECTORS'],
+        buyer_names=NameTable(sections[b'BNAMES'], sections[b'BNAMEOFF']),
+        buyer_vectors=sections[b'BVECTORS'],
+        pref_offsets=sections[b'PREFOFFS'],
+        pref_indices=sections[b'PREFIDX'],
+        neighborhood_capacities=sections.get(b'NCAPS'),
+    )
+    if market.neighborhood_count != neighborhood_count or market.buyer_count != buyer_count:
+        raise exceptions.DataParsingError(file_name)
+    return market
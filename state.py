@@ -0,0 +1,258 @@
+"""Keeping a stable matching stable as the market changes.
+
+Re-solving a whole market because one buyer arrived or left throws away almost all of the work. A
+`MatchingState` holds on to a buyer-optimal stable matching and repairs it after each change, touching
+only the buyers whose matches actually move:
+
+* a new buyer proposes down their preferences, and any buyer they displace carries on proposing from
+  where they left off, exactly as they would have in the original run;
+* a vacancy (a buyer leaving, or a neighborhood opening up) is offered to the best-fitting buyer who would
+  rather be there than where they are, whose own departure opens a vacancy in turn.
+
+Proposal chains keep buyers at their best stable match when the market gets more crowded, and vacancy
+chains do the same when it gets less crowded, so the result is the matching a full re-solve would find.
+Changing a neighborhood's characteristics does both: the neighborhood is closed, its buyers propose
+elsewhere, and then it reopens with its new characteristics.
+"""
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from buyer import Homebuyer
+from match import _match_pair, _unmatch_pair, buyer_optimal_match
+from neighborhood import Neighborhood
+from vector import PearlVector
+
+class MatchingState:
+    """A stable matching that can be updated in place.
+
+    Parameters
+    ----------
+    buyers : List[Homebuyer]
+        Every buyer in the market.
+    neighborhoods : List[Neighborhood]
+        Every neighborhood in the market, with its ``capacity`` set.
+
+    The players must already hold a buyer-optimal stable matching, as `buyer_optimal_match` leaves them;
+    `MatchingState.solve` does both steps.
+    """
+
+    def __init__(self, buyers: List[Homebuyer], neighborhoods: List[Neighborhood]) -> None:
+        self.buyers = list(buyers)
+        self.neighborhoods = list(neighborhoods)
+        self._closed: Set[Neighborhood] = set()
+        # for each neighborhood, the buyers who list it ordered from best fit to worst, alongside their
+        # negated fits so that `bisect` can keep them in order
+        self._rankings: Dict[Neighborhood, List[Homebuyer]] = {n: [] for n in self.neighborhoods}
+        self._keys: Dict[Neighborhood, List] = {n: [] for n in self.neighborhoods}
+        # for each neighborhood, how far into its ranking no buyer would rather be there than where they are
+        self._cursors: Dict[Neighborhood, int] = {n: 0 for n in self.neighborhoods}
+        # the neighborhoods whose best candidate may have changed since the matching was last buyer-optimal
+        self._touched: Set[Neighborhood] = set()
+        for buyer in self.buyers:
+            self._rank(buyer)
+
+    @classmethod
+    def solve(cls, buyers: List[Homebuyer], neighborhoods: List[Neighborhood], engine: str = 'object') -> 'MatchingState':
+        """Solve the market with `buyer_optimal_match`, and keep the result."""
+        buyer_optimal_match(buyers, neighborhoods, engine=engine)
+        return cls(buyers, neighborhoods)
+
+    def matches(self) -> Dict[Neighborhood, List[Homebuyer]]:
+        """The current matching, in the shape `buyer_optimal_match` returns."""
+        return {n: n.matching for n in self.neighborhoods}
+
+    def unmatched(self) -> List[Homebuyer]:
+        return [b for b in self.buyers if b.matching is None]
+
+    def add_buyer(self, buyer: Homebuyer) -> None:
+        """Add a buyer to the market, and let them propose."""
+        self.buyers.append(buyer)
+        self._rank(buyer)
+        self._propose(buyer, 0)
+        # proposal chains leave the matching buyer-optimal on their own
+        self._touched.clear()
+
+    def remove_buyer(self, buyer: Homebuyer) -> None:
+        """Withdraw a buyer from the market, and fill the vacancy they leave."""
+        self.buyers.remove(buyer)
+        self._unrank(buyer)
+        # wherever they were the best candidate, somebody else is now
+        self._touch(buyer, None)
+        neighborhood = buyer.matching
+        if neighborhood is not None:
+            _unmatch_pair(buyer, neighborhood)
+            self._fill_vacancies(neighborhood)
+        else:
+            # even an unmatched buyer may have been all that kept some other buyers from doing better
+            self._improve()
+
+    def update_neighborhood(self, neighborhood: Neighborhood, characteristics: PearlVector) -> None:
+        """Change a neighborhood's characteristics, and with them every buyer's fit to it."""
+        self._closed.add(neighborhood)
+        displaced = list(neighborhood.matching)
+        for buyer in displaced:
+            _unmatch_pair(buyer, neighborhood)
+        for buyer in displaced:
+            self._propose(buyer, buyer.get_rank(neighborhood) + 1)
+
+        neighborhood.characteristics = characteristics
+        ranked = self._rankings[neighborhood]
+        for buyer in ranked:
+            buyer.update_fit(neighborhood)
+        # a stable sort keeps tied buyers in the order they were already ranked, as `_insert` would
+        ranked.sort(key=lambda buyer: -buyer.get_fitness(neighborhood))
+        self._keys[neighborhood] = [-buyer.get_fitness(neighborhood) for buyer in ranked]
+        self._cursors[neighborhood] = 0
+
+        self._closed.discard(neighborhood)
+        self._touched.add(neighborhood)
+        self._fill_vacancies(neighborhood)
+
+    def _rank(self, buyer: Homebuyer) -> None:
+        for neighborhood in set(buyer.prefs):
+            if neighborhood in self._rankings:
+                self._insert(neighborhood, buyer)
+
+    def _insert(self, neighborhood: Neighborhood, buyer: Homebuyer) -> None:
+        keys = self._keys[neighborhood]
+        key = -buyer.get_fitness(neighborhood)
+        i = bisect_right(keys, key)
+        keys.insert(i, key)
+        self._rankings[neighborhood].insert(i, buyer)
+        self._cursors[neighborhood] = min(self._cursors[neighborhood], i)
+
+    def _unrank(self, buyer: Homebuyer) -> None:
+        for neighborhood in set(buyer.prefs):
+            if neighborhood not in self._rankings:
+                continue
+            keys = self._keys[neighborhood]
+            ranked = self._rankings[neighborhood]
+            key = -buyer.get_fitness(neighborhood)
+            for i in range(bisect_left(keys, key), bisect_right(keys, key)):
+                if ranked[i] is buyer:
+                    del keys[i]
+                    del ranked[i]
+                    if i < self._cursors[neighborhood]:
+                        self._cursors[neighborhood] -= 1
+                    break
+
+    def _rewind(self, neighborhood: Neighborhood, buyer: Homebuyer) -> None:
+        """Move the neighborhood's cursor back to `buyer`, who would now rather be there."""
+        i = bisect_left(self._keys[neighborhood], -buyer.get_fitness(neighborhood))
+        if i < self._cursors[neighborhood]:
+            self._cursors[neighborhood] = i
+
+    def _touch(self, buyer: Homebuyer, worse: Optional[Neighborhood]) -> None:
+        """Note the neighborhoods whose candidates can change when `buyer` moves.
+
+        Those are the ones `buyer` ranks no lower than `worse`, the less preferred of where they were and where
+        they are now: every preference if either is ``None``.
+        """
+        rank = buyer.get_rank(worse) if worse is not None else None
+        self._touched.update(buyer.prefs if rank is None else buyer.prefs[:rank + 1])
+
+    def _propose(self, buyer: Homebuyer, start: int) -> None:
+        """Let a free buyer propose from their `start`th preference on, following any displacements."""
+        proposals = deque([(buyer, start)])
+        while proposals:
+            buyer, k = proposals.popleft()
+            prefs = buyer.prefs
+            while k < len(prefs):
+                neighborhood = prefs[k]
+                k += 1
+                if neighborhood in self._closed or neighborhood not in self._rankings:
+                    continue
+                if len(neighborhood.matching) < neighborhood.capacity:
+                    _match_pair(buyer, neighborhood)
+                    break
+                if neighborhood.matching:
+                    worst_match = neighborhood.get_worst_match()
+                    if neighborhood.get_fitness(buyer) > neighborhood.get_fitness(worst_match):
+                        _unmatch_pair(worst_match, neighborhood)
+                        _match_pair(buyer, neighborhood)
+                        self._rewind(neighborhood, worst_match)
+                        proposals.append((worst_match, worst_match.get_rank(neighborhood) + 1))
+                        break
+                # the buyer is now worse off than here, so may be its candidate
+                self._rewind(neighborhood, buyer)
+            self._touch(buyer, buyer.matching)
+
+    def _candidate(self, neighborhood: Neighborhood) -> Optional[Homebuyer]:
+        """The best-fitting buyer who would rather be in `neighborhood` than where they are now.
+
+        Between proposals buyers only ever move to neighborhoods they prefer, so a buyer who is passed over
+        once stays passed over: the search carries on from the neighborhood's cursor, and `_propose` moves
+        the cursor back for any buyer it leaves worse off.
+        """
+        ranked = self._rankings[neighborhood]
+        i = self._cursors[neighborhood]
+        while i < len(ranked):
+            buyer = ranked[i]
+            current = buyer.matching
+            if current is None or (current is not neighborhood and buyer.prefers(neighborhood, current)):
+                break
+            i += 1
+        self._cursors[neighborhood] = i
+        return ranked[i] if i < len(ranked) else None
+
+    def _fill_vacancies(self, neighborhood: Neighborhood) -> None:
+        vacancies = deque([neighborhood])
+        while vacancies:
+            neighborhood = vacancies.popleft()
+            while len(neighborhood.matching) < neighborhood.capacity:
+                buyer = self._candidate(neighborhood)
+                if buyer is None:
+                    break
+                previous = buyer.matching
+                if previous is not None:
+                    vacancies.append(previous)
+                    _unmatch_pair(buyer, previous)
+                _match_pair(buyer, neighborhood)
+                self._touch(buyer, previous)
+        self._improve()
+
+    def _successor(self, neighborhood: Neighborhood) -> Optional[Homebuyer]:
+        """The buyer a full neighborhood would take in next, if they are leaving another neighborhood for it."""
+        if (neighborhood in self._closed or neighborhood not in self._rankings
+                or len(neighborhood.matching) < neighborhood.capacity):
+            return None
+        buyer = self._candidate(neighborhood)
+        if buyer is not None and buyer.matching is not None:
+            return buyer
+        return None
+
+    def _improve(self) -> None:
+        """Move buyers around cycles of full neighborhoods until no buyer can do better.
+
+        Each full neighborhood points at its best candidate, and through them at the neighborhood that
+        candidate would leave. Around a cycle of those pointers every candidate can move at once: each
+        neighborhood gains one buyer and loses one, every buyer who moves gets a neighborhood they prefer,
+        and the matching stays stable. Once no such cycle is left, the matching is buyer-optimal again.
+
+        A new cycle has to pass through a neighborhood whose pointer has changed, so the search only starts
+        from the neighborhoods touched since the matching was last buyer-optimal.
+        """
+        while self._touched:
+            starts, self._touched = self._touched, set()
+            successors: Dict[Neighborhood, Optional[Homebuyer]] = {}
+            cycles = []
+            visited: Dict[Neighborhood, Neighborhood] = {}
+            for start in starts:
+                path = []
+                neighborhood = start
+                while neighborhood is not None and neighborhood not in visited:
+                    visited[neighborhood] = start
+                    path.append(neighborhood)
+                    buyer = successors[neighborhood] = self._successor(neighborhood)
+                    neighborhood = buyer.matching if buyer is not None else None
+                if neighborhood is not None and visited[neighborhood] is start:
+                    cycles.append(path[path.index(neighborhood):])
+
+            for cycle in cycles:
+                movers = [(successors[neighborhood], successors[neighborhood].matching) for neighborhood in cycle]
+                for buyer, previous in movers:
+                    _unmatch_pair(buyer, previous)
+                for (buyer, previous), neighborhood in zip(movers, cycle):
+                    _match_pair(buyer, neighborhood)
+                    self._touch(buyer, previous)
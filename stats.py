@@ -0,0 +1,102 @@
+"""Statistics about a run of the matcher.
+
+Pass a `MatchStats` to `buyer_optimal_match` or `engine.array_optimal_match` to find out where a slow
+run spends its effort. Nothing is counted unless one is passed in.
+"""
+from contextlib import contextmanager, nullcontext
+import time
+from typing import ContextManager, Dict, Iterator, Optional
+
+class MatchStats:
+    """Counters and timings collected while matching.
+
+    Attributes
+    ----------
+    proposals : int
+        Every time a buyer asked a neighborhood to take them. A displaced buyer in the object engine
+        starts again from their first preference, so it can count more of these than the array engine.
+    rejections : int
+        Proposals the neighborhood turned down.
+    displacements : int
+        Matched buyers who were bumped out by a better fit (calls to `_unmatch_pair`).
+    longest_chain : int
+        The longest run of displacements set off by a single buyer: a buyer bumps someone, who bumps
+        someone else, and so on.
+    scanned : int
+        Rejections the array engine found in a vectorized scan of the neighborhoods' thresholds, rather
+        than one proposal at a time. They are counted among the proposals and rejections too.
+    cache_hits : int
+        Buyers whose fits were read back from a `cache.FitCache`.
+    cache_misses : int
+        Buyers the cache had to score.
+    cache_seconds_saved : float
+        About how much sooner the fits were ready than if every buyer had been scored, going by how long
+        scoring has taken per fit. It's negative when the cache costs more than it saves.
+    phases : Dict[str, float]
+        Seconds spent in each phase, in the order the phases ran.
+    """
+
+    def __init__(self) -> None:
+        self.proposals = 0
+        self.rejections = 0
+        self.displacements = 0
+        self.longest_chain = 0
+        self.scanned = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_seconds_saved = 0.0
+        self.phases: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as the phase `name`, adding to any time it already has."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other: 'MatchStats') -> None:
+        """Fold in the statistics of a separately solved part of the market."""
+        self.proposals += other.proposals
+        self.rejections += other.rejections
+        self.displacements += other.displacements
+        self.longest_chain = max(self.longest_chain, other.longest_chain)
+        self.scanned += other.scanned
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.cache_seconds_saved += other.cache_seconds_saved
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def as_dict(self) -> dict:
+        return {
+            'proposals': self.proposals,
+            'rejections': self.rejections,
+            'displacements': self.displacements,
+            'longest_chain': self.longest_chain,
+            'scanned': self.scanned,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'cache_seconds_saved': self.cache_seconds_saved,
+            'phases': dict(self.phases),
+        }
+
+    def __str__(self):
+        lines = [
+            f"proposals: {self.proposals}",
+            f"rejections: {self.rejections}",
+            f"displacements: {self.displacements}",
+            f"longest displacement chain: {self.longest_chain}",
+            f"rejections found by scanning: {self.scanned}",
+        ]
+        lookups = self.cache_hits + self.cache_misses
+        if lookups:
+            lines.append(f"fit cache hits: {self.cache_hits} of {lookups} ({self.cache_hits / lookups:.1%}), "
+                         f"about {self.cache_seconds_saved:.6f}s saved")
+        lines += [f"{name}: {seconds:.6f}s" for name, seconds in self.phases.items()]
+        return '\n'.join(lines)
+
+def timed(stats: Optional[MatchStats], name: str) -> ContextManager:
+    """Time a phase into `stats`, if there are any to collect."""
+    return stats.phase(name) if stats is not None else nullcontext()
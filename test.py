@@ -1,13 +1,88 @@
 # TODO consider pytest; using unittest because it's built into Python: one less dependency needed.
+from array import array
+import asyncio
+import hashlib
+import os
+import pstats
+import random
+import struct
+import threading
+import tempfile
+import time
 from typing import cast
 import unittest
 
+import bench
+import cache
+import checkpoint
+import dedupe
+import engine
 from buyer import Homebuyer
-from match import _match_pair, _unmatch_pair, buyer_optimal_match, buyer_from_string, neighborhood_from_string, tokens_for_type
+from engine import array_optimal_match
+import fits
+from fits import assign_fits, gather_fits, preference_fits, refit, stack
+import match
+import output
+from match import _match_pair, _unmatch_pair, buyer_optimal_match, buyer_from_string, neighborhood_from_string, read_input_file, tokens_for_type
+from market import Market, split_capacities
 from neighborhood import Neighborhood
-from vector import PearlVector
+import partition
+import profiling
+import reader
+import scenarios
+import server
+import snapshot
+from state import MatchingState
+from stats import MatchStats
+from vector import PEARL, AttributeVector, PearlVector, Schema
+import verify
 import exceptions
 
+def random_market_lines(seed, buyer_count, neighborhood_count, max_value=10):
+    """Lines of a seeded random market in which every buyer ranks every neighborhood."""
+    rng = random.Random(seed)
+    names = [f'N{i}' for i in range(neighborhood_count)]
+    lines = [f'N {name} E:{rng.randint(0, max_value)} W:{rng.randint(0, max_value)} R:{rng.randint(0, max_value)}'
+             for name in names]
+    for i in range(buyer_count):
+        prefs = names[:]
+        rng.shuffle(prefs)
+        lines.append(f'H H{i} E:{rng.randint(0, max_value)} W:{rng.randint(0, max_value)} '
+                     f'R:{rng.randint(0, max_value)} {">".join(prefs)}')
+    return lines
+
+def players_from_lines(lines):
+    neighborhoods = [neighborhood_from_string(line) for line in lines if line[0] == 'N']
+    neighborhood_dict = {n.name: n for n in neighborhoods}
+    buyers = [buyer_from_string(line, neighborhood_dict) for line in lines if line[0] == 'H']
+    return buyers, neighborhoods
+
+def schema_market_lines(seed, buyer_count, neighborhood_count):
+    """Lines of a seeded random market with a weighted, float-valued schema of five attributes, in which every
+    buyer ranks every neighborhood."""
+    rng = random.Random(seed)
+    keys = ['A', 'B', 'C', 'D', 'E']
+    lines = ['S A:1 B:0.5 C:2 D:1.25 E:0']
+    names = [f'N{i}' for i in range(neighborhood_count)]
+
+    def values():
+        return ' '.join(f'{key}:{rng.uniform(0, 10):.3f}' for key in keys)
+
+    lines += [f'N {name} {values()}' for name in names]
+    for i in range(buyer_count):
+        prefs = rng.sample(names, neighborhood_count)
+        lines.append(f'H H{i} {values()} {">".join(prefs)}')
+    return lines
+
+def write_lines(lines):
+    handle, file_name = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(handle, 'w') as input_file:
+        input_file.write('\n'.join(lines))
+    return file_name
+
+def match_names(matches):
+    return {n.name: [b.name for b in buyers] for n, buyers in matches.items()}
+
 class TestVectors(unittest.TestCase):
     
     def test_instantiation(self):
@@ -27,7 +102,29 @@ class TestVectors(unittest.TestCase):
 
         fit = vector @ other_vector
         self.assertEqual(fit, 32)
-    
+
+    def test_schema_values(self):
+        schema = Schema.from_tokens(['X:1', 'Y:0.5'])
+        self.assertEqual(schema.dims, 2)
+        self.assertEqual(schema.fit_typecode, 'd')
+        self.assertListEqual(schema.values(['Y:4', 'X:1.5']), [1.5, 4.0])
+        self.assertListEqual(schema.values([b'X:2', b'Y:3']), [2.0, 3.0])
+        for tokens in (['X:1'], ['X:1', 'Y:2', 'Z:3'], ['X:1', 'X:2', 'Y:3']):
+            with self.subTest(tokens=tokens):
+                with self.assertRaises(exceptions.DataParsingError):
+                    schema.values(tokens)
+        with self.assertRaises(ValueError):
+            Schema(['X', 'X'])
+        self.assertEqual(PEARL.fit_typecode, 'q')
+
+    def test_weighted_fit(self):
+        schema = Schema(['X', 'Y', 'Z'], [1, 0.5, 2])
+        vector = schema.parse(['X:1', 'Y:2', 'Z:3'])
+        self.assertIsInstance(vector, AttributeVector)
+        self.assertEqual(vector['Z'], 3.0)
+        self.assertEqual(vector @ schema.vector([4, 5, 6]), 4 + 5 + 36)
+        self.assertIsInstance(PEARL.vector([1, 2, 3]), PearlVector)
+
 class TestUtils(unittest.TestCase):
     def test_parse_error(self):
         try:
@@ -95,6 +192,38 @@ class TestNeighborhoods(unittest.TestCase):
         successors = neighborhood.get_successors()
         self.assertListEqual(successors, [buyer1])
 
+    def test_set_prefs_keeps_its_own_order(self):
+        buyers = self.homebuyers[:]
+        self.neighborhood.set_prefs(buyers)
+        self.assertListEqual(buyers, self.homebuyers)
+        self.assertListEqual([b.name for b in self.neighborhood.prefs], ['H1', 'H0'])
+
+    def test_matching_order(self):
+        neighborhoods = {'N0': self.neighborhood}
+        twin = cast(Homebuyer, buyer_from_string('H H2 E:3 W:9 R:2 N2>N0', neighborhoods))
+        buyer1, buyer2 = self.homebuyers
+        for buyer in (buyer1, buyer2, twin):
+            _match_pair(buyer, self.neighborhood)
+        # best fit first; among equal fits, the latest match is the worst
+        self.assertListEqual(self.neighborhood.matching, [buyer2, buyer1, twin])
+        self.assertIs(self.neighborhood.get_worst_match(), twin)
+        _unmatch_pair(buyer1, self.neighborhood)
+        self.assertListEqual(self.neighborhood.matching, [buyer2, twin])
+        self.neighborhood.matching = [twin, buyer1, buyer2]
+        self.assertListEqual(self.neighborhood.matching, [buyer2, twin, buyer1])
+
+    def test_threshold(self):
+        buyer1, buyer2 = self.homebuyers
+        self.neighborhood.capacity = 0
+        self.assertEqual(self.neighborhood.threshold, float('inf'))
+        self.neighborhood.capacity = 2
+        self.assertIsNone(self.neighborhood.threshold)
+        _match_pair(buyer2, self.neighborhood)
+        self.assertIsNone(self.neighborhood.threshold)
+        _match_pair(buyer1, self.neighborhood)
+        # the worst fit it holds: buyer 1's, 104
+        self.assertEqual(self.neighborhood.threshold, 104)
+
 class TestHomebuyers(unittest.TestCase):
     def setUp(self):
         neighborhoods = [neighborhood_from_string(n_string) for n_string in [
@@ -116,6 +245,23 @@ class TestHomebuyers(unittest.TestCase):
         fits = h.fits
         self.assertDictEqual(fits, {'N0': 104, 'N1': 17, 'N2': 83 })
 
+    def test_ranks(self):
+        n_dict = self.neighborhood_dict
+        h = cast(Homebuyer, buyer_from_string('H H0 E:3 W:9 R:2 N2>N0>N1', n_dict))
+        self.assertTrue(h.prefers(n_dict['N2'], n_dict['N1']))
+        self.assertFalse(h.prefers(n_dict['N1'], n_dict['N0']))
+        _match_pair(h, n_dict['N0'])
+        self.assertListEqual(h.get_successors(), [n_dict['N1']])
+
+    def test_slotted(self):
+        h = cast(Homebuyer, buyer_from_string('H H0 E:3 W:9 R:2 N2>N0>N1', self.neighborhood_dict))
+        for obj in (h, h.goals, self.neighborhood_dict['N0']):
+            self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertListEqual(h._pref_names, ['N2', 'N0', 'N1'])
+        self.assertEqual(self.neighborhood_dict['N0'].get_fitness(h), 104)
+        h._forget(self.neighborhood_dict['N0'])
+        self.assertDictEqual(h.fits, {'N1': 17, 'N2': 83})
+
 class TestMatching(unittest.TestCase):
     def setUp(self):
         neighborhoods = [cast(Neighborhood, neighborhood_from_string(n_string)) for n_string in [
@@ -200,6 +346,1512 @@ class TestMatching(unittest.TestCase):
         self.assertListEqual(n1_match_names, ['H9', 'H8', 'H7', 'H1'])
         self.assertListEqual(n2_match_names, ['H6', 'H3', 'H10', 'H0'])
 
+    def legacy_match_names(self, lines):
+        """The matching of the original implementation, which sorted one shared free list in place for each
+        neighborhood and proposed from the front of it, kept here to pin down how ties are broken."""
+        buyers, neighborhoods = players_from_lines(lines)
+        free_buyers = buyers[:]
+        for n in neighborhoods:
+            free_buyers.sort(key=lambda buyer: buyer.goals @ n.characteristics, reverse=True)
+        capacity = len(buyers) // len(neighborhoods)
+        matching = {n.name: [] for n in neighborhoods}
+        while free_buyers:
+            buyer = free_buyers.pop(0)
+            for n in buyer.prefs:
+                members = matching[n.name]
+                fit = buyer.goals @ n.characteristics
+                if len(members) == capacity:
+                    if fit <= members[-1].goals @ n.characteristics:
+                        continue
+                    free_buyers.append(members.pop())
+                members.append(buyer)
+                members.sort(key=lambda member: member.goals @ n.characteristics, reverse=True)
+                break
+        return {name: [b.name for b in members] for name, members in matching.items()}
+
+    def test_ties_follow_legacy_order(self):
+        # tiny values tie most fits, so who is proposed first (and displaced last) decides the result
+        for seed in range(20):
+            lines = random_market_lines(seed, buyer_count=12, neighborhood_count=4, max_value=2)
+            expected = self.legacy_match_names(lines)
+            for engine_name in ('object', 'array'):
+                actual = match_names(buyer_optimal_match(*players_from_lines(lines), engine=engine_name))
+                self.assertDictEqual(actual, expected, f'seed {seed}, {engine_name} engine')
+
+class TestArrayEngine(unittest.TestCase):
+    def test_market_from_players(self):
+        buyers, neighborhoods = players_from_lines(['N N0 E:7 W:7 R:10', 'N N1 E:2 W:1 R:1', 'H H0 E:3 W:9 R:2 N1>N0'])
+        market = Market.from_players(buyers, neighborhoods)
+        self.assertEqual(market.buyer_count, 1)
+        self.assertEqual(market.neighborhood_count, 2)
+        self.assertListEqual(list(market.buyer_prefs(0)), [1, 0])
+        self.assertListEqual(list(market.neighborhood_vector(1)), [2, 1, 1])
+
+    def test_matches_sample(self):
+        with open('test_input.txt') as input_file:
+            lines = [line.rstrip() for line in input_file if line.strip()]
+        buyers, neighborhoods = players_from_lines(lines)
+        expected = match_names(buyer_optimal_match(buyers, neighborhoods))
+        buyers, neighborhoods = players_from_lines(lines)
+        actual = match_names(buyer_optimal_match(buyers, neighborhoods, engine='array'))
+        self.assertDictEqual(actual, expected)
+        self.assertEqual(buyers[5].matching, neighborhoods[0])
+
+    def test_equivalent_to_object_engine(self):
+        # small values make for plenty of tied fits, which exercise the tie-breaking order
+        for seed in range(20):
+            lines = random_market_lines(seed, buyer_count=30, neighborhood_count=5, max_value=4)
+            expected = match_names(buyer_optimal_match(*players_from_lines(lines)))
+            actual = match_names(buyer_optimal_match(*players_from_lines(lines), engine='array'))
+            self.assertDictEqual(actual, expected, f'seed {seed}')
+
+    def test_exhausted_buyers_are_unmatched(self):
+        buyers, neighborhoods = players_from_lines([
+            'N N0 E:1 W:1 R:1', 'N N1 E:1 W:1 R:1', 'H H0 E:1 W:1 R:1 N0>N1', 'H H1 E:2 W:2 R:2 N0>N1'])
+        result = array_optimal_match(Market.from_players(buyers, neighborhoods), capacities=[1, 0])
+        self.assertListEqual(list(result.members[0]), [1])
+        self.assertListEqual(result.unmatched(), [0])
+
+    def test_neighborhoods_are_not_ranked(self):
+        buyers, neighborhoods = players_from_lines(random_market_lines(3, buyer_count=12, neighborhood_count=3))
+        buyer_optimal_match(buyers, neighborhoods)
+        self.assertTrue(all(n.prefs == [] for n in neighborhoods))
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            buyer_optimal_match([], [], engine='quantum')
+
+    @unittest.skipIf(engine.numpy is None, 'the scan needs NumPy')
+    def test_scan(self):
+        # room for a third of the buyers, so most of them are turned down all the way down their preferences
+        scan_after, scan_min = engine.SCAN_AFTER, engine.SCAN_MIN
+        engine.SCAN_AFTER, engine.SCAN_MIN = 2, 4
+        try:
+            for seed, skew in enumerate(bench.SKEWS):
+                lines = list(bench.generate_lines(60, 20, seed=seed, skew=skew, max_value=4, capacity=1))
+                file_name = write_lines(lines)
+                try:
+                    market = reader.read_market(file_name)
+                finally:
+                    os.remove(file_name)
+                found = {}
+                for scan in (False, True):
+                    stats = MatchStats()
+                    result = array_optimal_match(market, stats=stats, scan=scan)
+                    found[scan] = ([list(members) for members in result.members],
+                                   (stats.proposals, stats.rejections, stats.displacements), stats.scanned)
+                self.assertListEqual(found[True][0], found[False][0], skew)
+                self.assertEqual(found[True][1], found[False][1], skew)
+                self.assertEqual(found[False][2], 0)
+                self.assertGreater(found[True][2], 0, skew)
+                expected = match_names(buyer_optimal_match(*players_from_lines(lines)))
+                self.assertDictEqual({market.neighborhood_names[n]: [market.buyer_names[b] for b in members]
+                                      for n, members in enumerate(found[True][0])}, expected, skew)
+        finally:
+            engine.SCAN_AFTER, engine.SCAN_MIN = scan_after, scan_min
+
+class TestCapacities(unittest.TestCase):
+    def capacity_market_lines(self, seed, buyer_count, neighborhood_count):
+        """Lines of a random market where some neighborhoods declare a capacity, and buyers rank only some
+        neighborhoods, so that some of them can't be placed."""
+        rng = random.Random(seed)
+        names = [f'N{i}' for i in range(neighborhood_count)]
+        lines = []
+        for name in names:
+            capacity = f' C:{rng.randint(0, 6)}' if rng.random() < 0.6 else ''
+            lines.append(f'N {name} E:{rng.randint(0, 4)} W:{rng.randint(0, 4)} R:{rng.randint(0, 4)}{capacity}')
+        for i in range(buyer_count):
+            prefs = rng.sample(names, rng.randint(2, neighborhood_count))
+            lines.append(f'H H{i} E:{rng.randint(0, 4)} W:{rng.randint(0, 4)} R:{rng.randint(0, 4)} {">".join(prefs)}')
+        return lines
+
+    def test_parse(self):
+        neighborhood = neighborhood_from_string('N N0 E:1 W:2 R:3 C:120')
+        self.assertEqual(neighborhood.declared_capacity, 120)
+        self.assertEqual(neighborhood.characteristics @ PearlVector(1, 1, 1), 6)
+        self.assertIsNone(neighborhood_from_string('N N0 E:1 W:2 R:3').declared_capacity)
+        self.assertEqual(reader.parse_neighborhood(b'N N0 C:7 E:1 W:2 R:3'), (b'N0', (1, 2, 3), 7))
+        for line in ('N N0 E:1 W:2 R:3 C:-1', 'N N0 E:1 W:2 R:3 C:many'):
+            with self.assertRaises(exceptions.DataParsingError):
+                neighborhood_from_string(line)
+            with self.assertRaises(exceptions.DataParsingError):
+                reader.parse_neighborhood(line.encode())
+        # a schema with a C attribute keeps it as an attribute
+        schema = Schema(('C', 'D'))
+        self.assertEqual(reader.parse_neighborhood(b'N N0 C:7 D:1', schema), (b'N0', (7.0, 1.0), None))
+
+    def test_split_capacities(self):
+        self.assertListEqual(list(split_capacities(20, [None, 5, None])), [7, 5, 7])
+        self.assertListEqual(list(split_capacities(20, [None, None, None])), [6, 6, 6])
+        self.assertListEqual(list(split_capacities(20, [30, None])), [30, 0])
+        self.assertListEqual(list(split_capacities(20, [3, 4])), [3, 4])
+
+    def test_engines_agree(self):
+        for seed in range(30):
+            lines = self.capacity_market_lines(seed, buyer_count=40, neighborhood_count=5)
+            buyers, neighborhoods = players_from_lines(lines)
+            matches = buyer_optimal_match(buyers, neighborhoods)
+            expected = match_names(matches)
+            unmatched = [buyer.name for buyer in match.unmatched_buyers(buyers)]
+            self.assertTrue(verify.verify_stable(matches, buyers).stable, f'seed {seed}')
+            for neighborhood in neighborhoods:
+                if neighborhood.declared_capacity is not None:
+                    self.assertEqual(neighborhood.capacity, neighborhood.declared_capacity)
+            self.assertDictEqual(match_names(buyer_optimal_match(*players_from_lines(lines), engine='array')), expected,
+                                 f'seed {seed}')
+            file_name = write_lines(lines)
+            try:
+                market = reader.read_market(file_name)
+            finally:
+                os.remove(file_name)
+            result = array_optimal_match(market)
+            self.assertListEqual(list(result.capacities), [n.capacity for n in neighborhoods])
+            self.assertListEqual([market.buyer_names[b] for b in result.unmatched()], unmatched, f'seed {seed}')
+
+    def test_no_neighborhoods(self):
+        lines = ['H H0 E:1 W:2 R:3 N0>N1', 'H H1 E:3 W:2 R:1 N1>N0']
+        self.assertListEqual(list(split_capacities(2, [])), [])
+        self.assertDictEqual(buyer_optimal_match(*players_from_lines(lines), engine='array'), {})
+        file_name = write_lines(lines)
+        try:
+            markets = [reader.read_market(file_name, mode=mode) for mode in ('stream', 'mmap')]
+        finally:
+            os.remove(file_name)
+        for market in markets:
+            self.assertListEqual(list(market.capacities()), [])
+            for result in (array_optimal_match(market), dedupe.block_optimal_match(market),
+                           partition.partitioned_optimal_match(market, workers=2)):
+                self.assertListEqual(result.unmatched(), [0, 1])
+
+    def test_exhausted_buyers_leave_the_queue(self):
+        # both buyers only want N0, which has room for one; this used to loop forever. H0 is the better fit
+        # to N1, so proposes first, and is displaced
+        buyers, neighborhoods = players_from_lines(['N N0 E:1 W:1 R:1 C:1', 'N N1 E:9 W:0 R:0',
+                                                    'H H0 E:1 W:1 R:1 N0>N9', 'H H1 E:0 W:2 R:2 N0>N9'])
+        stats = MatchStats()
+        matches = match_names(buyer_optimal_match(buyers, neighborhoods, stats=stats))
+        self.assertDictEqual(matches, {'N0': ['H1'], 'N1': []})
+        self.assertListEqual(match.unmatched_buyers(buyers), [buyers[0]])
+        self.assertEqual((stats.proposals, stats.rejections, stats.displacements), (3, 1, 1))
+
+    def test_unmatched_message(self):
+        self.assertEqual(match.unmatched_message(['H3']), '1 homebuyer unmatched: H3')
+        self.assertEqual(match.unmatched_message([f'H{i}' for i in range(5)], limit=2),
+                         '5 homebuyers unmatched: H0 H1 and 3 more')
+
+    def test_snapshot(self):
+        buyers, neighborhoods = players_from_lines(self.capacity_market_lines(3, buyer_count=20, neighborhood_count=4))
+        market = Market.from_players(buyers, neighborhoods)
+        self.assertIsNotNone(market.neighborhood_capacities)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'market.snap')
+            snapshot.save_snapshot(file_name, market)
+            loaded = snapshot.load_snapshot(file_name)
+            self.assertListEqual(list(loaded.neighborhood_capacities), list(market.neighborhood_capacities))
+            self.assertListEqual(list(loaded.capacities()), list(market.capacities()))
+            del loaded
+
+class TestCheckpoint(unittest.TestCase):
+    class Interrupted(Exception):
+        pass
+
+    class Interrupting(checkpoint.Checkpointer):
+        """Checkpoints after every `proposals`, and stops the run after `stop_after` checkpoints."""
+
+        def __init__(self, file_name, proposals, stop_after):
+            super().__init__(file_name, proposals=proposals)
+            self.stop_after = stop_after
+
+        def save(self, market, capacities, state):
+            super().save(market, capacities, state)
+            if self.saves == self.stop_after:
+                raise TestCheckpoint.Interrupted()
+
+    def setUp(self):
+        handle, self.file_name = tempfile.mkstemp(suffix='.ckpt')
+        os.close(handle)
+        os.remove(self.file_name)
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def market(self, seed, lines=None):
+        file_name = write_lines(lines or random_market_lines(seed, buyer_count=60, neighborhood_count=5, max_value=4))
+        try:
+            return reader.read_market(file_name)
+        finally:
+            os.remove(file_name)
+
+    def test_resume_gives_the_same_matching(self):
+        for seed, lines in enumerate([None, None, schema_market_lines(2, 60, 5)]):
+            market = self.market(seed, lines)
+            capacities = array('q', [random.Random(seed).randint(5, 15) for _ in range(market.neighborhood_count)])
+            expected_stats, stats = MatchStats(), MatchStats()
+            expected = array_optimal_match(market, capacities, stats=expected_stats)
+            for stop_after in (1, 3, 10):
+                with self.assertRaises(self.Interrupted):
+                    array_optimal_match(market, capacities, checkpoint=self.Interrupting(self.file_name, 4, stop_after))
+                self.assertTrue(os.path.exists(self.file_name))
+                self.assertFalse(os.path.exists(f'{self.file_name}.tmp'))
+                resumed = checkpoint.Checkpointer(self.file_name, proposals=4, resume=True)
+                stats = MatchStats()
+                result = array_optimal_match(market, capacities, stats=stats, checkpoint=resumed)
+                self.assertListEqual([list(members) for members in result.members],
+                                     [list(members) for members in expected.members], f'seed {seed}')
+                self.assertListEqual([list(fits) for fits in result.member_fits],
+                                     [list(fits) for fits in expected.member_fits], f'seed {seed}')
+                self.assertEqual((stats.proposals, stats.rejections, stats.displacements),
+                                 (expected_stats.proposals, expected_stats.rejections, expected_stats.displacements))
+                self.assertGreater(resumed.saves, 0)
+                self.assertFalse(os.path.exists(self.file_name))
+
+    def test_round_trip(self):
+        market = self.market(5)
+        capacities = market.even_capacities()
+        state = checkpoint.SolverState(array('q', market.pref_offsets[:-1]), [3, 1, 2],
+                                       [[(4, -2, 7), (9, 0, 1)], [], [(2, -1, 5)], [], []], 3, array('i', range(60)))
+        checkpoint.save_checkpoint(self.file_name, market, capacities, state)
+        loaded = checkpoint.load_checkpoint(self.file_name, market, capacities)
+        self.assertListEqual(list(loaded.next_pref), list(state.next_pref))
+        self.assertListEqual(list(loaded.free), state.free)
+        self.assertListEqual(loaded.heaps, state.heaps)
+        self.assertEqual(loaded.sequence, 3)
+        self.assertListEqual(list(loaded.chains), list(state.chains))
+
+    def test_different_market(self):
+        market = self.market(5)
+        capacities = market.even_capacities()
+        state = checkpoint.SolverState(array('q', market.pref_offsets[:-1]), [], [[] for _ in range(5)], 0)
+        checkpoint.save_checkpoint(self.file_name, market, capacities, state)
+        with self.assertRaises(ValueError):
+            checkpoint.load_checkpoint(self.file_name, self.market(6), capacities)
+        with self.assertRaises(ValueError):
+            checkpoint.load_checkpoint(self.file_name, market, array('q', [0] * 5))
+        # the same number of preferences for every buyer, in another order
+        reordered = self.market(5)
+        reordered.pref_indices[0], reordered.pref_indices[1] = reordered.pref_indices[1], reordered.pref_indices[0]
+        with self.assertRaises(ValueError):
+            checkpoint.load_checkpoint(self.file_name, reordered, capacities)
+        with open(self.file_name, 'r+b') as checkpoint_file:
+            checkpoint_file.truncate(checkpoint.HEADER.size + 8)
+        with self.assertRaises(exceptions.DataParsingError):
+            checkpoint.load_checkpoint(self.file_name, market, capacities)
+
+    def test_object_engine_cannot_be_checkpointed(self):
+        buyers, neighborhoods = players_from_lines(random_market_lines(3, buyer_count=12, neighborhood_count=3))
+        with self.assertRaises(ValueError):
+            buyer_optimal_match(buyers, neighborhoods, checkpoint=checkpoint.Checkpointer(self.file_name))
+        expected = match_names(buyer_optimal_match(buyers, neighborhoods))
+        actual = match_names(buyer_optimal_match(buyers, neighborhoods, engine='array',
+                                                 checkpoint=checkpoint.Checkpointer(self.file_name, proposals=1)))
+        self.assertDictEqual(actual, expected)
+
+class TestDeadline(unittest.TestCase):
+    class Clock:
+        """Stands in for the `time` module: every look at the clock finds a second has passed, until the
+        deadline of a match started on it, so that finishing up is never cut short."""
+
+        def __init__(self, deadline):
+            self.now = 0.0
+            self.stop = 1.0 + deadline
+
+        def perf_counter(self):
+            self.now = min(self.now + 1.0, self.stop)
+            return self.now
+
+    SETTINGS = ('CHECK_EVERY', 'RESULT_SECONDS', 'FALLBACK_SECONDS', 'FALLBACK_PREFERENCE_SECONDS',
+                'BLOCKING_PAIR_SECONDS')
+
+    def setUp(self):
+        # look at the clock before every buyer is taken off the queue, and keep nothing back for finishing up,
+        # so that a deadline of n seconds stops both engines after the same n - 2 buyers
+        self.saved = {(module, name): getattr(module, name) for module in (engine, match) for name in self.SETTINGS}
+        self.saved.update({(engine, 'time'): engine.time, (match, 'time'): match.time})
+        for module in (engine, match):
+            module.CHECK_EVERY = 1
+            module.RESULT_SECONDS = module.FALLBACK_SECONDS = module.FALLBACK_PREFERENCE_SECONDS = 0
+            module.BLOCKING_PAIR_SECONDS = 0
+
+    def tearDown(self):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+
+    def solve(self, lines, engine_name, deadline):
+        engine.time, match.time = self.Clock(deadline), self.Clock(deadline)
+        buyers, neighborhoods = players_from_lines(lines)
+        return buyers, buyer_optimal_match(buyers, neighborhoods, engine=engine_name, deadline=deadline)
+
+    def test_greedy_fill(self):
+        # buyers 0 and 1 both want N0, which has room for one, and the better fit gets it; by the time buyer 0
+        # moves on to N1, buyer 2 has taken its only place, and nobody is displaced
+        pref_indices = [0, 1, 0, 1, 1]
+        fits = [3, 9, 5, 2, 2]
+        room = [1, 1]
+        self.assertListEqual(engine.greedy_fill([0, 1, 2], [0, 2, 4], [2, 4, 5], pref_indices, fits, room),
+                             [(1, 2), (2, 4)])
+        self.assertListEqual(room, [0, 0])
+        # among equal fits, whoever comes first
+        self.assertListEqual(engine.greedy_fill([7, 8], [0, 1], [1, 2], [0, 0], [4, 4], [1]), [(7, 0)])
+
+    def test_greedy_fill_stops(self):
+        numpy = engine.numpy
+        for lookup in [None] if numpy is None else [None, numpy]:
+            with self.subTest(numpy=lookup is not None):
+                engine.numpy = lookup
+                try:
+                    # a clock that has already passed the deadline places nobody
+                    room = [1, 1]
+                    self.assertListEqual(engine.greedy_fill([0, 1], [0, 2], [2, 4], [0, 1, 0, 1], [5, 5, 4, 4], room,
+                                                            stop_at=0.0), [])
+                    self.assertListEqual(room, [1, 1])
+                    # nor does a market with no room left, however long the buyers' preferences
+                    self.assertListEqual(engine.greedy_fill([0, 1], [0, 2], [2, 4], [0, 1, 0, 1], [5, 5, 4, 4], [0, 0]),
+                                         [])
+                finally:
+                    engine.numpy = numpy
+
+    def test_no_time_at_all(self):
+        for engine_name in match.ENGINES:
+            buyers, neighborhoods = players_from_lines(random_market_lines(1, buyer_count=12, neighborhood_count=3))
+            matches = buyer_optimal_match(buyers, neighborhoods, engine=engine_name, deadline=0)
+            self.assertTrue(matches.timed_out, engine_name)
+
+    def test_wall_time(self):
+        # everyone wants the same neighborhoods in the same order and there's room for a tenth of them, so
+        # placing the free buyers greedily and counting their blocking pairs would take several times the
+        # deadline if either ran to the end
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+        rng = random.Random(0)
+        buyer_count, neighborhood_count = 4000, 400
+        market = Market([f'N{n}' for n in range(neighborhood_count)],
+                        array('q', [rng.randint(0, 10) for _ in range(3 * neighborhood_count)]),
+                        [f'H{b}' for b in range(buyer_count)],
+                        array('q', [rng.randint(0, 10) for _ in range(3 * buyer_count)]),
+                        array('q', range(0, buyer_count * neighborhood_count + 1, neighborhood_count)),
+                        array('i', range(neighborhood_count)) * buyer_count,
+                        neighborhood_capacities=array('q', [2]) * neighborhood_count)
+        fits = preference_fits(market)
+        deadline = 0.05
+        started = time.perf_counter()
+        result = array_optimal_match(market, fits=fits, deadline=deadline)
+        elapsed = time.perf_counter() - started
+        self.assertTrue(result.timed_out)
+        # a little leeway for the last look at the clock and for building the result
+        self.assertLess(elapsed, deadline + 0.025)
+
+    @unittest.skipIf(engine.numpy is None, 'compares the NumPy greedy pass with the plain one')
+    def test_vectorized_greedy_fill(self):
+        rng = random.Random(4)
+        for _ in range(20):
+            lengths = [rng.randint(0, 6) for _ in range(40)]
+            starts = [sum(lengths[:i]) for i in range(40)]
+            ends = [start + length for start, length in zip(starts, lengths)]
+            pref_indices = [rng.randrange(6) for _ in range(ends[-1])]
+            fits = [rng.randint(0, 3) for _ in range(ends[-1])]
+            room = [rng.randint(0, 5) for _ in range(6)]
+            expected_room = room[:]
+            numpy = engine.numpy
+            engine.numpy = None
+            try:
+                expected = engine.greedy_fill(range(40), starts, ends, pref_indices, fits, expected_room)
+            finally:
+                engine.numpy = numpy
+            self.assertListEqual(engine.greedy_fill(range(40), starts, ends, pref_indices, fits, room), expected)
+            self.assertListEqual(room, expected_room)
+
+    def test_engines_agree_when_out_of_time(self):
+        for seed in range(4):
+            lines = list(bench.generate_lines(60, 6, seed=seed, skew='zipf', max_value=4, capacity=8))
+            for deadline in (1, 10, 40):
+                found = {}
+                for engine_name in match.ENGINES:
+                    buyers, matches = self.solve(lines, engine_name, deadline)
+                    report = verify.verify_stable(matches, buyers)
+                    self.assertTrue(matches.timed_out)
+                    self.assertEqual(matches.blocking_pairs, len(report.blocking_pairs), f'seed {seed}')
+                    self.assertListEqual(report.capacity_violations, [])
+                    found[engine_name] = (match_names(matches), matches.blocking_pairs)
+                self.assertEqual(found['object'], found['array'], f'seed {seed}, deadline {deadline}')
+
+    def test_array_result(self):
+        file_name = write_lines(list(bench.generate_lines(60, 6, seed=1, skew='top', max_value=4, capacity=8)))
+        try:
+            market = reader.read_market(file_name)
+        finally:
+            os.remove(file_name)
+        engine.time = self.Clock(20)
+        result = array_optimal_match(market, deadline=20)
+        self.assertTrue(result.timed_out)
+        self.assertGreater(result.greedy_placed, 0)
+        self.assertEqual(result.blocking_pairs, len(verify.verify_array(result).blocking_pairs))
+        engine.time = self.Clock(10 ** 6)
+        exact = array_optimal_match(market, deadline=10 ** 6)
+        self.assertFalse(exact.timed_out)
+        self.assertEqual(exact.blocking_pairs, 0)
+        self.assertListEqual(list(exact.buyer_match), list(array_optimal_match(market).buyer_match))
+
+    def test_checkpointed_when_out_of_time(self):
+        file_name = write_lines(random_market_lines(2, buyer_count=40, neighborhood_count=4, max_value=4))
+        try:
+            market = reader.read_market(file_name)
+        finally:
+            os.remove(file_name)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_file = os.path.join(directory, 'market.ckpt')
+            engine.time = self.Clock(10)
+            array_optimal_match(market, deadline=10, checkpoint=checkpoint.Checkpointer(checkpoint_file))
+            self.assertTrue(os.path.exists(checkpoint_file))
+            resumed = array_optimal_match(market, checkpoint=checkpoint.Checkpointer(checkpoint_file, resume=True))
+            self.assertListEqual(list(resumed.buyer_match), list(array_optimal_match(market).buyer_match))
+
+class TestFits(unittest.TestCase):
+    def setUp(self):
+        self.buyers, self.neighborhoods = players_from_lines(random_market_lines(7, buyer_count=12, neighborhood_count=4))
+
+    def test_gather_fits(self):
+        market = Market.from_players(self.buyers, self.neighborhoods)
+        expected = [buyer.goals @ n.characteristics for buyer in self.buyers for n in buyer.prefs]
+        numpy = fits.numpy
+        for lookup in [None] if numpy is None else [None, numpy]:
+            with self.subTest(numpy=lookup is not None):
+                fits.numpy = lookup
+                try:
+                    self.assertListEqual(list(gather_fits(market.buyer_vectors, market.neighborhood_vectors,
+                                                          market.pref_offsets, market.pref_indices)), expected)
+                finally:
+                    fits.numpy = numpy
+
+    def test_assign_fits(self):
+        neighborhood_dict = {n.name: n for n in self.neighborhoods}
+        buyer = buyer_from_string('H H99 E:3 W:9 R:2 N2>N0', neighborhood_dict, compute_fits=False)
+        self.assertDictEqual(buyer.fits, {})
+        assign_fits([buyer], self.neighborhoods)
+        self.assertDictEqual(buyer.fits, {n: buyer.goals @ neighborhood_dict[n].characteristics for n in ('N0', 'N2')})
+        self.assertEqual(self.neighborhoods[3].get_fitness(buyer), buyer.goals @ self.neighborhoods[3].characteristics)
+        self.assertListEqual(list(stack([buyer.goals])), [3, 9, 2])
+
+    def test_legacy_order(self):
+        buyers, neighborhoods = players_from_lines(random_market_lines(5, buyer_count=40, neighborhood_count=4,
+                                                                       max_value=2))
+        expected = list(range(len(buyers)))
+        for n in neighborhoods:
+            expected.sort(key=lambda b: buyers[b].goals @ n.characteristics, reverse=True)
+        buyer_vectors = stack([b.goals for b in buyers])
+        neighborhood_vectors = stack([n.characteristics for n in neighborhoods])
+        numpy = fits.numpy
+        for lookup in [None] if numpy is None else [None, numpy]:
+            with self.subTest(numpy=lookup is not None):
+                fits.numpy = lookup
+                try:
+                    self.assertListEqual(fits.legacy_order(buyer_vectors, neighborhood_vectors), expected)
+                finally:
+                    fits.numpy = numpy
+
+    def test_read_input_file_fits(self):
+        homebuyers = read_input_file('test_input.txt')['homebuyers']
+        self.assertDictEqual(homebuyers[0].fits, {'N0': 104, 'N1': 17, 'N2': 83})
+
+class TestSchemas(unittest.TestCase):
+    def setUp(self):
+        self.file_name = write_lines(schema_market_lines(5, buyer_count=60, neighborhood_count=6))
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_batched_fits_match_pairwise_fits(self):
+        input_data = read_input_file(self.file_name)
+        self.assertEqual(input_data['schema'].keys, ('A', 'B', 'C', 'D', 'E'))
+        buyers = input_data['homebuyers']
+        for buyer in buyers:
+            for n in buyer.prefs:
+                self.assertAlmostEqual(buyer.fits[n.name], buyer.goals @ n.characteristics)
+
+    def test_engines_agree(self):
+        input_data = read_input_file(self.file_name)
+        expected = match_names(buyer_optimal_match(input_data['homebuyers'], input_data['neighborhoods']))
+        input_data = read_input_file(self.file_name)
+        self.assertDictEqual(match_names(buyer_optimal_match(input_data['homebuyers'], input_data['neighborhoods'],
+                                                             engine='array')), expected)
+        market = reader.read_market(self.file_name)
+        self.assertIs(market.schema.typecode, 'd')
+        result = array_optimal_match(market)
+        self.assertDictEqual({name: [market.buyer_names[b] for b in members]
+                              for name, members in zip(market.neighborhood_names, result.members)}, expected)
+        self.assertTrue(verify.verify_array(result).stable)
+        self.assertTrue(verify.verify_array(partition.partitioned_optimal_match(market, workers=1)).stable)
+
+    def test_schema_must_come_first(self):
+        file_name = write_lines(['N N0 E:1 W:1 R:1', 'S A:1', 'H H0 A:1 N0'])
+        try:
+            with self.assertRaises(exceptions.DataParsingError):
+                read_input_file(file_name)
+            with self.assertRaises(exceptions.DataParsingError):
+                reader.read_market(file_name)
+        finally:
+            os.remove(file_name)
+
+    def test_float_assignments(self):
+        market = reader.read_market(self.file_name)
+        result = array_optimal_match(market)
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'assignments.bin')
+            output.write_assignments(file_name, output.matching_assignments(result), binary=True,
+                                     typecode=market.schema.fit_typecode)
+            self.assertListEqual(output.read_assignments(file_name),
+                                 [(n, fit) for _, n, fit in output.matching_assignments(result)])
+
+    def test_snapshots_are_pearl_only(self):
+        with self.assertRaises(ValueError):
+            snapshot.save_snapshot(os.path.join(tempfile.gettempdir(), 'unused.snap'), reader.read_market(self.file_name))
+
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        lines = random_market_lines(3, buyer_count=40, neighborhood_count=4) + [
+            '',
+            'H H5 E:1 W:2 R:3 N9>N1>N0',
+            'n N2 E:1 W:1 R:1',
+            'N N1 E:9 W:8 R:7',
+            'h h7 e:4 w:4 r:4 n3>n2',
+        ]
+        handle, self.file_name = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(handle, 'w') as input_file:
+            input_file.write('\n'.join(lines))
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def assertMarketsEqual(self, actual, expected):
+        self.assertListEqual(list(actual.neighborhood_names), list(expected.neighborhood_names))
+        self.assertListEqual(list(actual.buyer_names), list(expected.buyer_names))
+        self.assertListEqual(list(actual.neighborhood_vectors), list(expected.neighborhood_vectors))
+        self.assertListEqual(list(actual.buyer_vectors), list(expected.buyer_vectors))
+        self.assertListEqual(list(actual.pref_offsets), list(expected.pref_offsets))
+        self.assertListEqual(list(actual.pref_indices), list(expected.pref_indices))
+        self.assertEqual(actual.neighborhood_capacities and list(actual.neighborhood_capacities),
+                         expected.neighborhood_capacities and list(expected.neighborhood_capacities))
+
+    def test_matches_read_input_file(self):
+        input_data = read_input_file(self.file_name)
+        expected = Market.from_players(input_data['homebuyers'], input_data['neighborhoods'])
+        for mode in reader.READERS:
+            with self.subTest(mode=mode):
+                self.assertMarketsEqual(reader.read_market(self.file_name, mode=mode, batch_size=7), expected)
+
+    def test_parallel_ranges(self):
+        expected = reader.read_market(self.file_name)
+        range_bytes = reader.RANGE_BYTES
+        try:
+            for reader.RANGE_BYTES in (1, 50, 300, 1 << 20):
+                with self.subTest(range_bytes=reader.RANGE_BYTES):
+                    self.assertMarketsEqual(reader.read_market(self.file_name, mode='parallel', workers=3), expected)
+        finally:
+            reader.RANGE_BYTES = range_bytes
+        file_name = write_lines(schema_market_lines(5, 30, 4))
+        try:
+            self.assertMarketsEqual(reader.read_market(file_name, mode='parallel', workers=2),
+                                    reader.read_market(file_name))
+        finally:
+            os.remove(file_name)
+
+    def test_duplicates_keep_first_position_and_last_data(self):
+        market = reader.read_market(self.file_name)
+        self.assertEqual(market.buyer_count, 40)
+        self.assertEqual(market.buyer_names[5], 'H5')
+        self.assertListEqual(list(market.buyer_vector(5)), [1, 2, 3])
+        self.assertListEqual([market.neighborhood_names[n] for n in market.buyer_prefs(5)], ['N1', 'N0'])
+        self.assertListEqual(list(market.neighborhood_vector(1)), [9, 8, 7])
+
+    def test_missing_preferences(self):
+        with self.assertRaises(exceptions.DataParsingError):
+            reader.parse_buyer(b'H H0 E:1 W:2 R:3')
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'market.snap')
+        self.buyers, self.neighborhoods = players_from_lines(random_market_lines(5, buyer_count=20, neighborhood_count=4))
+        self.market = Market.from_players(self.buyers, self.neighborhoods)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        snapshot.save_snapshot(self.file_name, self.market)
+        loaded = snapshot.load_snapshot(self.file_name)
+        TestReader.assertMarketsEqual(self, loaded, self.market)
+        self.assertEqual(loaded.dims, 3)
+
+    def test_loaded_market_matches(self):
+        snapshot.save_snapshot(self.file_name, self.market)
+        expected = array_optimal_match(self.market)
+        actual = array_optimal_match(snapshot.load_snapshot(self.file_name))
+        self.assertListEqual([list(m) for m in actual.members], [list(m) for m in expected.members])
+        self.assertListEqual([list(f) for f in actual.member_fits], [list(f) for f in expected.member_fits])
+
+    def test_rejects_other_files(self):
+        with open(self.file_name, 'wb') as other:
+            other.write(b'N N0 E:1 W:1 R:1\n' * 8)
+        with self.assertRaises(exceptions.DataParsingError):
+            snapshot.load_snapshot(self.file_name)
+
+    def test_values_must_fit_int32(self):
+        self.market.buyer_vectors[0] = 2 ** 40
+        with self.assertRaises(ValueError):
+            snapshot.save_snapshot(self.file_name, self.market)
+
+class TestFitCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.fit_cache = cache.FitCache(self.directory.name)
+        self.buyers, self.neighborhoods = players_from_lines(random_market_lines(9, buyer_count=30, neighborhood_count=5))
+        self.market = Market.from_players(self.buyers, self.neighborhoods)
+        self.lookups = [None] if engine.numpy is None else [None, engine.numpy]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith(cache.SUFFIX))
+
+    def test_hits(self):
+        first, second = MatchStats(), MatchStats()
+        self.assertListEqual(list(self.fit_cache.preference_fits(self.market, first)), list(preference_fits(self.market)))
+        self.assertListEqual(list(self.fit_cache.preference_fits(self.market, second)), list(preference_fits(self.market)))
+        self.assertEqual((first.cache_hits, first.cache_misses), (0, 30))
+        self.assertEqual((second.cache_hits, second.cache_misses), (30, 0))
+        self.assertEqual(len(self.entries()), 1)
+        self.assertIn('fit cache hits: 30 of 30 (100.0%)', str(second))
+
+    def test_rescores_changed_buyers(self):
+        for numpy in self.lookups:
+            with self.subTest(numpy=numpy is not None):
+                cache.numpy = numpy
+                try:
+                    self.fit_cache.preference_fits(self.market)
+                    buyers = list(reversed(self.buyers))[1:]
+                    buyers.append(buyer_from_string('H H99 E:3 W:9 R:2 N2>N0', {n.name: n for n in self.neighborhoods}))
+                    market = Market.from_players(buyers, self.neighborhoods)
+                    market.buyer_vectors[3 * 3] += 1
+                    stats = MatchStats()
+                    self.assertListEqual(list(self.fit_cache.preference_fits(market, stats)),
+                                         list(preference_fits(market)))
+                    self.assertEqual((stats.cache_hits, stats.cache_misses), (28, 2))
+                    stats = MatchStats()
+                    self.fit_cache.preference_fits(market, stats)
+                    self.assertEqual((stats.cache_hits, stats.cache_misses), (30, 0))
+                finally:
+                    cache.numpy = engine.numpy
+                os.remove(os.path.join(self.directory.name, self.entries()[0]))
+
+    def test_shared_profiles(self):
+        lines = random_market_lines(3, buyer_count=4, neighborhood_count=3)
+        lines += [line.replace('H H', 'H G') for line in lines if line[0] == 'H']
+        market = Market.from_players(*players_from_lines(lines))
+        for numpy in self.lookups:
+            with self.subTest(numpy=numpy is not None):
+                cache.numpy = numpy
+                try:
+                    self.assertListEqual(list(self.fit_cache.preference_fits(market)), list(preference_fits(market)))
+                finally:
+                    cache.numpy = engine.numpy
+                entry = cache.load_entry(os.path.join(self.directory.name, self.entries()[0]))
+                self.assertEqual(len(entry.digests), 4)
+                self.assertEqual(len(entry.fits), 12)
+                os.remove(os.path.join(self.directory.name, self.entries()[0]))
+
+    def test_keyed_by_neighborhoods(self):
+        self.fit_cache.preference_fits(self.market)
+        market = Market.from_players(self.buyers, self.neighborhoods)
+        market.neighborhood_vectors[1] += 1
+        stats = MatchStats()
+        self.assertListEqual(list(self.fit_cache.preference_fits(market, stats)), list(preference_fits(market)))
+        self.assertEqual(stats.cache_misses, 30)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_portable_digests(self):
+        # profiles hash as little-endian 8-byte goals and 4-byte preferences, however the columns are stored
+        goals, prefs = (3, 9, 2), (2, 0)
+        expected = hashlib.blake2b(struct.pack('<3q', *goals) + struct.pack('<2i', *prefs), digest_size=8).digest()
+        for typecode in ('i', 'l', 'q'):
+            digests = cache.buyer_digests(array('q', goals), array('q', [0, 2]), array(typecode, prefs))
+            self.assertEqual(digests.tobytes(), expected)
+
+    def test_schema_and_snapshot(self):
+        file_name = write_lines(schema_market_lines(4, buyer_count=10, neighborhood_count=3))
+        try:
+            market = reader.read_market(file_name)
+            self.assertListEqual(list(self.fit_cache.preference_fits(market)), list(preference_fits(market)))
+        finally:
+            os.remove(file_name)
+        snapshot_name = os.path.join(self.directory.name, 'market.snap')
+        snapshot.save_snapshot(snapshot_name, self.market)
+        self.fit_cache.preference_fits(self.market)
+        stats = MatchStats()
+        self.fit_cache.preference_fits(snapshot.load_snapshot(snapshot_name), stats)
+        self.assertEqual(stats.cache_hits, 30)
+
+    def test_evicts_least_recently_used(self):
+        self.fit_cache.preference_fits(self.market)
+        size = os.path.getsize(os.path.join(self.directory.name, self.entries()[0]))
+        older = self.entries()[0]
+        os.utime(os.path.join(self.directory.name, older), (0, 0))
+        self.fit_cache.max_bytes = 2 * size
+        self.market.neighborhood_vectors[1] += 1
+        self.fit_cache.preference_fits(self.market)
+        self.assertEqual(len(self.entries()), 2)
+        self.market.neighborhood_vectors[1] += 1
+        self.fit_cache.preference_fits(self.market)
+        self.assertEqual(len(self.entries()), 2)
+        self.assertNotIn(older, self.entries())
+
+    def test_entry_too_big(self):
+        self.fit_cache.max_bytes = 100
+        self.assertListEqual(list(self.fit_cache.preference_fits(self.market)), list(preference_fits(self.market)))
+        self.assertListEqual(self.entries(), [])
+
+    def test_unreadable_entry(self):
+        self.fit_cache.preference_fits(self.market)
+        entry_name = os.path.join(self.directory.name, self.entries()[0])
+        with open(entry_name, 'r+b') as entry_file:
+            entry_file.truncate(cache.HEADER.size + 8)
+        stats = MatchStats()
+        with self.assertLogs('cache', 'WARNING'):
+            self.assertListEqual(list(self.fit_cache.preference_fits(self.market, stats)),
+                                 list(preference_fits(self.market)))
+        self.assertEqual(stats.cache_misses, 30)
+        self.assertEqual(len(cache.load_entry(entry_name).digests), 30)
+
+    def test_read_input_file(self):
+        expected = [buyer.fits for buyer in read_input_file('test_input.txt')['homebuyers']]
+        for dedupe_buyers in (False, True, False):
+            stats = MatchStats()
+            homebuyers = read_input_file('test_input.txt', intern_profiles=dedupe_buyers, fit_cache=self.fit_cache, stats=stats)['homebuyers']
+            self.assertListEqual([buyer.fits for buyer in homebuyers], expected)
+        self.assertEqual(stats.cache_misses, 0)
+
+class TestMatchingState(unittest.TestCase):
+    def resolved(self, state):
+        """The matching a full re-solve of the state's market would find."""
+        market = Market.from_players(state.buyers, state.neighborhoods)
+        result = array_optimal_match(market, capacities=[n.capacity for n in state.neighborhoods])
+        return {n.name: sorted(state.buyers[b].name for b in members)
+                for n, members in zip(state.neighborhoods, result.members)}
+
+    def current(self, state):
+        return {n.name: sorted(b.name for b in n.matching) for n in state.neighborhoods}
+
+    def has_ties(self, state):
+        for n in state.neighborhoods:
+            fits = [n.get_fitness(b) for b in state.buyers if n in b.prefs]
+            if len(fits) != len(set(fits)):
+                return True
+        return False
+
+    def compare_updates(self, seed, buyer_count, neighborhood_count, steps):
+        """Apply random updates to a state, comparing it with a full re-solve after each one until a fit ties."""
+        rng = random.Random(seed + 1000)
+        buyers, neighborhoods = players_from_lines(
+            random_market_lines(seed, buyer_count=buyer_count, neighborhood_count=neighborhood_count, max_value=1000))
+        state = MatchingState.solve(buyers, neighborhoods)
+        neighborhood_dict = {n.name: n for n in neighborhoods}
+        compared = 0
+        for step in range(steps):
+            operation = rng.choice(['add', 'remove', 'update'])
+            if operation == 'add':
+                prefs = list(neighborhood_dict)
+                rng.shuffle(prefs)
+                state.add_buyer(buyer_from_string(
+                    f'H X{step} E:{rng.randint(0, 1000)} W:{rng.randint(0, 1000)} R:{rng.randint(0, 1000)} '
+                    f'{">".join(prefs[:rng.randint(2, neighborhood_count)])}', neighborhood_dict))
+            elif operation == 'remove':
+                state.remove_buyer(rng.choice(state.buyers))
+            else:
+                state.update_neighborhood(rng.choice(neighborhoods),
+                                          PearlVector(rng.randint(0, 1000), rng.randint(0, 1000), rng.randint(0, 1000)))
+            # with tied fits more than one buyer-optimal matching is possible
+            if self.has_ties(state):
+                break
+            self.assertDictEqual(self.current(state), self.resolved(state), f'seed {seed}, step {step}')
+            compared += 1
+        return compared
+
+    def test_equals_full_resolve(self):
+        compared = sum(self.compare_updates(seed, buyer_count=20, neighborhood_count=4, steps=12) for seed in range(40))
+        self.assertGreater(compared, 400)
+
+    def test_long_update_sequences(self):
+        # the search for each neighborhood's next candidate picks up where the last update left it
+        compared = sum(self.compare_updates(seed, buyer_count=30, neighborhood_count=8, steps=60) for seed in range(10))
+        self.assertGreater(compared, 500)
+
+    def test_remove_fills_vacancy(self):
+        buyers, neighborhoods = players_from_lines(['N N0 E:1 W:1 R:1', 'N N1 E:1 W:0 R:0',
+                                                    'H H0 E:5 W:5 R:5 N0>N1', 'H H1 E:1 W:1 R:1 N0>N1'])
+        state = MatchingState.solve(buyers, neighborhoods)
+        self.assertEqual(buyers[1].matching, neighborhoods[1])
+        state.remove_buyer(buyers[0])
+        self.assertEqual(buyers[1].matching, neighborhoods[0])
+        self.assertListEqual(neighborhoods[1].matching, [])
+        self.assertListEqual(state.unmatched(), [])
+
+class TestPartition(unittest.TestCase):
+    def setUp(self):
+        # three regions whose buyers only rank their own region's neighborhoods
+        rng = random.Random(11)
+        lines = []
+        for region in range(3):
+            names = [f'N{region}_{i}' for i in range(3)]
+            lines += [f'N {name} E:{rng.randint(0, 4)} W:{rng.randint(0, 4)} R:{rng.randint(0, 4)}' for name in names]
+            for i in range(6 + 3 * region):
+                prefs = names[:]
+                rng.shuffle(prefs)
+                lines.append(f'H H{region}_{i} E:{rng.randint(0, 4)} W:{rng.randint(0, 4)} R:{rng.randint(0, 4)} '
+                             f'{">".join(prefs)}')
+        rng.shuffle(lines)
+        self.buyers, self.neighborhoods = players_from_lines(lines)
+        self.market = Market.from_players(self.buyers, self.neighborhoods)
+
+    def test_components(self):
+        found = partition.components(self.market)
+        self.assertEqual(len(found), 3)
+        for neighborhoods, buyers in found:
+            regions = {self.market.neighborhood_names[n].split('_')[0][1:] for n in neighborhoods}
+            regions |= {self.market.buyer_names[b].split('_')[0][1:] for b in buyers}
+            self.assertEqual(len(regions), 1)
+
+    def test_same_result_as_whole_market(self):
+        expected = array_optimal_match(self.market)
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                actual = partition.partitioned_optimal_match(self.market, workers=workers)
+                self.assertListEqual([list(m) for m in actual.members], [list(m) for m in expected.members])
+                self.assertListEqual([list(f) for f in actual.member_fits], [list(f) for f in expected.member_fits])
+
+    def test_match_players(self):
+        expected = match_names(buyer_optimal_match(self.buyers, self.neighborhoods, engine='array'))
+        self.assertDictEqual(match_names(partition.match_players(self.buyers, self.neighborhoods, workers=2)), expected)
+
+class TestDedupe(unittest.TestCase):
+    def profile_market(self, seed, buyer_count, neighborhood_count, profiles, grouped):
+        """A market whose buyers are drawn from a few (goals, preferences) profiles, some of them incomplete."""
+        rng = random.Random(seed)
+        neighborhood_vectors = array('q', [rng.randint(0, 5) for _ in range(3 * neighborhood_count)])
+        templates = [([rng.randint(0, 5) for _ in range(3)],
+                      rng.sample(range(neighborhood_count), rng.randint(1, neighborhood_count))) for _ in range(profiles)]
+        picks = [rng.randrange(profiles) for _ in range(buyer_count)]
+        if grouped:
+            picks.sort()
+        buyer_vectors, offsets, indices = array('q'), array('q', [0]), array('i')
+        for pick in picks:
+            goals, prefs = templates[pick]
+            buyer_vectors.extend(goals)
+            indices.extend(prefs)
+            offsets.append(len(indices))
+        return Market([f'N{n}' for n in range(neighborhood_count)], neighborhood_vectors,
+                      [f'H{b}' for b in range(buyer_count)], buyer_vectors, offsets, indices)
+
+    def test_classes(self):
+        market = self.profile_market(1, buyer_count=50, neighborhood_count=4, profiles=5, grouped=False)
+        classes = dedupe.buyer_classes(market)
+        self.assertLessEqual(len(classes), 5)
+        self.assertEqual(sum(classes.sizes()), 50)
+        for c, members in enumerate(classes.members):
+            self.assertListEqual(list(classes.class_market.buyer_prefs(c)), list(market.buyer_prefs(members[0])))
+            for buyer in members:
+                self.assertEqual(classes.buyer_class()[buyer], c)
+                self.assertListEqual(list(market.buyer_vector(buyer)), list(classes.class_market.buyer_vector(c)))
+                self.assertListEqual(list(market.buyer_prefs(buyer)), list(market.buyer_prefs(members[0])))
+
+    def test_same_result_as_array_engine(self):
+        # with small values there are plenty of tied fits, so proposal order matters
+        for seed in range(60):
+            rng = random.Random(seed)
+            market = self.profile_market(seed, rng.randint(1, 80), rng.randint(1, 6), rng.randint(1, 6), seed % 2 == 0)
+            capacities = array('q', [rng.randint(0, 10) for _ in range(market.neighborhood_count)])
+            expected_stats, stats = MatchStats(), MatchStats()
+            expected = array_optimal_match(market, capacities, stats=expected_stats)
+            result = dedupe.block_optimal_match(market, capacities, stats=stats)
+            self.assertListEqual([list(members) for members in result.members],
+                                 [list(members) for members in expected.members], f'seed {seed}')
+            self.assertListEqual([list(fits) for fits in result.member_fits],
+                                 [list(fits) for fits in expected.member_fits], f'seed {seed}')
+            self.assertEqual((stats.proposals, stats.rejections, stats.displacements),
+                             (expected_stats.proposals, expected_stats.rejections, expected_stats.displacements))
+
+    def test_blocks_in_a_shuffled_market(self):
+        # shuffled markets usually go straight to the array engine; make sure blocks get them right too
+        minimum = dedupe.MIN_BLOCK
+        dedupe.MIN_BLOCK = 0
+        try:
+            for seed in range(30):
+                market = self.profile_market(seed, 60, 4, 4, grouped=False)
+                self.assertListEqual([list(members) for members in dedupe.block_optimal_match(market).members],
+                                     [list(members) for members in array_optimal_match(market).members], f'seed {seed}')
+        finally:
+            dedupe.MIN_BLOCK = minimum
+
+    def test_read_input_file(self):
+        lines = ['N N0 E:1 W:2 R:3', 'N N1 E:3 W:2 R:1', 'N N2 E:2 W:2 R:2']
+        lines += [f'H H{i} E:{i % 2} W:1 R:{2 - i % 2} {"N0>N1>N2" if i % 2 else "N2>N1>N0"}' for i in range(12)]
+        file_name = write_lines(lines)
+        try:
+            input_data = read_input_file(file_name, intern_profiles=True)
+            buyers = input_data['homebuyers']
+            self.assertIs(buyers[0].goals, buyers[2].goals)
+            self.assertIs(buyers[0].prefs, buyers[2].prefs)
+            self.assertDictEqual(buyers[0].fits, {'N0': 8, 'N1': 4, 'N2': 6})
+            self.assertDictEqual(buyers[2].fits, buyers[0].fits)
+            matches = match_names(dedupe.match_players(buyers, input_data['neighborhoods']))
+            input_data = read_input_file(file_name)
+            self.assertDictEqual(matches, match_names(buyer_optimal_match(input_data['homebuyers'],
+                                                                          input_data['neighborhoods'])))
+        finally:
+            os.remove(file_name)
+
+class TestScenarios(unittest.TestCase):
+    DELTAS = [
+        'SCENARIO resilient',
+        'N N2 R:9',
+        'SCENARIO crowded',
+        'C N0 9',
+        'H H3 E:9 W:9 R:9 N0>N1',
+        'H H90 E:1 W:2 R:3 N1>N0>N7',
+        'R H5',
+        'SCENARIO everything',
+        'N N0 E:0 W:10',
+        'N N1 E:4',
+        'R H0',
+        'R H1',
+        'H H1 E:5 W:5 R:5 N3>N2>N1>N0',
+        'C N3 0',
+        'SCENARIO unchanged',
+    ]
+
+    def edited(self, lines, scenario):
+        """The input lines with `scenario` applied by hand."""
+        lines = list(lines)
+        overrides = {name: {key: str(value) for key, value in values.items()}
+                     for name, values in scenario.characteristics.items()}
+        for name, capacity in scenario.capacities.items():
+            overrides.setdefault(name, {})['C'] = str(capacity)
+        for name, values in overrides.items():
+            i = next(i for i, line in enumerate(lines) if line.split()[:2] == ['N', name])
+            tokens = dict(token.split(':') for token in lines[i].split()[2:])
+            tokens.update(values)
+            lines[i] = f"N {name} {' '.join(f'{key}:{value}' for key, value in tokens.items())}"
+        lines = [line for line in lines if not (line[0] == 'H' and line.split()[1] in scenario.removed)]
+        for name, goals, prefs in scenario.added:
+            line = f"H {name} E:{goals[0]} W:{goals[1]} R:{goals[2]} {'>'.join(prefs)}"
+            rows = [i for i, existing in enumerate(lines) if existing[0] == 'H' and existing.split()[1] == name]
+            if rows:
+                lines[rows[0]] = line
+            else:
+                lines.append(line)
+        return lines
+
+    def assignment(self, result):
+        names = result.market.neighborhood_names
+        return {buyer: names[n] if n >= 0 else None for buyer, n in zip(result.market.buyer_names, result.buyer_match)}
+
+    def test_same_result_as_edited_input(self):
+        lines = random_market_lines(7, buyer_count=40, neighborhood_count=4, max_value=4)
+        input_file, deltas_file = write_lines(lines), write_lines(self.DELTAS)
+        try:
+            market = reader.read_market(input_file)
+            runner = scenarios.ScenarioRunner.from_market(market, workers=1)
+            baseline = self.assignment(runner.baseline)
+            deltas = scenarios.read_scenarios(deltas_file)
+            self.assertListEqual([scenario.name for scenario in deltas], ['resilient', 'crowded', 'everything', 'unchanged'])
+            for scenario, diff in zip(deltas, runner.run(deltas)):
+                edited_file = write_lines(self.edited(lines, scenario))
+                try:
+                    edited = reader.read_market(edited_file)
+                finally:
+                    os.remove(edited_file)
+                expected = self.assignment(array_optimal_match(edited))
+
+                assignment = dict(baseline)
+                for buyer, before, after in diff.moved:
+                    self.assertEqual(assignment[buyer], before)
+                    assignment[buyer] = after
+                for buyer, before in diff.removed:
+                    self.assertEqual(assignment.pop(buyer), before)
+                for buyer, after in diff.added:
+                    assignment[buyer] = after
+                self.assertDictEqual(assignment, expected, scenario.name)
+                self.assertTrue(str(diff).startswith(f'SCENARIO {scenario.name}: {len(diff.moved)} moved'))
+            self.assertEqual(str(runner.solve(deltas[-1])), 'SCENARIO unchanged: 0 moved, 0 added, 0 removed')
+            self.assertListEqual([str(diff) for diff in scenarios.ScenarioRunner.from_market(market, workers=2).run(deltas)],
+                                 [str(diff) for diff in runner.run(deltas)])
+        finally:
+            os.remove(input_file)
+            os.remove(deltas_file)
+
+    def test_capacity_override(self):
+        # the neighborhoods without an override share the buyers it leaves over, as if it were declared
+        with open('test_input.txt') as input_file:
+            lines = [line for line in input_file.read().splitlines() if line.strip()]
+        deltas_file = write_lines(['SCENARIO big', 'C N0 10'])
+        try:
+            scenario, = scenarios.read_scenarios(deltas_file)
+        finally:
+            os.remove(deltas_file)
+        edited_file = write_lines(self.edited(lines, scenario))
+        try:
+            data = read_input_file(edited_file)
+        finally:
+            os.remove(edited_file)
+        expected = match_names(buyer_optimal_match(data['homebuyers'], data['neighborhoods']))
+        self.assertDictEqual(expected, {'N0': ['H3', 'H5', 'H11', 'H2', 'H4', 'H10', 'H1', 'H7', 'H0', 'H8'],
+                                        'N1': ['H9'], 'N2': ['H6']})
+
+        runner = scenarios.ScenarioRunner.from_market(reader.read_market('test_input.txt'), workers=1)
+        _, _, capacities, _ = runner.apply(scenario)
+        self.assertListEqual(list(capacities), [10, 1, 1])
+        assignment = self.assignment(runner.baseline)
+        for buyer, before, after in runner.solve(scenario).moved:
+            assignment[buyer] = after
+        self.assertDictEqual({name: sorted(members) for name, members in expected.items()},
+                             {name: sorted(b for b, n in assignment.items() if n == name) for name in expected})
+
+    def test_refit(self):
+        for lines in (random_market_lines(3, 30, 5), schema_market_lines(3, 30, 5)):
+            file_name = write_lines(lines)
+            try:
+                market = reader.read_market(file_name)
+            finally:
+                os.remove(file_name)
+            vectors = array(market.schema.typecode, market.neighborhood_vectors)
+            vectors[1 * market.dims] = 7
+            vectors[4 * market.dims + 2] = 2
+            changed = Market(market.neighborhood_names, vectors, market.buyer_names, market.buyer_vectors,
+                             market.pref_offsets, market.pref_indices, market.schema)
+            self.assertListEqual(list(refit(market, preference_fits(market), [1, 4], vectors)),
+                                 list(preference_fits(changed)))
+
+    def test_bad_deltas(self):
+        for deltas in (['N N0 E:1'], ['SCENARIO a', 'N N0 X:1'], ['SCENARIO a', 'C N0'], ['SCENARIO a', 'H H1 E:1 W:1 R:1'],
+                       ['SCENARIO'], ['SCENARIO a', 'R']):
+            file_name = write_lines(deltas)
+            try:
+                with self.assertRaises(exceptions.DataParsingError, msg=deltas):
+                    scenarios.read_scenarios(file_name)
+            finally:
+                os.remove(file_name)
+
+    def test_unknown_names(self):
+        market = Market(['N0', 'N1'], array('q', [1, 2, 3, 3, 2, 1]), ['H0', 'H1'], array('q', [1, 1, 1, 2, 2, 2]),
+                        array('q', [0, 2, 4]), array('i', [0, 1, 1, 0]))
+        runner = scenarios.ScenarioRunner.from_market(market, workers=1)
+        for delta in ('N N9 E:1', 'C N9 1', 'R H9'):
+            file_name = write_lines(['SCENARIO bad', delta])
+            try:
+                scenario, = scenarios.read_scenarios(file_name)
+            finally:
+                os.remove(file_name)
+            with self.assertRaises(ValueError, msg=delta):
+                runner.solve(scenario)
+
+class TestStats(unittest.TestCase):
+    def check_counts(self, stats, matches):
+        # every proposal is either rejected or accepted, and every acceptance either lasted or was undone
+        matched = sum(len(buyers) for buyers in matches.values())
+        self.assertEqual(stats.proposals - stats.rejections, matched + stats.displacements)
+
+    def test_engines(self):
+        found = {}
+        for engine in match.ENGINES:
+            data = read_input_file('test_input.txt')
+            stats = MatchStats()
+            matches = buyer_optimal_match(data['homebuyers'], data['neighborhoods'], engine=engine, stats=stats)
+            self.check_counts(stats, matches)
+            self.assertTrue({'setup', 'match'} <= set(stats.phases))
+            found[engine] = stats
+        self.assertEqual(found['object'].displacements, found['array'].displacements)
+        self.assertEqual(found['object'].longest_chain, found['array'].longest_chain)
+        # displaced buyers in the object engine start again from their first preference
+        self.assertGreaterEqual(found['object'].proposals, found['array'].proposals)
+
+    def test_skewed_market(self):
+        buyers, neighborhoods = players_from_lines(list(bench.generate_lines(60, 4, seed=2, skew='top')))
+        stats = MatchStats()
+        matches = buyer_optimal_match(buyers, neighborhoods, engine='array', stats=stats)
+        self.check_counts(stats, matches)
+        self.assertGreater(stats.displacements, 0)
+        self.assertGreater(stats.longest_chain, 0)
+
+    def test_partitioned_stats(self):
+        market = Market.from_players(*players_from_lines(random_market_lines(5, 30, 4)))
+        whole = MatchStats()
+        array_optimal_match(market, stats=whole)
+        merged = MatchStats()
+        partition.partitioned_optimal_match(market, workers=1, stats=merged)
+        self.assertDictEqual({k: v for k, v in merged.as_dict().items() if k != 'phases'},
+                             {k: v for k, v in whole.as_dict().items() if k != 'phases'})
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_collapsed(self, stage):
+        stacks = {}
+        with open(os.path.join(self.directory.name, f'{stage}.collapsed')) as collapsed:
+            for line in collapsed:
+                stack, count = line.rsplit(' ', 1)
+                stacks[stack] = int(count)
+        return stacks
+
+    def test_cprofile(self):
+        buyers, neighborhoods = players_from_lines(random_market_lines(1, buyer_count=300, neighborhood_count=5))
+        with profiling.Profiler(self.directory.name, mode='cprofile') as profiler:
+            expected = match_names(buyer_optimal_match(buyers, neighborhoods, stats=profiler))
+        self.assertGreater(profiler.proposals, 0)
+        self.assertListEqual(sorted(profiler.phases), ['match', 'setup'])
+        stats = pstats.Stats(os.path.join(self.directory.name, 'match.pstats'))
+        self.assertTrue(any(name == '_match_pair' for _, _, name in stats.stats))
+        stacks = self.read_collapsed('match')
+        self.assertTrue(all(stack.split(';')[-1] for stack in stacks))
+        self.assertTrue(any(stack.startswith('_match_pair (match.py') for stack in stacks))
+        # profiling changes nothing about the result
+        buyers, neighborhoods = players_from_lines(random_market_lines(1, buyer_count=300, neighborhood_count=5))
+        self.assertDictEqual(match_names(buyer_optimal_match(buyers, neighborhoods)), expected)
+
+    def test_sampling(self):
+        def busy(seconds):
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                pass
+
+        with profiling.Profiler(self.directory.name, interval=0.001) as profiler:
+            with profiler.phase('busy'):
+                busy(0.1)
+        stacks = self.read_collapsed('busy')
+        self.assertGreater(sum(stacks.values()), 0)
+        self.assertTrue(any(stack.split(';')[-1].startswith('busy (test.py') for stack in stacks))
+        stats = pstats.Stats(os.path.join(self.directory.name, 'busy.pstats'))
+        busy_entry = next(entry for function, entry in stats.stats.items() if function[2] == 'busy')
+        # samples are scaled to the stage's measured time
+        self.assertGreater(busy_entry[2], 0)
+        self.assertLessEqual(busy_entry[2], profiler.phases['busy'] + 1e-9)
+        self.assertAlmostEqual(sum(entry[2] for entry in stats.stats.values()), profiler.phases['busy'], delta=1e-6)
+
+    def test_nested_stages(self):
+        def inner():
+            return sum(range(1000))
+
+        with profiling.Profiler(self.directory.name, mode='cprofile') as profiler:
+            with profiler.phase('outer'):
+                with profiler.phase('inner'):
+                    inner()
+        self.assertFalse(any('inner' in stack.split(';')[-1] for stack in self.read_collapsed('outer')))
+        self.assertTrue(any('inner (test.py' in stack for stack in self.read_collapsed('inner')))
+
+    def test_collapse_call_graph(self):
+        root, child, leaf = ('a.py', 1, 'root'), ('a.py', 5, 'child'), ('~', 0, '<len>')
+        stats = {
+            root: (1, 1, 1.0, 4.0, {}),
+            child: (2, 2, 1.0, 3.0, {root: (2, 2, 1.0, 3.0)}),
+            leaf: (4, 4, 2.0, 2.0, {child: (4, 4, 2.0, 2.0)}),
+        }
+        self.assertDictEqual(profiling.collapse_call_graph(stats), {
+            'root (a.py:1)': 1000000,
+            'root (a.py:1);child (a.py:5)': 1000000,
+            'root (a.py:1);child (a.py:5);<len>': 2000000,
+        })
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            profiling.Profiler(self.directory.name, mode='perf')
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.buyers, self.neighborhoods = players_from_lines(random_market_lines(4, buyer_count=20, neighborhood_count=4))
+
+    def verify_array(self, result):
+        """Both ways of checking an `ArrayMatching`, which must agree."""
+        report = verify.verify_array(result)
+        numpy = verify.numpy
+        verify.numpy = None
+        try:
+            fallback = verify.verify_array(result)
+        finally:
+            verify.numpy = numpy
+        self.assertListEqual(sorted(report.blocking_pairs), sorted(fallback.blocking_pairs))
+        self.assertListEqual(report.unacceptable, fallback.unacceptable)
+        return report
+
+    def test_solutions_are_stable(self):
+        matches = buyer_optimal_match(self.buyers, self.neighborhoods)
+        self.assertTrue(verify.verify_stable(matches, self.buyers).stable)
+        report = self.verify_array(array_optimal_match(Market.from_players(self.buyers, self.neighborhoods)))
+        self.assertTrue(report.stable)
+        self.assertEqual(str(report), 'matching is stable')
+
+    def test_blocking_pairs(self):
+        market = Market.from_players(self.buyers, self.neighborhoods)
+        result = array_optimal_match(market)
+        # take the first neighborhood's best match out of it, leaving them unmatched
+        first = result.members[0][0]
+        result.members[0] = result.members[0][1:]
+        result.member_fits[0] = result.member_fits[0][1:]
+        result.buyer_match[first] = -1
+        report = self.verify_array(result)
+        self.assertIn((market.buyer_names[first], market.neighborhood_names[0]), report.blocking_pairs)
+
+        matches = buyer_optimal_match(self.buyers, self.neighborhoods)
+        neighborhood = self.neighborhoods[0]
+        buyer = matches[neighborhood][0]
+        matches[neighborhood] = matches[neighborhood][1:]
+        report = verify.verify_stable(matches, self.buyers)
+        self.assertIn((buyer.name, neighborhood.name), report.blocking_pairs)
+
+    def test_capacity_and_unacceptable_matches(self):
+        buyers, neighborhoods = players_from_lines([
+            'N N0 E:1 W:1 R:1', 'N N1 E:1 W:1 R:1', 'H H0 E:1 W:1 R:1 N0>N9', 'H H1 E:2 W:2 R:2 N0>N1'])
+        for n in neighborhoods:
+            n.capacity = 1
+        report = verify.verify_stable({neighborhoods[0]: [], neighborhoods[1]: buyers[:]}, buyers)
+        self.assertListEqual(report.capacity_violations, [('N1', 2, 1)])
+        self.assertListEqual(report.unacceptable, [('H0', 'N1')])
+        self.assertFalse(report.stable)
+
+        market = Market.from_players(buyers, neighborhoods)
+        result = engine.ArrayMatching(market, array('q', [1, 1]), [array('i'), array('i', [1, 0])],
+                                      [array('q'), array('q', [6, 3])])
+        report = self.verify_array(result)
+        self.assertListEqual(report.capacity_violations, [('N1', 2, 1)])
+        self.assertListEqual(report.unacceptable, [('H0', 'N1')])
+
+    def test_no_room(self):
+        buyers, neighborhoods = players_from_lines(['N N0 E:1 W:1 R:1', 'H H0 E:1 W:1 R:1 N0>N0'])
+        result = array_optimal_match(Market.from_players(buyers, neighborhoods), capacities=[0])
+        self.assertTrue(self.verify_array(result).stable)
+
+
+class TestOutput(unittest.TestCase):
+    def setUp(self):
+        self.buyers, self.neighborhoods = players_from_lines(random_market_lines(6, buyer_count=30, neighborhood_count=3))
+        self.matches = buyer_optimal_match(self.buyers, self.neighborhoods)
+        self.result = array_optimal_match(Market.from_players(self.buyers, self.neighborhoods))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def read(self, name):
+        with open(self.path(name)) as output_file:
+            return output_file.read()
+
+    def test_text_in_chunks(self):
+        expected = ''.join(f"{n.name}: {' '.join(f'{b.name}({b.get_fitness(n)})' for b in buyers)}\n"
+                           for n, buyers in self.matches.items())
+        chunk = output.CHUNK
+        output.CHUNK = 3
+        try:
+            match.write_output_file(self.path('objects.txt'), self.matches)
+            match.write_matching(self.path('arrays.txt'), self.result)
+        finally:
+            output.CHUNK = chunk
+        self.assertEqual(self.read('objects.txt'), expected)
+        self.assertEqual(self.read('arrays.txt'), expected)
+
+    def test_assignments(self):
+        expected = [(b.name, self.neighborhoods.index(b.matching), b.get_fitness(b.matching)) for b in self.buyers]
+        self.assertListEqual(list(output.match_assignments(self.buyers, self.matches)), expected)
+        self.assertListEqual(list(output.matching_assignments(self.result)), expected)
+
+        output.write_assignments(self.path('assignments.csv'), output.matching_assignments(self.result))
+        lines = self.read('assignments.csv').splitlines()
+        self.assertEqual(lines[0], 'buyer,neighborhood,fit')
+        self.assertListEqual(lines[1:], [f'{b},{n},{fit}' for b, n, fit in expected])
+
+        output.write_assignments(self.path('assignments.bin'), output.matching_assignments(self.result), binary=True)
+        self.assertListEqual(output.read_assignments(self.path('assignments.bin')), [(n, fit) for _, n, fit in expected])
+
+    def test_unmatched_assignments(self):
+        buyers, neighborhoods = players_from_lines(['N N0 E:1 W:1 R:1', 'H H0 E:1 W:1 R:1 N0>N1', 'H H1 E:2 W:2 R:2 N0>N1'])
+        result = array_optimal_match(Market.from_players(buyers, neighborhoods), capacities=[1])
+        self.assertListEqual(list(output.matching_assignments(result)), [('H0', -1, 0), ('H1', 0, 6)])
+
+    def test_shards(self):
+        file_names = output.write_shards(self.path('shards'), output.matching_rows(self.result), workers=2)
+        self.assertListEqual(file_names, [self.path(os.path.join('shards', f'{n.name}.txt')) for n in self.neighborhoods])
+        for n, buyers in self.matches.items():
+            self.assertEqual(self.read(os.path.join('shards', f'{n.name}.txt')),
+                             ''.join(f'{b.name}({b.get_fitness(n)})\n' for b in buyers))
+        with self.assertRaises(ValueError):
+            output.write_shards(self.path('shards'), [(os.path.join('..', 'N0'), [])])
+
+
+class TestServer(unittest.TestCase):
+    def start(self, workers=0, tcp=False):
+        """Start a server in a thread, and return a connected client."""
+        self.directory = tempfile.TemporaryDirectory()
+        started = threading.Event()
+        addresses = []
+
+        def ready(address):
+            addresses.append(address)
+            started.set()
+
+        match_server = server.MatchServer(workers)
+        path = None if tcp else os.path.join(self.directory.name, 'match.sock')
+        self.thread = threading.Thread(target=asyncio.run, args=(match_server.serve(path, port=0, ready=ready),))
+        self.thread.start()
+        self.assertTrue(started.wait(10))
+        if tcp:
+            return server.MatchClient(host=addresses[0][0], port=addresses[0][1])
+        return server.MatchClient(path)
+
+    def stop(self, client):
+        client.shutdown()
+        client.close()
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.directory.cleanup()
+
+    def check_session(self, client):
+        expected = array_optimal_match(reader.read_market('test_input.txt'))
+        loaded = client.load('sample', os.path.abspath('test_input.txt'))
+        self.assertEqual((loaded['buyers'], loaded['neighborhoods']), (12, 3))
+        self.assertEqual(client.match('sample')['unmatched'], 0)
+        names = list(expected.market.buyer_names)
+        assignments = client.assignment('sample', names)
+        for buyer, name in enumerate(names):
+            neighborhood = expected.buyer_match[buyer]
+            self.assertEqual(assignments[name]['neighborhood'], expected.market.neighborhood_names[neighborhood])
+            self.assertEqual(assignments[name]['fit'],
+                             expected.member_fits[neighborhood][list(expected.members[neighborhood]).index(buyer)])
+        self.assertEqual(client.match('sample', capacities=[1, 0, 2])['matched'], 3)
+        self.assertEqual(sum(value is not None for value in client.assignment('sample', names).values()), 3)
+
+    def test_session(self):
+        client = self.start()
+        try:
+            self.check_session(client)
+        finally:
+            self.stop(client)
+
+    def test_worker_processes_over_tcp(self):
+        client = self.start(workers=1, tcp=True)
+        try:
+            self.check_session(client)
+        finally:
+            self.stop(client)
+
+    def test_errors(self):
+        client = self.start()
+        try:
+            for op, fields in (('nothing', {}), ('match', {'market': 'missing'}), ('load', {'market': 'x'}),
+                               ('load', {'market': 'x', 'path': 'no_such_file.txt'})):
+                with self.subTest(op=op, fields=fields):
+                    with self.assertRaises(exceptions.ServerError):
+                        client.request(op, **fields)
+            client.load('sample', os.path.abspath('test_input.txt'))
+            with self.assertRaises(exceptions.ServerError):
+                client.assignment('sample', ['H0'])
+            with self.assertRaises(exceptions.ServerError):
+                client.match('sample', capacities=[1, 2])
+            self.assertEqual(client.request('match', market='sample', id=7)['id'], 7)
+            with self.assertRaises(exceptions.ServerError):
+                client.assignment('sample', ['NOBODY'])
+            client.unload('sample')
+            self.assertNotIn('sample', server._resident)
+            with self.assertRaises(exceptions.ServerError):
+                client.match('sample')
+        finally:
+            self.stop(client)
+
+    def test_changed_source_is_refused(self):
+        file_name = write_lines(random_market_lines(1, buyer_count=12, neighborhood_count=3))
+        client = self.start(workers=1)
+        try:
+            client.load('market', file_name)
+            # the worker reads the market for itself on its first solve, and finds it isn't what was loaded
+            with open(file_name, 'w') as input_file:
+                input_file.write('\n'.join(random_market_lines(2, buyer_count=12, neighborhood_count=3)))
+            with self.assertRaises(exceptions.ServerError):
+                client.match('market')
+            client.load('market', file_name)
+            self.assertEqual(client.match('market')['unmatched'], 0)
+        finally:
+            self.stop(client)
+            os.remove(file_name)
+
+    def test_resident_markets(self):
+        source = {'path': 'test_input.txt', 'reader': 'stream'}
+        crc = server._crc(reader.read_market('test_input.txt'))
+        try:
+            server._solve('sample', 1, source, crc, None)
+            self.assertEqual(server._resident['sample'][0], 1)
+            self.assertIsNotNone(server._resident['sample'][2])
+            # only the generation the worker holds is evicted
+            server._evict('sample', 2)
+            self.assertIn('sample', server._resident)
+            server._evict('sample', 1)
+            self.assertNotIn('sample', server._resident)
+            with self.assertRaises(ValueError):
+                server._resident_market('sample', 3, source, crc + 1)
+        finally:
+            server._resident.pop('sample', None)
+
+class TestBench(unittest.TestCase):
+    def test_generator_is_seeded(self):
+        first = list(bench.generate_lines(50, 5, seed=3, skew='zipf'))
+        self.assertListEqual(first, list(bench.generate_lines(50, 5, seed=3, skew='zipf')))
+        self.assertNotEqual(first, list(bench.generate_lines(50, 5, seed=4, skew='zipf')))
+        self.assertEqual(len(first), 55)
+
+    def test_top_skew(self):
+        lines = list(bench.generate_lines(20, 4, skew='top', preferences=3))
+        for line in lines[4:]:
+            self.assertTrue(line.endswith(tuple(f' N0>{rest}' for rest in ('N1>N2', 'N1>N3', 'N2>N1', 'N2>N3', 'N3>N1', 'N3>N2'))))
+
+    def test_capacity(self):
+        lines = list(bench.generate_lines(20, 4, capacity=3))
+        self.assertTrue(all(line.endswith(' C:3') for line in lines[:4]))
+        self.assertFalse(any(' C:' in line for line in bench.generate_lines(20, 4)))
+
+    def test_scan_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'market.txt')
+            bench.generate_market(input_file, 40, 4, seed=1, capacity=5)
+            results = bench.scan_benchmark(input_file, repeats=1)
+            self.assertEqual(results['scan']['proposals'], results['one_at_a_time']['proposals'])
+            self.assertEqual(results['one_at_a_time']['scanned'], 0)
+
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'market.txt')
+            bench.generate_market(input_file, 40, 4, seed=1)
+            for engine in match.ENGINES:
+                stages = bench.run_benchmark(input_file, engine)
+                self.assertTrue({'parse', 'match', 'output'} <= set(stages))
+                self.assertIn('peak_bytes', stages['parse'])
+
+    def test_serve_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = os.path.join(directory, 'market.txt')
+            bench.generate_market(input_file, 40, 4, seed=1)
+            results = bench.serve_benchmark(input_file, requests=4, clients=2, workers=0, cli_requests=1)
+            self.assertEqual(results['requests'], 4)
+            self.assertGreater(results['server_rps'], 0)
+            self.assertGreater(results['cli_rps'], 0)
+
+    def test_compare(self):
+        run = {'buyers': 10, 'neighborhoods': 2, 'skew': 'uniform', 'preferences': None, 'engine': 'array',
+               'stages': {'match': {'seconds': 1.0}}}
+        slower = dict(run, stages={'match': {'seconds': 1.5}})
+        self.assertListEqual(bench.compare({'runs': [run]}, {'runs': [run]}), [])
+        self.assertEqual(len(bench.compare({'runs': [slower]}, {'runs': [run]})), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,26 +1,166 @@
-from functools import reduce
+"""Attribute vectors, and the schemas that say what their attributes are.
+
+A `Schema` names the attributes every vector in a market has, in order, and how much each counts towards
+a fit: the fit of a buyer to a neighborhood is the weighted sum of the products of their attributes. The
+E/W/R format of the brief is the predefined `PEARL` schema – integer values, every weight 1 – and its
+vectors are `PearlVector`s. Any other schema is declared in the input with an ``S`` line of
+``KEY:weight`` tokens, and its vectors are `AttributeVector`s of floats:
+
+    S ENERGY:1 WATER:1 RESILIENCE:0.5 TRANSIT:2.25
+
+An ``N`` line may also give the neighborhood's capacity as a ``C:count`` token, as long as the schema has no
+``C`` attribute of its own.
+
+Vectors are stored in flat typed arrays, and whole markets of them are scored in batches by `fits`; the
+``@`` operator here is for the odd pair that isn't.
+"""
+from array import array
 import operator
-from typing import List
+from typing import Dict, List, Optional, Sequence
+
+import exceptions
+
+class Schema:
+    """The attributes of a market's vectors.
+
+    Parameters
+    ----------
+    keys : Sequence[str]
+        The attribute names, in the order their values are stored.
+    weights : Optional[Sequence[float]]
+        How much each attribute counts towards a fit; all 1 if not given.
+    typecode : str
+        The `array` typecode values are stored as: 'd' for floats, or 'q' for integers.
+    """
+
+    def __init__(self, keys: Sequence[str], weights: Optional[Sequence[float]] = None, typecode: str = 'd') -> None:
+        self.keys = tuple(keys)
+        self.index: Dict[str, int] = {key: i for i, key in enumerate(self.keys)}
+        if len(self.index) != len(self.keys):
+            raise ValueError(f"Schema has repeated keys: {self.keys}")
+        if weights is not None and len(weights) != len(self.keys):
+            raise ValueError(f"Schema has {len(self.keys)} keys but {len(weights)} weights")
+        self.weights = None if weights is None else array('d', weights)
+        self.typecode = typecode
+
+    def __repr__(self):
+        weights = self.weights if self.weights is not None else [1] * len(self.keys)
+        return f"Schema({' '.join(f'{key}:{weight}' for key, weight in zip(self.keys, weights))})"
+
+    @property
+    def dims(self) -> int:
+        return len(self.keys)
+
+    @property
+    def fit_typecode(self) -> str:
+        """The `array` typecode of fits: integers only for integer values with no weights."""
+        return 'q' if self.typecode == 'q' and self.weights is None else 'd'
+
+    def convert(self, value):
+        """A single value, as this schema stores it."""
+        return int(value) if self.typecode == 'q' else float(value)
+
+    def values(self, tokens: Sequence, line: str = '') -> List:
+        """The values of ``KEY:value`` tokens, in key order.
+
+        Every key must be given exactly once, and no others; tokens may be `str` or `bytes`.
+        """
+        values: List = [None] * len(self.keys)
+        index = self.index
+        for token in tokens:
+            key, value = token.split(b':' if isinstance(token, bytes) else ':')
+            i = index.get(key.decode() if isinstance(key, bytes) else key)
+            if i is None or values[i] is not None:
+                raise exceptions.DataParsingError(line or ' '.join(map(str, tokens)))
+            values[i] = self.convert(value)
+        if None in values:
+            raise exceptions.DataParsingError(line or ' '.join(map(str, tokens)))
+        return values
+
+    def vector(self, values: Sequence):
+        """A vector of this schema holding `values`, in key order."""
+        if self is PEARL:
+            return PearlVector(*values)
+        return AttributeVector(self, values)
+
+    def parse(self, tokens: Sequence, line: str = ''):
+        """The vector described by ``KEY:value`` tokens."""
+        return self.vector(self.values(tokens, line))
+
+    @staticmethod
+    def from_tokens(tokens: Sequence[str]) -> 'Schema':
+        """A float-valued schema from ``KEY:weight`` tokens, as given on an ``S`` line."""
+        keys = []
+        weights = []
+        for token in tokens:
+            key, weight = token.split(':')
+            keys.append(key)
+            weights.append(float(weight))
+        return Schema(keys, weights)
+
+# the key of a neighborhood's capacity on its ``N`` line, unless the schema has an attribute of that name
+CAPACITY_KEY = 'C'
+
+def parse_capacity(value) -> int:
+    """A capacity from an ``N`` line, as `str` or `bytes`."""
+    capacity = int(value)
+    if capacity < 0:
+        raise ValueError(f"Negative capacity {capacity}")
+    return capacity
+
+# the E/W/R format of the brief
+PEARL = Schema(('E', 'W', 'R'), typecode='q')
 
 class PearlVector:
+    __slots__ = ('energy', 'water', 'resilience')
+
+    schema = PEARL
+
     def __init__(self, energy, water, resilience) -> None:
         self.energy = energy
         self.water = water
         self.resilience = resilience
-    
+
     def _to_list(self):
         return [self.energy, self.water, self.resilience]
-    
+
     def __matmul__(self, other):
-        self_list = self._to_list()
-        other_list = other._to_list()
-        return reduce(operator.add, [s * o for s, o in zip(self_list, other_list)], 0)
+        # spelled out rather than zipped and reduced: this is called for every pair that isn't batched
+        # through `fits.gather_fits`
+        return self.energy * other.energy + self.water * other.water + self.resilience * other.resilience
 
     @staticmethod
     def from_tokens(tokens: List[str]) -> object:
         values = {}
         for token in tokens:
             key, value = token.split(':')
-            # using int here for conformity with the brief, but it could be float to accommodate finer-grained ratings
+            # using int here for conformity with the brief; other schemas use floats
             values[key] = int(value)
-        return PearlVector(energy=values['E'], water=values['W'], resilience=values['R'])
\ No newline at end of file
+        return PearlVector(energy=values['E'], water=values['W'], resilience=values['R'])
+
+class AttributeVector:
+    """A vector of any `Schema`, its values held in one typed `array`."""
+
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema: Schema, values: Sequence) -> None:
+        if len(values) != schema.dims:
+            raise ValueError(f"Expected {schema.dims} values for {schema}, got {len(values)}")
+        self.schema = schema
+        self.values = array(schema.typecode, values)
+
+    def __repr__(self):
+        return f"AttributeVector({', '.join(f'{key}={value}' for key, value in zip(self.schema.keys, self.values))})"
+
+    def __getitem__(self, key: str):
+        return self.values[self.schema.index[key]]
+
+    def _to_list(self):
+        return self.values.tolist()
+
+    def __matmul__(self, other):
+        products = map(operator.mul, self.values, other.values)
+        weights = self.schema.weights
+        if weights is not None:
+            products = map(operator.mul, products, weights)
+        return sum(products)
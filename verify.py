@@ -0,0 +1,164 @@
+"""Checking that a matching is stable before it is published.
+
+A matching is stable when no buyer and neighborhood would both rather be matched to each other than to
+what they have: the buyer ranks the neighborhood above their match (or is unmatched), and the neighborhood
+either has room or fits the buyer better than its worst match. Such a pair is a blocking pair.
+
+Rather than compare every buyer with every neighborhood they list, we work out once, for each
+neighborhood, the lowest fit a buyer needs to displace someone – its minimum matched fit, or nothing at
+all if it has room. Each buyer then only has to be checked against the neighborhoods they rank above their
+match, so the whole check is a single pass over the preferences. For an `ArrayMatching` that pass is
+vectorized when NumPy is installed.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from engine import ArrayMatching
+from fits import numpy, preference_fits
+
+class StabilityReport:
+    """What `verify_stable` found.
+
+    Attributes
+    ----------
+    blocking_pairs : List[Tuple[str, str]]
+        (buyer name, neighborhood name) pairs who would both rather be matched to each other.
+    capacity_violations : List[Tuple[str, int, int]]
+        (neighborhood name, matched buyers, capacity) for every neighborhood holding more buyers than it can.
+    unacceptable : List[Tuple[str, str]]
+        (buyer name, neighborhood name) pairs matched although the buyer doesn't list the neighborhood.
+    """
+
+    def __init__(self) -> None:
+        self.blocking_pairs: List[Tuple[str, str]] = []
+        self.capacity_violations: List[Tuple[str, int, int]] = []
+        self.unacceptable: List[Tuple[str, str]] = []
+
+    @property
+    def stable(self) -> bool:
+        return not (self.blocking_pairs or self.capacity_violations or self.unacceptable)
+
+    def __str__(self):
+        if self.stable:
+            return "matching is stable"
+        lines = [f"blocking pair: {buyer} and {neighborhood}" for buyer, neighborhood in self.blocking_pairs]
+        lines += [f"over capacity: {neighborhood} has {matched} buyers for {capacity} places"
+                  for neighborhood, matched, capacity in self.capacity_violations]
+        lines += [f"unacceptable match: {buyer} doesn't list {neighborhood}"
+                  for buyer, neighborhood in self.unacceptable]
+        return '\n'.join(lines)
+
+def verify_stable(matches: Dict, buyers: Optional[Sequence] = None) -> StabilityReport:
+    """Check a ``{Neighborhood: [Homebuyer]}`` matching, as `buyer_optimal_match` returns it.
+
+    Pass every buyer in the market as `buyers` so that unmatched buyers are checked too; otherwise only
+    the buyers in `matches` are.
+    """
+    report = StabilityReport()
+    # the fit a buyer has to beat to be taken: None if the neighborhood has room for anyone
+    thresholds = {}
+    matched_to = {}
+    for neighborhood, matched in matches.items():
+        capacity = neighborhood.capacity
+        if len(matched) > capacity:
+            report.capacity_violations.append((neighborhood.name, len(matched), capacity))
+        thresholds[neighborhood] = _threshold([neighborhood.get_fitness(buyer) for buyer in matched], capacity)
+        for buyer in matched:
+            matched_to[buyer] = neighborhood
+
+    if buyers is None:
+        buyers = list(matched_to)
+    for buyer in buyers:
+        match = matched_to.get(buyer)
+        for neighborhood in buyer.prefs:
+            if neighborhood is match:
+                break
+            if neighborhood not in thresholds:
+                continue
+            threshold = thresholds[neighborhood]
+            if threshold is None or buyer.get_fitness(neighborhood) > threshold:
+                report.blocking_pairs.append((buyer.name, neighborhood.name))
+        else:
+            if match is not None:
+                report.unacceptable.append((buyer.name, match.name))
+    return report
+
+def _threshold(fits: Sequence, capacity: int):
+    if len(fits) < capacity:
+        return None
+    # a neighborhood with no room at all can't be blocked by anyone
+    return min(fits) if fits else float('inf')
+
+def verify_array(result: ArrayMatching, fits: Optional[Sequence] = None) -> StabilityReport:
+    """Check an `ArrayMatching`, as `engine.array_optimal_match` returns it.
+
+    `fits` is the fit of every preference, parallel to ``market.pref_indices``, if already known.
+    """
+    market = result.market
+    report = StabilityReport()
+    names = market.neighborhood_names
+    buyer_names = market.buyer_names
+    for n, (members, capacity) in enumerate(zip(result.members, result.capacities)):
+        if len(members) > capacity:
+            report.capacity_violations.append((names[n], len(members), capacity))
+    if fits is None:
+        fits = preference_fits(market)
+    offsets = market.pref_offsets
+    pref_indices = market.pref_indices
+    buyer_match = result.buyer_match
+
+    if numpy is not None:
+        blocking, unacceptable = _check_vectorized(result, fits)
+    else:
+        thresholds = [_threshold(member_fits, capacity)
+                      for member_fits, capacity in zip(result.member_fits, result.capacities)]
+        blocking = []
+        unacceptable = []
+        for buyer in range(market.buyer_count):
+            match = buyer_match[buyer]
+            for k in range(offsets[buyer], offsets[buyer + 1]):
+                n = pref_indices[k]
+                if n == match:
+                    break
+                threshold = thresholds[n]
+                if threshold is None or fits[k] > threshold:
+                    blocking.append((buyer, n))
+            else:
+                if match >= 0:
+                    unacceptable.append((buyer, match))
+
+    report.blocking_pairs = [(buyer_names[b], names[n]) for b, n in blocking]
+    report.unacceptable = [(buyer_names[b], names[n]) for b, n in unacceptable]
+    return report
+
+def _check_vectorized(result: ArrayMatching, fits: Sequence) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """The blocking pairs and unacceptable matches of `result`, as index pairs, computed with NumPy."""
+    market = result.market
+    offsets = numpy.asarray(market.pref_offsets, dtype=numpy.int64)
+    pref_indices = numpy.asarray(market.pref_indices, dtype=numpy.int64)
+    floating = market.schema.fit_typecode == 'd'
+    dtype = numpy.float64 if floating else numpy.int64
+    fits = numpy.asarray(fits, dtype=dtype)
+    buyer_match = numpy.asarray(result.buyer_match, dtype=numpy.int64)
+    lengths = numpy.diff(offsets)
+    owners = numpy.repeat(numpy.arange(market.buyer_count), lengths)
+
+    capacities = numpy.asarray(result.capacities, dtype=numpy.int64)
+    counts = numpy.array([len(members) for members in result.members], dtype=numpy.int64)
+    # a neighborhood with no room at all can't be blocked by anyone
+    full = numpy.inf if floating else numpy.iinfo(numpy.int64).max
+    lowest = numpy.array([min(member_fits) if member_fits else full for member_fits in result.member_fits],
+                         dtype=dtype)
+    room = counts < capacities
+
+    # the position of each buyer's match in their own preferences, or the end of them if there is none
+    hits = numpy.flatnonzero(pref_indices == buyer_match[owners])
+    match_position = offsets[1:].copy()
+    numpy.minimum.at(match_position, owners[hits], hits)
+    above = numpy.arange(len(pref_indices)) < match_position[owners]
+    beats = room[pref_indices] | (fits > lowest[pref_indices])
+    blocking = numpy.flatnonzero(above & beats)
+
+    matched = numpy.flatnonzero(buyer_match >= 0)
+    missing = matched[match_position[matched] == offsets[1:][matched]]
+    return (list(zip(owners[blocking].tolist(), pref_indices[blocking].tolist())),
+            list(zip(missing.tolist(), buyer_match[missing].tolist())))